@@ -3,41 +3,28 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import functools
 import numpy as np
-import pip
-from pip._internal import main
 import math
-import SimpleITK as sitk
 import re
 
-# Install necessary libraries
-try:
-    import matplotlib
-except ModuleNotFoundError:
-    import pip
-
-    slicer.util.pip_install("matplotlib")
-    import matplotlib
-
-try:
-    import PIL
-except ModuleNotFoundError:
-    import pip
-
-    slicer.util.pip_install("PIL")
-    import PIL
-
-try:
-    import skimage
-except ModuleNotFoundError:
-    import pip
-
-    slicer.util.pip_install("scikit-image")
-    import skimage
-
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-from pylab import savefig
+# Heavy third-party libraries (matplotlib, PIL, skimage, SimpleITK, ...) are imported on first use
+from HypModuleLib import installPackages, missingPackages, requireModule, requirePyplot
+from HypModuleLib import BackgroundJob, JobRunner
+from HypModuleLib import CELL_STATISTICS, StageScheduler, cellMeanIntensities, cellStatisticLut
+from HypModuleLib import compartmentColumnNames, compartmentMeanIntensities
+from HypModuleLib import labelsUnderSelection, percentileNormalize
+from HypModuleLib import MORPHOLOGY_FEATURES, borderLabels, cellMorphology, joinCellFeatures, removeCells
+from HypModuleLib import CellGate, GatingTree, cellLabels
+from HypModuleLib import CellTable
+from HypModuleLib import CELL_TABLE_FORMATS, cellTableBlocks, writeCellTable, writeCsvFiles
+from HypModuleLib import parseQuery, queryMarkers, queryRows, resolveMarker
+from HypModuleLib import ResultStore
+from HypModuleLib import TitanProject
+from HypModuleLib import OverlayCompositor, colourMatrix
+from HypModuleLib import PyramidCache, levelForScale
+from HypModuleLib import THUMBNAIL_SIZE, cachedStatistics, cachedThumbnails, cohortMontage, reduceToTile
+from HypModuleLib import binnedDensity, categoryColours, drawFigure, scatterPoints
 
 
 # Define global variables
@@ -52,8 +39,33 @@ roiDict = None
 selectedChannel = None
 scatterPlotRoi = None
 tsnePcaData = None
+# Bumped whenever tsnePcaData is replaced; the version of its source stage in the analysis pipeline
+tsnePcaVersion = 0
 gatingList = []
 selectedGates = None
+# Gates by name, each under the ROI or gate it was gated from: bitsets over the cells of their ROI with cached
+# per-gate cell subsets, statistics and counts. Their mask volumes are only made when shown
+gatingTree = GatingTree()
+# Gate of every cell of each ROI, with the version of the cell mask it was made from
+gatePopulations = {}
+# Normalized 8-bit previews of the channels shown in the overlay
+overlayCompositor = OverlayCompositor()
+# Block-mean image pyramids of the channels, used to display large ROIs at the resolution of the view
+channelPyramids = PyramidCache()
+# TITAN project that lazily opened volumes are paged in from
+titanProject = None
+# Analysis results are kept across sessions in a size-capped store under Slicer's cache directory, which is only
+# read when it is first used
+resultStore = ResultStore(os.path.join(slicer.app.cachePath, "TITAN"),
+                          int(qt.QSettings().value("TITAN/ResultStoreSizeMB", 2048)) * 1024 ** 2)
+# Cached results of the analysis stages (masks, features, embeddings, clusters), recomputed only when stale
+analysisPipeline = StageScheduler(store=resultStore)
+# Per-cell morphology of each ROI's cell mask, measured during segmentation (see cellMorphology)
+cellMorphologies = {}
+# Number of times the morphology of each ROI has been replaced; the version of its source stage
+morphologyVersions = {}
+# Stage of the cohort cell table (ROI, cell label and per-channel means of every cell) that analyses read from
+cellTableKey = None
 
 
 #
@@ -123,6 +135,8 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
 
         # Data
         self.ui.textFileLoad.connect("clicked(bool)", self.onTextFileLoad)
+        self.ui.openProjectButton.connect("clicked(bool)", self.onOpenProject)
+        self.ui.saveProjectButton.connect("clicked(bool)", self.onSaveProject)
 
         self.ui.roiList.connect("itemSelectionChanged()", self.onRoiList)
         self.ui.channelList.connect("itemSelectionChanged()", self.onChannelList)
@@ -132,6 +146,7 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         self.ui.resetViewButton.connect("clicked(bool)", self.onReset)
 
         self.ui.crtThumbnails.connect("clicked(bool)", self.onThumbnails)
+        self.ui.crtCohortMontage.connect("clicked(bool)", self.onCohortMontage)
 
         self.ui.roiVisualization.connect("activated(int)", self.onVisualization)
 
@@ -176,6 +191,8 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         self.ui.clearSelection.connect("clicked(bool)", self.onClearSelection)
 
         self.ui.gatingMasks.connect("itemSelectionChanged()", self.onGatingList)
+        self.ui.combineGates.connect("clicked(bool)", self.onCombineGates)
+        self.ui.queryGates.connect("clicked(bool)", self.onQueryGates)
 
         # Advanced
         self.ui.crtTsne.connect('clicked(bool)', self.onCreateTsne)
@@ -185,15 +202,74 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         self.ui.crtRawData.connect('clicked(bool)', self.onCreateRawData)
         # self.ui.crtPhenograph.connect('clicked(bool)', self.onPhenograph)
 
+        self.ui.resultCacheSize.value = resultStore.maxBytes // 1024 ** 2
+        self.ui.resultCacheSize.connect("valueChanged(int)", self.onResultCacheSize)
+        self.ui.clearResultCache.connect("clicked(bool)", self.onClearResultCache)
+
+        # Long analyses run on a worker thread; progress is reported in the bar below the tabs
+        self.jobRunner = JobRunner(self.onJobProgress, self.onJobState)
+        self.ui.cancelJobButton.connect("clicked(bool)", self.onCancelJob)
+
+        # Show the overlay at another pyramid level when the red slice view is zoomed
+        self.redSliceNode = slicer.util.getNode("vtkMRMLSliceNodeRed")
+        self.redSliceObserver = self.redSliceNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onRedSliceModified)
+
+        # Missing third-party packages are installed by one pip process in a background job, not at import time
+        missing = missingPackages()
+        if missing:
+            self.jobRunner.start(BackgroundJob("Installing " + ", ".join(missing),
+                                               lambda job: installPackages(missing)))
+
+    def cleanup(self):
+        self.jobRunner.cancel()
+        resultStore.flush()
+        self.redSliceNode.RemoveObserver(self.redSliceObserver)
+
     def onReset(self):
         slicer.util.resetSliceViews()
 
+    def onJobProgress(self, job, value, message):
+        self.ui.jobProgressBar.value = value
+        self.ui.jobStatusLabel.text = job.name + ": " + message
+
+    def onJobState(self, job):
+        self.ui.cancelJobButton.enabled = job.status == "running"
+        if job.status == "running":
+            self.ui.jobProgressBar.value = 0
+            self.ui.jobStatusLabel.text = job.name + ": started"
+        elif job.status == "done":
+            self.ui.jobProgressBar.value = 100
+            self.ui.jobStatusLabel.text = job.name + ": done"
+        else:
+            self.ui.jobStatusLabel.text = job.name + ": " + job.status
+
+    def onCancelJob(self):
+        self.jobRunner.cancel()
+
     def onSubjectHierarchy(self):
         print(self.ui.subjectHierarchy.currentItems)
 
     def onTextFileLoad(self):
         logic = HypModuleLogic()
         logic.textFileLoad()
+        logic.thumbnailCacheRun(self.jobRunner)
+
+    def onOpenProject(self):
+        path = qt.QFileDialog.getExistingDirectory(None, "Open TITAN Project", slicer.app.defaultScenePath)
+        if not path:
+            return
+        logic = HypModuleLogic()
+        logic.openProject(path)
+        self.onRefreshLists()
+        self.updateGatingMasks()
+
+    def onSaveProject(self):
+        path = qt.QFileDialog.getSaveFileName(None, "Save TITAN Project", slicer.app.defaultScenePath,
+                                              "TITAN project (*.titan)")
+        if not path:
+            return
+        logic = HypModuleLogic()
+        logic.saveProject(path)
 
     def onThumbnails(self):
         if selectedChannel is None or len(selectedChannel) <= 1:
@@ -207,9 +283,19 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         logic = HypModuleLogic()
         logic.thumbnails()
 
+    def onCohortMontage(self):
+        if selectedChannel is None or len(selectedChannel) < 1:
+            self.ui.thumbErrorMessage.text = "ERROR: Minimum 1 channel should be selected."
+            return
+        else:
+            self.ui.thumbErrorMessage.text = ""
+        logic = HypModuleLogic()
+        logic.cohortMontageRun(self.jobRunner)
+
     # Whenever something is updated in Visualization tab, this function runs
     def onVisualization(self):
         logic = HypModuleLogic()
+        logic.pageInVolumes([self.ui.roiVisualization.currentText])
 
         logic.visualizationRun(self.ui.roiVisualization.currentText, self.ui.redSelect.currentText,
                                self.ui.greenSelect.currentText, self.ui.blueSelect.currentText,
@@ -244,6 +330,10 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
                                         self.ui.yellowSelect.currentText or self.ui.cyanSelect.currentText or \
                                         self.ui.magentaSelect.currentText or self.ui.whiteSelect.currentText
 
+    def onRedSliceModified(self, caller, event):
+        if HypModuleLogic().overlayLevelStale():
+            self.onVisualization()
+
     def onGetWL(self):
         currentId = slicer.app.layoutManager().sliceWidget("Red").sliceLogic().GetSliceCompositeNode().GetBackgroundVolumeID()
         currentNode = slicer.util.getNode(currentId)
@@ -276,6 +366,7 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         selectedRoi = []
         for item in self.ui.roiList.selectedItems():
             selectedRoi.append(item.text())
+        HypModuleLogic().pageInVolumes(selectedRoi)
 
     def onChannelList(self):
         global selectedChannel
@@ -287,7 +378,36 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         global selectedGates
         selectedGates = []
         for item in self.ui.gatingMasks.selectedItems():
-            selectedGates.append(item.text())
+            selectedGates.append(item.data(qt.Qt.UserRole) or item.text())
+        HypModuleLogic().pageInVolumes(selectedGates)
+
+        # Counts come from the gate's cached bitset, without making its mask
+        if len(selectedGates) == 1 and selectedGates[0] in gatingTree:
+            name = selectedGates[0]
+            parent = gatingTree.parent(name) or gatingTree[name].roi
+            self.ui.selectedCellsCount.text = "%d (%.1f%% of %s)" % (gatingTree.count(name),
+                                                                     100 * gatingTree.fraction(name), parent)
+
+    def updateGatingMasks(self):
+        """
+        List the gating masks, each gate indented under the gate it was gated from. The tooltip of a gate shows the
+        per-marker statistics computed for it so far
+        """
+        self.ui.gatingMasks.clear()
+        for root in gatingList:
+            if root in gatingTree and gatingTree.parent(root) is not None:
+                continue
+            names = gatingTree.walk(root) if root in gatingTree else [(root, 0)]
+            for name, depth in names:
+                item = qt.QListWidgetItem("    " * depth + name)
+                item.setData(qt.Qt.UserRole, name)
+                summary = gatingTree.summaries(name) if name in gatingTree else {}
+                if summary:
+                    item.setToolTip("\n".join(
+                        "%s: mean %.3g, median %.3g (%d cells)" % (marker, values["mean"], values["median"],
+                                                                   values["count"])
+                        for marker, values in summary.items() if values["count"]))
+                self.ui.gatingMasks.addItem(item)
 
     def onRefreshLists(self):
         # Get list of ROI's
@@ -363,6 +483,9 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
             self.ui.magentaSelect.addItem(channel)
             self.ui.whiteSelect.addItem(channel)
 
+        # Fill the thumbnail cache for newly added channels in the background
+        HypModuleLogic().thumbnailCacheRun(self.jobRunner)
+
     # When "Save Image" is clicked, run saveVisualization function
     def onSaveButton(self):
         logic = HypModuleLogic()
@@ -382,7 +505,10 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         nucleiMin = self.ui.nucleiMin.value
         nucleiMax = self.ui.nucleiMax.value
         cellDim = self.ui.cellDimInput.value
-        nCells = logic.crtMasksRun(nucleiMin, nucleiMax, cellDim)
+        job = logic.crtMasksRun(nucleiMin, nucleiMax, cellDim, self.jobRunner)
+        job.addFinishedCallback(self.onMasksCreated)
+
+    def onMasksCreated(self, nCells):
         nCellsText = []
         for roi in nCells:
             nCellsText.append(roi + ": " + str(nCells[roi]))
@@ -402,7 +528,7 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
 
     def onHistoSave(self):
         logic = HypModuleLogic()
-        logic.saveTableData()
+        logic.saveTableData(self.jobRunner)
 
     def onHeatmapChannelPlot(self):
         if selectedChannel is None or len(selectedChannel) != 1:
@@ -417,11 +543,11 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         else:
             self.ui.analysisErrorMessage.text = ""
         logic = HypModuleLogic()
-        logic.heatmapChannelRun()
+        logic.heatmapChannelRun(CELL_STATISTICS[self.ui.heatmapStatistic.currentIndex])
 
     def onHeatmapSaveTable(self):
         logic = HypModuleLogic()
-        logic.saveTableData()
+        logic.saveTableData(self.jobRunner)
 
     def onScatterPlot(self):
         if selectedChannel is None or len(selectedChannel) != 2:
@@ -455,10 +581,9 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
 
         if selectedGates is None or len(selectedGates) == 0:
             logic.scatterPlotRun(False, arcsinState, logState)
-        elif len(selectedGates) > 1:
-            self.ui.analysisErrorMessage.text = "ERROR: One mask should be selected."
         else:
             logic.scatterPlotRun(True, arcsinState, logState)
+            self.updateGatingMasks()
 
         # Scatter plot gating signal
         layoutManager = slicer.app.layoutManager()
@@ -475,58 +600,45 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         existingMasks = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
 
 
+        from vtk.util import numpy_support
+
+        # Each plot series holds the cells of one ROI or gate
+        selections = []
         for selectionIndex in range(mrmlPlotDataIDs.GetNumberOfValues()):
-            pointIdList = []
-            pointIds = selectionCol.GetItemAsObject(selectionIndex)
-            for pointIndex in range(pointIds.GetNumberOfValues()):
-                pointIdList.append(pointIds.GetValue(pointIndex))
+            pointIds = numpy_support.vtk_to_numpy(selectionCol.GetItemAsObject(selectionIndex))
+            seriesNode = slicer.mrmlScene.GetNodeByID(mrmlPlotDataIDs.GetValue(selectionIndex))
+            source = seriesNode.GetAttribute("TITAN.Source") or scatterPlotRoi
+            labelColumn = numpy_support.vtk_to_numpy(seriesNode.GetTableNode().GetTable().GetColumnByName("Cell Label"))
+            selections.append((source, np.rint(labelColumn[pointIds]).astype(np.int64)))
 
         # Get cell number
-        tables = slicer.util.getNodesByClass("vtkMRMLTableNode")
-        tableNode = tables[0]
-        cellLabels = []
-        for cell in pointIdList:
-            label = tableNode.GetCellText(cell, 2)
-            cellLabels.append(label)
-        cellCount = len(cellLabels)
+        cellCount = sum(len(labels) for source, labels in selections)
         self.ui.selectedCellsCount.text = cellCount
         self.ui.tsneSelectedCellsCount.text = cellCount
 
-        cellMaskNode = globalCellMask[scatterPlotRoi]
-        cellMaskArray = slicer.util.arrayFromVolume(cellMaskNode)
-
-        selectedCellsMask = np.copy(cellMaskArray)
-
-        # Remove cells in the array that aren't part of the selected cells
-        for cell in np.unique(selectedCellsMask):
-            if cell != 0:
-                if str(cell) not in cellLabels:
-                    selectedCellsMask[selectedCellsMask == cell] = 0
-
-        # Create new cell mask image
-        name = self.ui.selectedCellsName.text + " - " + str(cellCount) + " Cells"
-
-        volumeNode = slicer.modules.volumes.logic().CloneVolume(cellMaskNode, name)
-        slicer.util.updateVolumeFromArray(volumeNode, selectedCellsMask)
-
-        # Add to global list of cell masks
-        globalCellMask[name] = volumeNode
+        # Store the selected cells as a gate of each plotted ROI or gate they were selected from
+        logic = HypModuleLogic()
+        name = None
+        for source, labels in selections:
+            name = self.ui.selectedCellsName.text
+            if len(selections) > 1:
+                name += " (" + source + ")"
+            name += " - " + str(len(labels)) + " Cells"
+            logic.addGate(name, logic.gateFromSelection(source, labels), source if source in gatingTree else None)
+        if name is None:
+            return
 
-        # Change colormap of volume
+        # Only the mask that is shown is made at full resolution
+        volumeNode = logic.cellMaskNode(name)
         red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
         red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(volumeNode.GetID())
 
         for img in existingMasks:
-            if name in img.GetName():
+            if name in img.GetName() and img is not volumeNode and slicer.mrmlScene.IsNodePresent(img):
                 slicer.mrmlScene.RemoveNode(img)
 
         # Add mask name to list of possible gating masks
-        global gatingList
-        if name not in gatingList:
-            gatingList.append(name)
-        self.ui.gatingMasks.clear()
-        for i in gatingList:
-            self.ui.gatingMasks.addItem(i)
+        self.updateGatingMasks()
 
     def onUpdatePlotFromSelection(self):
         """
@@ -536,7 +648,8 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         existingMasks = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
 
         # Export segmentation into a labelmap
-        cellMask = globalCellMask[scatterPlotRoi]
+        logic = HypModuleLogic()
+        cellMask = logic.cellMaskNode(scatterPlotRoi)
 
         segs = slicer.util.getNodesByClass("vtkMRMLSegmentationNode")
         seg = segs[-1]
@@ -545,41 +658,18 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         visibleIds = vtk.vtkStringArray()
         slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(seg, visibleIds, labelmap, cellMask)
 
-        selectedCellLabels = []
-
-        # Get values of cell labels
+        # Get values of cell labels under any of the selected segments
         cellMaskArray = slicer.util.arrayFromVolume(cellMask)
         labelmapArray = slicer.util.arrayFromVolume(labelmap)
-        for selection in np.unique(labelmapArray):
-            if selection != 0:
-                points = np.where(labelmapArray == selection)
-                values = cellMaskArray[points]
-                cellLabels = list(np.unique(values))
-                for i in cellLabels:
-                    if i != 0:
-                        # if np.any(i not in selectedCellLabels):
-                        if i not in selectedCellLabels:
-                            selectedCellLabels.append(i)
-
-        selectedCellsMask = np.copy(cellMaskArray)
-
-        # Remove cells in the array that aren't part of the selected cells
-        for cell in np.unique(selectedCellsMask):
-            if cell != 0:
-                if cell not in selectedCellLabels:
-                # if np.any(cell not in selectedCellLabels):
-                    selectedCellsMask[selectedCellsMask == cell] = 0
-
-        # Create new cell mask image
-        name = self.ui.selectedCellsName.text
+        selectedCellLabels = labelsUnderSelection(cellMaskArray, labelmapArray)
 
-        volumeNode = slicer.modules.volumes.logic().CloneVolume(cellMask, name)
-        slicer.util.updateVolumeFromArray(volumeNode, selectedCellsMask)
-
-        # Add to global list of cell masks
-        globalCellMask[name] = volumeNode
+        # Store the selected cells as a gate and make its mask for display
+        name = self.ui.selectedCellsName.text
+        logic.addGate(name, logic.gateFromSelection(scatterPlotRoi, selectedCellLabels),
+                      scatterPlotRoi if scatterPlotRoi in gatingTree else None)
+        volumeNode = logic.cellMaskNode(name)
 
-        self.ui.selectedCellsCount.text = len(cellLabels)
+        self.ui.selectedCellsCount.text = len(selectedCellLabels)
 
         if self.ui.arcsinTrans.checkState()==0:
             arcsinState = False
@@ -591,29 +681,89 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
         else:
             logState = True
 
-        logic = HypModuleLogic()
-
         if selectedGates is None or len(selectedGates) == 0:
             logic.scatterPlotRun(False, arcsinState, logState)
-        elif len(selectedGates) > 1:
-            self.ui.analysisErrorMessage.text = "ERROR: One mask should be selected."
         else:
             logic.scatterPlotRun(True, arcsinState, logState)
+            self.updateGatingMasks()
 
         red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
         red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(volumeNode.GetID())
 
         for img in existingMasks:
-            if name in img.GetName():
+            if name in img.GetName() and img is not volumeNode and slicer.mrmlScene.IsNodePresent(img):
                 slicer.mrmlScene.RemoveNode(img)
 
         # Add mask name to list of possible gating masks
-        global gatingList
-        if name not in gatingList:
-            gatingList.append(name)
-        self.ui.gatingMasks.clear()
-        for i in gatingList:
-            self.ui.gatingMasks.addItem(i)
+        self.updateGatingMasks()
+
+    def onCombineGates(self):
+        """
+        Make a new gate from the selected gates with the chosen operation
+        """
+        operation = self.ui.gateOperation.currentText
+        nGates = 1 if operation == "NOT" else 2
+        if selectedGates is None or len(selectedGates) != nGates:
+            self.ui.analysisErrorMessage.text = "ERROR: " + str(nGates) + " mask(s) should be selected."
+            return
+        elif any(name not in gatingTree for name in selectedGates):
+            self.ui.analysisErrorMessage.text = "ERROR: Only masks gated on a plot or image can be combined."
+            return
+        else:
+            self.ui.analysisErrorMessage.text = ""
+
+        logic = HypModuleLogic()
+        try:
+            name = logic.combineGates(operation, selectedGates)
+        except ValueError:
+            self.ui.analysisErrorMessage.text = "ERROR: Masks of different ROIs cannot be combined."
+            return
+        self.ui.selectedCellsCount.text = gatingTree.count(name)
+
+        volumeNode = logic.cellMaskNode(name)
+        red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
+        red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(volumeNode.GetID())
+
+        self.updateGatingMasks()
+
+    def onQueryGates(self):
+        """
+        Gate the cells satisfying the marker query (e.g. CD3 > 2 & CD20 < 0.5) in each selected ROI, or within each
+        selected mask
+        """
+        query = self.ui.cellQuery.text.strip()
+        sources = list(selectedGates) if selectedGates else list(selectedRoi or [])
+        if len(globalCellMask) == 0:
+            self.ui.analysisErrorMessage.text = "ERROR: Masks have not been created."
+            return
+        elif len(sources) == 0:
+            self.ui.analysisErrorMessage.text = "ERROR: Minimum 1 ROI or mask should be selected."
+            return
+        elif any(source not in gatingTree and source not in globalCellMask for source in sources):
+            self.ui.analysisErrorMessage.text = "ERROR: Only ROIs with cell masks and gated masks can be queried."
+            return
+        else:
+            self.ui.analysisErrorMessage.text = ""
+
+        logic = HypModuleLogic()
+        try:
+            gates = logic.queryGates(query, sources)
+        except ValueError as error:
+            self.ui.analysisErrorMessage.text = "ERROR: " + str(error)
+            return
+
+        name = None
+        for source, gate in gates.items():
+            name = source + ": " + query
+            logic.addGate(name, gate, source if source in gatingTree else None)
+        self.ui.selectedCellsCount.text = sum(gate.count() for gate in gates.values())
+
+        # Show the mask of the last gate
+        volumeNode = logic.cellMaskNode(name)
+        red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
+        red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(volumeNode.GetID())
+
+        self.updateGatingMasks()
 
     def onClearSelection(self):
         existingSegs = slicer.util.getNodesByClass("vtkMRMLSegmentationNode")
@@ -623,7 +773,7 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
 
     def onScatPlotSaveTable(self):
         logic = HypModuleLogic()
-        logic.saveTableData()
+        logic.saveTableData(self.jobRunner)
 
     def onHeatmapPlot(self):
         if selectedChannel is None or len(selectedChannel) < 1:
@@ -664,14 +814,20 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
 
         self.ui.tsneSelectedCellsCount.text = ""
 
+        # Masks without cells are left out of the embedding
+        emptyGates = [name for name in selectedGates or [] if name in gatingTree and gatingTree.count(name) == 0]
+        if emptyGates and len(emptyGates) == len(selectedGates):
+            self.ui.advancedErrorMessage.text = "ERROR: The selected masks have no cells."
+            return
+        elif emptyGates:
+            self.ui.advancedErrorMessage.text = "Masks without cells are left out: " + ", ".join(emptyGates)
+
         logic = HypModuleLogic()
 
         if selectedGates is None or len(selectedGates) == 0:
-            logic.tsnePCARun("tsne", False)
-        elif len(selectedGates) > 1:
-            self.ui.advancedErrorMessage.text = "ERROR: One mask should be selected."
+            logic.tsnePCARun("tsne", False, self.jobRunner)
         else:
-            logic.tsnePCARun("tsne", True)
+            logic.tsnePCARun("tsne", True, self.jobRunner)
 
         # Scatter plot gating signal
         layoutManager = slicer.app.layoutManager()
@@ -691,14 +847,20 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
 
         self.ui.tsneSelectedCellsCount.text = ""
 
+        # Masks without cells are left out of the embedding
+        emptyGates = [name for name in selectedGates or [] if name in gatingTree and gatingTree.count(name) == 0]
+        if emptyGates and len(emptyGates) == len(selectedGates):
+            self.ui.advancedErrorMessage.text = "ERROR: The selected masks have no cells."
+            return
+        elif emptyGates:
+            self.ui.advancedErrorMessage.text = "Masks without cells are left out: " + ", ".join(emptyGates)
+
         logic = HypModuleLogic()
 
         if selectedGates is None or len(selectedGates) == 0:
-            logic.tsnePCARun("pca", False)
-        elif len(selectedGates) > 1:
-            self.ui.advancedErrorMessage.text = "ERROR: One mask should be selected."
+            logic.tsnePCARun("pca", False, self.jobRunner)
         else:
-            logic.tsnePCARun("pca", True)
+            logic.tsnePCARun("pca", True, self.jobRunner)
 
         # Scatter plot gating signal
         layoutManager = slicer.app.layoutManager()
@@ -708,11 +870,11 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
 
     def onCreateKMeans(self):
         logic = HypModuleLogic()
-        logic.clusterRun(nClusters=self.ui.nClusters.value, clusterType="kmeans")
+        logic.clusterRun(nClusters=self.ui.nClusters.value, clusterType="kmeans", runner=self.jobRunner)
 
     def onHierarchicalCluster(self):
         logic = HypModuleLogic()
-        logic.clusterRun(nClusters=self.ui.nClusters.value, clusterType="hierarchical")
+        logic.clusterRun(nClusters=self.ui.nClusters.value, clusterType="hierarchical", runner=self.jobRunner)
 
     # def onPhenograph(self):
     #     if selectedChannel is None or len(selectedChannel) < 1:
@@ -727,9 +889,16 @@ class HypModuleCodeWidget(ScriptedLoadableModuleWidget):
     #     logic = HypModuleLogic()
     #     logic.phenographRun()
 
+    def onResultCacheSize(self, sizeMB):
+        qt.QSettings().setValue("TITAN/ResultStoreSizeMB", sizeMB)
+        resultStore.setMaxBytes(sizeMB * 1024 ** 2)
+
+    def onClearResultCache(self):
+        resultStore.clear()
+
     def onCreateRawData(self):
         logic = HypModuleLogic()
-        logic.rawDataRun()
+        logic.rawDataRun(self.jobRunner, self.ui.rawDataFormat.currentText)
 
 
 #
@@ -747,6 +916,224 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    def runJob(self, job, runner=None, modules=()):
+        """
+        Run a BackgroundJob on the given JobRunner and return the job, or run it synchronously and return its result.
+        Packages of the given modules that the job imports and that are missing are installed by a job queued
+        before it, since requireModule does not install from worker threads
+        """
+        if runner is None:
+            return job.runNow()
+        missing = missingPackages(modules)
+        if missing:
+            runner.start(BackgroundJob("Installing " + ", ".join(missing),
+                                       lambda installJob: installPackages(missingPackages(modules))))
+        return runner.start(job)
+
+    def volumeStage(self, volumeNode):
+        """
+        Register a volume as a source stage of the analysis pipeline and return its key.
+        The voxels are only copied again when the volume has been modified
+        """
+        key = ("volume", volumeNode.GetID())
+        imageData = volumeNode.GetImageData()
+        version = (imageData.GetMTime(), imageData.GetPointData().GetScalars().GetMTime())
+        analysisPipeline.setSource(key, version, lambda: np.array(slicer.util.arrayFromVolume(volumeNode)))
+        return key
+
+    def featureStage(self, cellMaskNode, channelStages):
+        """
+        Define the stage computing per-cell mean intensities of the given channel stages within a cell mask
+        """
+        maskKey = self.volumeStage(cellMaskNode)
+        key = ("features", maskKey[1]) + tuple(channelKey[1] for channelKey in channelStages)
+        analysisPipeline.define(key, cellMeanIntensities, [maskKey] + list(channelStages))
+        return key
+
+    def nucleusMaskNode(self, roi):
+        """
+        Nucleus mask volume made for a ROI by Create Masks, or None
+        """
+        return slicer.mrmlScene.GetFirstNodeByName(roi + " Nucleus Mask")
+
+    def compartmentFeatureStage(self, roi, channelStages):
+        """
+        Define the stage computing per-cell mean intensities of the given channel stages in the whole cell, nucleus
+        and cytoplasm of a ROI's cells in one pass (see compartmentMeanIntensities). Returns its key and whether the
+        ROI has a nucleus mask; without one only the whole-cell featureStage is defined
+        """
+        nucleusNode = self.nucleusMaskNode(roi)
+        if nucleusNode is None:
+            return self.featureStage(globalCellMask[roi], channelStages), False
+        maskKey = self.volumeStage(globalCellMask[roi])
+        nucleusKey = self.volumeStage(nucleusNode)
+        key = ("compartmentFeatures", maskKey[1], nucleusKey[1]) + tuple(channelKey[1] for channelKey in channelStages)
+        analysisPipeline.define(key, compartmentMeanIntensities, [maskKey, nucleusKey] + list(channelStages))
+        return key, True
+
+    def roiChannelNodes(self, rois):
+        """
+        Marker channels of the given ROIs as {roi: [(channel name without the ROI suffix, channel node)]}
+        """
+        allChannels = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+        roiChannels = {}
+        for roi in rois:
+            roiChannels[roi] = []
+        for channelNode in allChannels:
+            itemId = shNode.GetItemByDataNode(channelNode)  # Channel
+            parent = shNode.GetItemParent(itemId)  # ROI
+            roiName = shNode.GetItemName(parent)
+            channelName = shNode.GetItemName(itemId)
+            if ".ome" not in channelName:
+                continue
+            if re.findall(r"_[0-9]\b", channelName) != []:
+                channelName = channelName[:-2]
+            if roiName == "Scene":
+                roiName = "ROI"
+            if roiName not in roiChannels:
+                continue
+            roiChannels[roiName].append((channelName, channelNode))
+        return roiChannels
+
+    def sourceChannelNodes(self, source, channelNames):
+        """
+        Nodes of the named marker channels in the ROI of a source (a ROI or a gate)
+        """
+        roi = gatingTree[source].roi if source in gatingTree else source
+        nodes = dict(self.roiChannelNodes([roi])[roi])
+        return [nodes[channelName] for channelName in channelNames]
+
+    def cellTableStage(self, rois):
+        """
+        Define the stage building the cohort cell table of the given ROIs (see buildCellTable) over their feature
+        stages, and make it the table later analyses read from. Returns its key
+        """
+        global cellTableKey
+        roiChannels = self.roiChannelNodes(rois)
+        stageKeys = []
+        roiColumns = []
+        for roi in rois:
+            featureKey, compartments = self.compartmentFeatureStage(roi, [self.volumeStage(channelNode) for
+                                                                          channelName, channelNode in roiChannels[roi]])
+            stageKeys.append(featureKey)
+            stageKeys.append(self.morphologyStage(roi))
+            roiChannelNames = [channelName for channelName, channelNode in roiChannels[roi]]
+            roiColumns.append(compartmentColumnNames(roiChannelNames) if compartments else roiChannelNames)
+        cellTableKey = ("cellTable",) + tuple(stageKeys)
+        analysisPipeline.define(cellTableKey, self.buildCellTable, stageKeys,
+                                {"rois": list(rois), "roiColumns": roiColumns,
+                                 "columnNames": compartmentColumnNames(channelNames) + list(MORPHOLOGY_FEATURES)})
+        return cellTableKey
+
+    def buildCellTable(self, *roiResults, rois, roiColumns, columnNames):
+        """
+        Cohort cell table with one column per channel and compartment and per morphology feature, appended ROI by ROI
+        from their per-cell features and morphology (alternating in roiResults). Channels a ROI does not have, and
+        the nucleus and cytoplasm columns of ROIs without a nucleus mask, are 0
+        """
+        cells = CellTable(columnNames)
+        for index, roi in enumerate(rois):
+            features = joinCellFeatures(roiResults[2 * index], roiResults[2 * index + 1])
+            cells.appendFeatures(roi, features, roiColumns[index] + list(MORPHOLOGY_FEATURES))
+        return cells
+
+    def morphologyStage(self, roi):
+        """
+        Register the morphology of a ROI's cells as a stage of the analysis pipeline and return its key: the table
+        measured during segmentation, or for masks that were not segmented in this session a stage measuring it
+        from the cell mask
+        """
+        cellMaskNode = globalCellMask[roi]
+        if roi in cellMorphologies:
+            key = ("morphology", cellMaskNode.GetID())
+            analysisPipeline.setSource(key, morphologyVersions.get(roi, 0), lambda: cellMorphologies[roi])
+            return key
+        maskKey = self.volumeStage(cellMaskNode)
+        key = ("measuredMorphology", maskKey[1])
+        analysisPipeline.define(key, cellMorphology, [maskKey])
+        return key
+
+    def cohortCells(self):
+        """
+        The last cohort cell table built, or None if there is none or its masks or channels have changed since
+        """
+        if cellTableKey is None or not analysisPipeline.hasResult(cellTableKey):
+            return None
+        return analysisPipeline.result(cellTableKey)
+
+    def queryGates(self, query, sources):
+        """
+        Gate the cells of each source (a ROI or a gate) whose per-cell channel means and morphology satisfy a
+        marker-threshold query such as "CD3 > 2 & CD20 < 0.5", "CD3.nucleus > 2" or "Area > 40". ROIs are read from
+        the cohort cell table when it has been built; otherwise only the channels named in the query are quantified,
+        in every compartment at once, through the cached feature stages of the analysis pipeline. Each comparison is
+        evaluated over all cells at once. Returns {source: gate}; raises ValueError for a malformed query or an
+        unknown marker
+        """
+        expression = parseQuery(query)
+        markers = queryMarkers(expression)
+        rois = [gatingTree[source].roi if source in gatingTree else source for source in sources]
+        self.pageInVolumes(list(set(rois)))
+        roiChannels = self.roiChannelNodes(set(rois))
+
+        # ROIs in the cohort cell table are read from it; the others quantify just the channels in the query
+        cells = self.cohortCells()
+        featureStages = []
+        for source, roi in zip(sources, rois):
+            if cells is not None and roi in cells:
+                # Cached gate rows of the table's columns are reused until the cell table stage is recomputed
+                tableRows = (cellTableKey, roi) + tuple(markers)
+                columns = [cells.columnNames[resolveMarker(marker, cells.columnNames)] for marker in markers]
+                featureStages.append((source, tableRows, columns, cells.features(roi, columns),
+                                      analysisPipeline.generation(cellTableKey)))
+                continue
+            # Markers are channels in a compartment or morphology features
+            roiChannelNames = [channelName for channelName, channelNode in roiChannels[roi]]
+            compartments = self.nucleusMaskNode(roi) is not None
+            names = compartmentColumnNames(roiChannelNames) if compartments else roiChannelNames
+            nColumns = len(names)
+            indices = [resolveMarker(marker, names + list(MORPHOLOGY_FEATURES)) for marker in markers]
+            needed = sorted({index % len(roiChannelNames) for index in indices if index < nColumns})
+            channels = [roiChannels[roi][index] for index in needed]
+            featureKey, compartments = self.compartmentFeatureStage(roi, [self.volumeStage(channelNode)
+                                                                          for channelName, channelNode in channels])
+            columns = [channelName for channelName, channelNode in channels]
+            columns = compartmentColumnNames(columns) if compartments else columns
+            stageKeys = (featureKey,)
+            if any(index >= nColumns for index in indices):
+                stageKeys += (self.morphologyStage(roi),)
+                columns += list(MORPHOLOGY_FEATURES)
+            featureStages.append((source, stageKeys, columns, None, None))
+        results = analysisPipeline.run([key for source, stageKeys, columns, rows, version in featureStages
+                                        if rows is None for key in stageKeys])
+
+        gates = {}
+        for source, stageKeys, columns, rows, version in featureStages:
+            if rows is None:
+                rows = results[stageKeys[0]]
+                if len(stageKeys) > 1:
+                    rows = joinCellFeatures(rows, results[stageKeys[1]])
+                version = tuple(analysisPipeline.generation(key) for key in stageKeys)
+            if source in gatingTree:
+                rows = gatingTree.rows(source, stageKeys, rows, version)
+            selected = queryRows(expression, rows, columns)
+            gates[source] = self.gateFromSelection(source, rows[selected, 0].astype(np.int64))
+        return gates
+
+    def gateFeatures(self, name, channelNodes):
+        """
+        Per-cell mean intensities of the given channels in the cells of a gate, as rows of (cell label, channel ...).
+        The features of the gate's ROI come from the analysis pipeline; the gate's rows and per-marker statistics
+        are cached in the gating tree until the feature stage is recomputed
+        """
+        gate = gatingTree[name]
+        self.pageInVolumes([gate.roi])
+        featureKey = self.featureStage(globalCellMask[gate.roi], [self.volumeStage(node) for node in channelNodes])
+        features = analysisPipeline.run([featureKey])[featureKey]
+        version = analysisPipeline.generation(featureKey)
+        gatingTree.statistics(name, featureKey, features, [node.GetName() for node in channelNodes], version)
+        return gatingTree.rows(name, featureKey, features, version)
 
     def textFileLoad(self):
         # Open file explorer for user to select files
@@ -844,6 +1231,268 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
             roiCount += 1
 
 
+    def saveProject(self, path):
+        """
+        Save channels, masks, gates, tables and the t-SNE/PCA embedding as a TITAN project folder: compressed,
+        chunked arrays plus an index of everything in them
+        """
+        project = TitanProject(path)
+        sameProject = titanProject is not None and os.path.abspath(titanProject.path) == os.path.abspath(path)
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+
+        # ROI (or gate) that each cell mask belongs to
+        maskRois = {}
+        for roi, cellMask in globalCellMask.items():
+            maskRois[cellMask.GetID()] = roi
+
+        from vtk.util import numpy_support
+
+        volumes = []
+        for volumeNode in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
+            # Plots and selection labelmaps are regenerated, not saved
+            if volumeNode.IsA("vtkMRMLVectorVolumeNode") or volumeNode.IsA("vtkMRMLLabelMapVolumeNode"):
+                continue
+            # Gates are saved as bitsets below; their masks are made again when used
+            if volumeNode.GetName() in gatingTree and globalCellMask.get(volumeNode.GetName()) is volumeNode:
+                continue
+            name = volumeNode.GetName()
+            itemId = shNode.GetItemByDataNode(volumeNode)
+            folder = shNode.GetItemName(shNode.GetItemParent(itemId))
+            if volumeNode.GetID() in maskRois:
+                roi = maskRois[volumeNode.GetID()]
+            elif name.endswith(" Nucleus Mask") or name.endswith(" Cytoplasm Mask"):
+                roi = name.rsplit(" ", 2)[0]
+            elif folder == "Scene":
+                roi = "ROI"
+            else:
+                roi = folder
+
+            arrayName = "volumes/" + name
+            lazyArray = volumeNode.GetAttribute("TITAN.ProjectArray")
+            if not (sameProject and lazyArray == arrayName):
+                # Volumes that were never paged in are copied straight from the project they were opened from
+                if lazyArray is not None:
+                    voxels = titanProject.array(lazyArray).read()
+                else:
+                    voxels = slicer.util.arrayFromVolume(volumeNode)
+                ijkToRas = vtk.vtkMatrix4x4()
+                volumeNode.GetIJKToRASMatrix(ijkToRas)
+                displayNode = volumeNode.GetDisplayNode()
+                attributes = {
+                    "ijkToRas": [ijkToRas.GetElement(i, j) for i in range(4) for j in range(4)],
+                    "colorNodeID": displayNode.GetColorNodeID() if displayNode is not None else None,
+                }
+                project.writeArray(arrayName, voxels, attributes=attributes)
+            volumes.append({"name": name, "folder": folder, "roi": roi, "array": arrayName,
+                            "cellMask": volumeNode.GetID() in maskRois})
+
+        # Tables: numeric columns as arrays, text columns in the index
+        tables = []
+        for tableNode in slicer.util.getNodesByClass("vtkMRMLTableNode"):
+            table = tableNode.GetTable()
+            columns = {}
+            for columnIndex in range(table.GetNumberOfColumns()):
+                column = table.GetColumn(columnIndex)
+                if column.IsA("vtkDataArray"):
+                    columns[column.GetName()] = numpy_support.vtk_to_numpy(column)
+                else:
+                    columns[column.GetName()] = [column.GetValue(row) for row in range(column.GetNumberOfValues())]
+            project.writeTable(tableNode.GetName(), columns)
+            tables.append(tableNode.GetName())
+
+        if tsnePcaData is not None:
+            project.writeTable("embedding", {column: tsnePcaData[column].to_numpy() for column in tsnePcaData.columns})
+
+        project.setMetadata("volumes", volumes)
+        project.setMetadata("sceneTables", tables)
+        project.setMetadata("embedding", tsnePcaData is not None)
+        gates = {}
+        for name, depth in gatingTree.walk():
+            gate = gatingTree[name]
+            project.writeArray("gates/" + name + "/cells", gate.bits)
+            project.writeArray("gates/" + name + "/population", gate.populationBits)
+            gates[name] = {"roi": gate.roi, "parent": gatingTree.parent(name), "cells": "gates/" + name + "/cells",
+                           "population": "gates/" + name + "/population"}
+        project.setMetadata("gates", gates)
+        morphology = {}
+        for roi, cellShapes in cellMorphologies.items():
+            project.writeArray("morphology/" + roi, cellShapes)
+            morphology[roi] = "morphology/" + roi
+        project.setMetadata("morphology", morphology)
+        project.setMetadata("gatingList", list(gatingList))
+        project.save()
+        return project
+
+    def openProject(self, path):
+        """
+        Open a TITAN project. Only the index is read: volumes are created empty and their voxels are paged in by
+        pageInVolumes when their ROI or gate is first used
+        """
+        global titanProject
+        global tsnePcaData
+        global tsnePcaVersion
+
+        project = TitanProject(path)
+        titanProject = project
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+        sceneId = shNode.GetSceneItemID()
+        folders = {}
+
+        for volume in project.metadata("volumes", []):
+            attributes = project.arrayAttributes(volume["array"])
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", volume["name"])
+            ijkToRas = vtk.vtkMatrix4x4()
+            for index, value in enumerate(attributes.get("ijkToRas", [])):
+                ijkToRas.SetElement(index // 4, index % 4, value)
+            volumeNode.SetIJKToRASMatrix(ijkToRas)
+
+            # One-voxel placeholder until the volume is paged in
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(1, 1, 1)
+            imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+            imageData.GetPointData().GetScalars().Fill(0)
+            volumeNode.SetAndObserveImageData(imageData)
+            volumeNode.CreateDefaultDisplayNodes()
+            volumeNode.CreateDefaultStorageNode()
+            if attributes.get("colorNodeID") and slicer.mrmlScene.GetNodeByID(attributes["colorNodeID"]):
+                volumeNode.GetDisplayNode().SetAndObserveColorNodeID(attributes["colorNodeID"])
+            volumeNode.SetAttribute("TITAN.ProjectArray", volume["array"])
+            volumeNode.SetAttribute("TITAN.ROI", volume["roi"])
+
+            # Put the volume back in its ROI folder
+            if volume["folder"] != "Scene":
+                if volume["folder"] not in folders:
+                    folders[volume["folder"]] = shNode.CreateFolderItem(sceneId, volume["folder"])
+                shNode.SetItemParent(shNode.GetItemByDataNode(volumeNode), folders[volume["folder"]])
+
+            if volume["cellMask"]:
+                globalCellMask[volume["roi"]] = volumeNode
+
+        from vtk.util import numpy_support
+
+        for name in project.metadata("sceneTables", []):
+            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", name)
+            for columnName, values in project.readTable(name).items():
+                if isinstance(values, list):
+                    column = vtk.vtkStringArray()
+                    for value in values:
+                        column.InsertNextValue(value)
+                else:
+                    column = numpy_support.numpy_to_vtk(values, deep=True)
+                column.SetName(columnName)
+                tableNode.AddColumn(column)
+
+        if project.metadata("embedding"):
+            pd = requireModule("pandas")
+            tsnePcaData = pd.DataFrame(project.readTable("embedding"))
+            tsnePcaVersion += 1
+
+        for name, gate in project.metadata("gates", {}).items():
+            # Parents are listed before their children
+            gatingTree.add(name, CellGate(gate["roi"], project.array(gate["cells"]).read(),
+                                          project.array(gate["population"]).read()), gate.get("parent"))
+
+        for roi, arrayName in project.metadata("morphology", {}).items():
+            cellMorphologies[roi] = project.array(arrayName).read()
+            morphologyVersions[roi] = morphologyVersions.get(roi, 0) + 1
+
+        for name in project.metadata("gatingList", []):
+            if name not in gatingList:
+                gatingList.append(name)
+
+        return project
+
+    def pageInVolumes(self, rois=None):
+        """
+        Read the voxels of lazily opened project volumes belonging to the given ROIs or gates (all if rois is None)
+        """
+        if titanProject is None:
+            return
+        for volumeNode in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
+            arrayName = volumeNode.GetAttribute("TITAN.ProjectArray")
+            if arrayName is None:
+                continue
+            if rois is not None and volumeNode.GetAttribute("TITAN.ROI") not in rois:
+                continue
+            slicer.util.updateVolumeFromArray(volumeNode, titanProject.array(arrayName).read())
+            volumeNode.RemoveAttribute("TITAN.ProjectArray")
+
+    def gatePopulation(self, roi):
+        """
+        Gate holding every cell of a ROI, made again only when the ROI's cell mask changed
+        """
+        cellMaskNode = globalCellMask[roi]
+        version = cellMaskNode.GetImageData().GetMTime() if cellMaskNode.GetImageData() is not None else 0
+        cached = gatePopulations.get(roi)
+        if cached is None or cached[0] != version:
+            cellMaskArray = slicer.util.arrayFromVolume(cellMaskNode)
+            cached = (version, CellGate.population(roi, cellLabels(cellMaskArray)))
+            gatePopulations[roi] = cached
+        return cached[1]
+
+    def gateFromSelection(self, source, labels):
+        """
+        Gate of the given cells of a ROI or of another gate
+        """
+        parent = gatingTree.get(source)
+        if parent is None:
+            parent = self.gatePopulation(source)
+        return parent.subset(labels)
+
+    def addGate(self, name, gate, parent=None):
+        """
+        Store a gate under name, as a child of the gate parent (None for its ROI), replacing any gate of that name
+        together with its mask volume and caches, and list it as a gating mask
+        """
+        gatingTree.add(name, gate, parent)
+        oldMask = globalCellMask.pop(name, None)
+        if oldMask is not None and slicer.mrmlScene.IsNodePresent(oldMask):
+            slicer.mrmlScene.RemoveNode(oldMask)
+        if name not in gatingList:
+            gatingList.append(name)
+
+    def cellMaskNode(self, name):
+        """
+        Cell mask volume of a ROI or a gate. A gate's mask is only made from its bitset when it is first needed
+        """
+        gate = gatingTree.get(name)
+        volumeNode = globalCellMask.get(name)
+        if gate is None or (volumeNode is not None and slicer.mrmlScene.IsNodePresent(volumeNode)):
+            return globalCellMask[name]
+        self.pageInVolumes([gate.roi])
+        roiMask = globalCellMask[gate.roi]
+        volumeNode = slicer.modules.volumes.logic().CloneVolume(roiMask, name)
+        slicer.util.updateVolumeFromArray(volumeNode, gate.mask(slicer.util.arrayFromVolume(roiMask)))
+        globalCellMask[name] = volumeNode
+        return volumeNode
+
+    def combineGates(self, operation, names):
+        """
+        New gate from the named gates: the "AND", "OR" or "Difference" (first minus second) of two gates, or "NOT"
+        of one. Returns the name of the new gate
+        """
+        gates = [gatingTree[name] for name in names]
+        # AND and Difference give a subset of the first gate, so they are placed under it
+        parent = None
+        if operation == "NOT":
+            gate = ~gates[0]
+            name = "NOT " + names[0]
+        elif operation == "AND":
+            gate = gates[0] & gates[1]
+            name = names[0] + " AND " + names[1]
+            parent = names[0]
+        elif operation == "OR":
+            gate = gates[0] | gates[1]
+            name = names[0] + " OR " + names[1]
+        elif operation == "Difference":
+            gate = gates[0] - gates[1]
+            name = names[0] + " - " + names[1]
+            parent = names[0]
+        else:
+            raise ValueError("Unknown gate operation " + repr(operation))
+        self.addGate(name, gate, parent)
+        return name
+
     def visualizationRun(self, roiSelect, redSelect, greenSelect, blueSelect, yellowSelect, cyanSelect, magentaSelect, whiteSelect, threshMin, threshMax):
         """
         Runs the algorithm to display the volumes selected in "Visualization" in their respective colours
@@ -853,226 +1502,166 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
 
         # Make dictionary of the selected channels
         selectChannels = {} # key = colour, value = node
+        colourSelects = {"red": redSelect, "green": greenSelect, "blue": blueSelect, "yellow": yellowSelect,
+                         "cyan": cyanSelect, "magenta": magentaSelect, "white": whiteSelect}
         shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
         allChannels = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
         for channel in allChannels:
             name = channel.GetName()
-            if redSelect in name:
-                # Check if channel is the correct ROI
-                id = shNode.GetItemByDataNode(channel)
-                parent = shNode.GetItemParent(id)
-                if roiSelect == "ROI":
-                    selectChannels["red"] = channel
-                else:
-                    roiName = shNode.GetItemName(parent)
-                    if roiName == roiSelect:
-                        selectChannels["red"] = channel
-            elif greenSelect in name:
-                # Check if channel is the correct ROI
-                id = shNode.GetItemByDataNode(channel)
-                parent = shNode.GetItemParent(id)
-                if roiSelect == "ROI":
-                    selectChannels["green"] = channel
-                else:
-                    roiName = shNode.GetItemName(parent)
-                    if roiName == roiSelect:
-                        selectChannels["green"] = channel
-            elif blueSelect in name:
-                # Check if channel is the correct ROI
-                id = shNode.GetItemByDataNode(channel)
-                parent = shNode.GetItemParent(id)
-                if roiSelect == "ROI":
-                    selectChannels["blue"] = channel
-                else:
-                    roiName = shNode.GetItemName(parent)
-                    if roiName == roiSelect:
-                        selectChannels["blue"] = channel
-            elif yellowSelect in name:
-                # Check if channel is the correct ROI
-                id = shNode.GetItemByDataNode(channel)
-                parent = shNode.GetItemParent(id)
-                if roiSelect == "ROI":
-                    selectChannels["yellow"] = channel
-                else:
-                    roiName = shNode.GetItemName(parent)
-                    if roiName == roiSelect:
-                        selectChannels["yellow"] = channel
-            elif cyanSelect in name:
-                # Check if channel is the correct ROI
-                id = shNode.GetItemByDataNode(channel)
-                parent = shNode.GetItemParent(id)
-                if roiSelect == "ROI":
-                    selectChannels["cyan"] = channel
-                else:
-                    roiName = shNode.GetItemName(parent)
-                    if roiName == roiSelect:
-                        selectChannels["cyan"] = channel
-            elif magentaSelect in name:
-                # Check if channel is the correct ROI
-                id = shNode.GetItemByDataNode(channel)
-                parent = shNode.GetItemParent(id)
-                if roiSelect == "ROI":
-                    selectChannels["magenta"] = channel
-                else:
-                    roiName = shNode.GetItemName(parent)
-                    if roiName == roiSelect:
-                        selectChannels["magenta"] = channel
-            elif whiteSelect in name:
-                # Check if channel is the correct ROI
-                id = shNode.GetItemByDataNode(channel)
-                parent = shNode.GetItemParent(id)
-                if roiSelect == "ROI":
-                    selectChannels["white"] = channel
-                else:
-                    roiName = shNode.GetItemName(parent)
-                    if roiName == roiSelect:
-                        selectChannels["white"] = channel
+            # A channel is shown in the first colour whose selection matches it
+            for colour, select in colourSelects.items():
+                if select in name:
+                    # Check if channel is the correct ROI
+                    if roiSelect == "ROI":
+                        selectChannels[colour] = channel
+                    else:
+                        parent = shNode.GetItemParent(shNode.GetItemByDataNode(channel))
+                        if shNode.GetItemName(parent) == roiSelect:
+                            selectChannels[colour] = channel
+                    break
+
+        if not selectChannels:
+            return False
+
+        # Pick the pyramid level matching the zoom of the red slice view; a new overlay is shown fitted to the view
+        firstNode = list(selectChannels.values())[0]
+        fullSize = slicer.util.arrayFromVolume(firstNode).shape
+        nLevels = len(self.channelPyramid(firstNode))
+        level = self.overlayViewLevel(fullSize, nLevels, self.overlayNode() is None)
+
         saveImageName = ""
-        arrayList = []
-        arraySize = None
+        channels = []
+        colours = []
         for colour in selectChannels:
-            if colour == "red":
-                name = redSelect[:-4]
-                saveImageName += name
-                # Set redscale array
-                array = slicer.util.arrayFromVolume(selectChannels[colour])
-                if array.shape[0] != 1:
-                    array = array[49]
-                    array = np.expand_dims(array, axis=0)
-                # Scale the array
-                scaled = np.interp(array, (array.min(), array.max()), (0, 255))
-                if arraySize == None:
-                    arraySize = scaled.shape
-                stacked = np.stack((scaled,) * 3, axis=-1)
-                stacked[:, :, :, 1] = 0
-                stacked[:, :, :, 2] = 0
-                arrayList.append(stacked)
-            elif colour == "green":
-                name = greenSelect[:-4]
-                saveImageName += name
-                # Set greenscale array
-                array = slicer.util.arrayFromVolume(selectChannels[colour])
-                # Scale the array
-                scaled = np.interp(array, (array.min(), array.max()), (0, 255))
-                if arraySize == None:
-                    arraySize = scaled.shape
-                stacked = np.stack((scaled,) * 3, axis=-1)
-                stacked[:, :, :, 0] = 0
-                stacked[:, :, :, 2] = 0
-                arrayList.append(stacked)
-            elif colour == "blue":
-                name = blueSelect[:-4]
-                saveImageName += name
-                # Set bluescale array
-                array = slicer.util.arrayFromVolume(selectChannels[colour])
-                # Scale the array
-                scaled = np.interp(array, (array.min(), array.max()), (0, 255))
-                if arraySize == None:
-                    arraySize = scaled.shape
-                stacked = np.stack((scaled,) * 3, axis=-1)
-                stacked[:, :, :, 0] = 0
-                stacked[:, :, :, 1] = 0
-                arrayList.append(stacked)
-            elif colour == "yellow":
-                name = yellowSelect[:-4]
-                saveImageName += name
-                # Set bluescale array
-                array = slicer.util.arrayFromVolume(selectChannels[colour])
-                # Scale the array
-                scaled = np.interp(array, (array.min(), array.max()), (0, 255))
-                if arraySize == None:
-                    arraySize = scaled.shape
-                stacked = np.stack((scaled,) * 3, axis=-1)
-                stacked[:, :, :, 2] = 0
-                arrayList.append(stacked)
-            elif colour == "cyan":
-                name = cyanSelect[:-4]
-                saveImageName += name
-                # Set bluescale array
-                array = slicer.util.arrayFromVolume(selectChannels[colour])
-                # Scale the array
-                scaled = np.interp(array, (array.min(), array.max()), (0, 255))
-                if arraySize == None:
-                    arraySize = scaled.shape
-                stacked = np.stack((scaled,) * 3, axis=-1)
-                stacked[:, :, :, 0] = 0
-                arrayList.append(stacked)
-            elif colour == "magenta":
-                name = magentaSelect[:-4]
-                saveImageName += name
-                # Set bluescale array
-                array = slicer.util.arrayFromVolume(selectChannels[colour])
-                # Scale the array
-                scaled = np.interp(array, (array.min(), array.max()), (0, 255))
-                if arraySize == None:
-                    arraySize = scaled.shape
-                stacked = np.stack((scaled,) * 3, axis=-1)
-                stacked[:, :, :, 1] = 0
-                arrayList.append(stacked)
-            elif colour == "white":
-                name = whiteSelect[:-4]
-                saveImageName += name
-                # Set bluescale array
-                array = slicer.util.arrayFromVolume(selectChannels[colour])
-                # Scale the array
-                scaled = np.interp(array, (array.min(), array.max()), (0, 255))
-                if arraySize == None:
-                    arraySize = scaled.shape
-                stacked = np.stack((scaled,) * 3, axis=-1)
-                arrayList.append(stacked)
-
-        overlay = sum(arrayList)
+            saveImageName += colourSelects[colour][:-4]
+            channelNode = selectChannels[colour]
+            channels.append(((channelNode.GetID(), level), channelNode.GetImageData().GetMTime(),
+                             functools.partial(self.overlayChannelArray, channelNode, level)))
+            colours.append(colour)
+
+        arraySize = self.overlayChannelArray(firstNode, level).shape
 
         # Run helper function
-        HypModuleLogic().visualizationRunHelper(overlay, threshMin, threshMax, saveImageName, arraySize,
-                                                existingOverlays)
+        HypModuleLogic().visualizationRunHelper(channels, colours, threshMin, threshMax, saveImageName, arraySize,
+                                                existingOverlays, level, nLevels)
         return True
 
+    def channelPyramid(self, channelNode):
+        """
+        Block-mean pyramid levels (1, 2, ...) of a channel, built once and cached until the channel changes
+        """
+        return channelPyramids.pyramid(channelNode.GetID(), channelNode.GetImageData().GetMTime(),
+                                       functools.partial(slicer.util.arrayFromVolume, channelNode))
 
-    def visualizationRunHelper(self, overlay, threshMin, threshMax, saveImageName, arraySize, existingOverlays):
+    def overlayChannelArray(self, channelNode, level=0):
+        """
+        Slice of a channel shown in the overlay, at the given pyramid level
+        """
+        array = channelPyramids.level(channelNode.GetID(), channelNode.GetImageData().GetMTime(),
+                                      functools.partial(slicer.util.arrayFromVolume, channelNode), level)
+        if array.shape[0] != 1:
+            array = array[49:50]
+        return array
 
-        # Set array with thresholded values
-        overlay[overlay < threshMin] = 0
-        threshMaxVal = 255 - threshMax
-        overlay[overlay > threshMaxVal] = 255
+    def overlayNode(self):
+        """
+        The persistent image overlay volume, or None if there is none
+        """
+        for volumeNode in slicer.util.getNodesByClass("vtkMRMLVectorVolumeNode"):
+            if volumeNode.GetAttribute("TITAN.Overlay") == "1":
+                return volumeNode
+        return None
 
-        # Create new volume "Image Overlay"
-        # Set name of overlaid image to be the names of all the channels being overlaid
-        imageSize = [arraySize[2], arraySize[1], 1]
-        voxelType = vtk.VTK_UNSIGNED_CHAR
-        imageOrigin = [0.0, 0.0, 0.0]
-        imageSpacing = [1.0, 1.0, 1.0]
-        imageDirections = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
-        fillVoxelValue = 0
+    def overlayViewLevel(self, fullSize, nLevels, fitToView):
+        """
+        Pyramid level for the current zoom of the red slice view, or for the zoom that fits the whole image
+        """
+        sliceNode = slicer.util.getNode("vtkMRMLSliceNodeRed")
+        dimensions = sliceNode.GetDimensions()
+        if dimensions[0] <= 0 or dimensions[1] <= 0:
+            return 0
+        if fitToView:
+            scale = max(fullSize[-1] / dimensions[0], fullSize[-2] / dimensions[1])
+        else:
+            scale = sliceNode.GetFieldOfView()[0] / dimensions[0]
+        return levelForScale(scale, nLevels)
 
-        # Create an empty image volume, filled with fillVoxelValue
-        imageData = vtk.vtkImageData()
-        imageData.SetDimensions(imageSize)
-        imageData.AllocateScalars(voxelType, 3)
-        imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
+    def overlayLevelStale(self):
+        """
+        True if the red slice view has been zoomed so that the overlay should be shown at another pyramid level
+        """
+        volumeNode = self.overlayNode()
+        if volumeNode is None or volumeNode.GetAttribute("TITAN.OverlayLevel") is None:
+            return False
+        nLevels = int(volumeNode.GetAttribute("TITAN.OverlayLevels"))
+        level = self.overlayViewLevel(None, nLevels, False)
+        return level != int(volumeNode.GetAttribute("TITAN.OverlayLevel"))
+
+    def visualizationRunHelper(self, channels, colours, threshMin, threshMax, saveImageName, arraySize,
+                               existingOverlays, level=0, nLevels=0):
+        """
+        Blend the channels straight into the voxels of the overlay volume. The overlay volume is only created when
+        there is none yet; otherwise it is updated in place, with new image data only if the size or pyramid level
+        changed
+        """
+        volumeNode = self.overlayNode()
+        created = volumeNode is None
 
-        # Create volume node
-        # Needs to be a vector volume in order to show in colour
-        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", saveImageName)
-        volumeNode.SetOrigin(imageOrigin)
-        volumeNode.SetSpacing(imageSpacing)
-        volumeNode.SetIJKToRASDirections(imageDirections)
-        volumeNode.SetAndObserveImageData(imageData)
-        volumeNode.CreateDefaultDisplayNodes()
-        volumeNode.CreateDefaultStorageNode()
+        # Set name of overlaid image to be the names of all the channels being overlaid
+        imageSize = [arraySize[2], arraySize[1], 1]
+        if created:
+            # Create new volume "Image Overlay"
+            imageDirections = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
 
-        voxels = slicer.util.arrayFromVolume(volumeNode)
-        voxels[:] = overlay
+            # Create volume node
+            # Needs to be a vector volume in order to show in colour
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", saveImageName)
+            volumeNode.SetIJKToRASDirections(imageDirections)
+            volumeNode.CreateDefaultDisplayNodes()
+            volumeNode.CreateDefaultStorageNode()
+            volumeNode.SetAttribute("TITAN.Overlay", "1")
+        else:
+            volumeNode.SetName(saveImageName)
 
-        volumeNode.Modified()
+        if volumeNode.GetImageData() is None or volumeNode.GetImageData().GetDimensions() != tuple(imageSize):
+            voxelType = vtk.VTK_UNSIGNED_CHAR
+            fillVoxelValue = 0
 
-        slicer.util.setSliceViewerLayers(background=volumeNode, foreground=None)
+            # Create an empty image volume, filled with fillVoxelValue
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(imageSize)
+            imageData.AllocateScalars(voxelType, 3)
+            imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
+            volumeNode.SetAndObserveImageData(imageData)
+
+        # A voxel of a coarser pyramid level covers factor x factor full resolution pixels
+        factor = 2 ** level
+        volumeNode.SetSpacing([float(factor), float(factor), 1.0])
+        volumeNode.SetOrigin([-(factor - 1) / 2.0, -(factor - 1) / 2.0, 0.0])
+        volumeNode.SetAttribute("TITAN.OverlayLevel", str(level))
+        volumeNode.SetAttribute("TITAN.OverlayLevels", str(nLevels))
+
+        # Write the overlay into the volume's own buffer and tell the views it changed
+        voxels = slicer.util.arrayFromVolume(volumeNode)
+        overlayCompositor.composite(channels, colourMatrix(colours), threshMin, threshMax, out=voxels)
+        slicer.util.arrayFromVolumeModified(volumeNode)
 
         for overlay in existingOverlays:
-            slicer.mrmlScene.RemoveNode(overlay)
+            if overlay is not volumeNode:
+                slicer.mrmlScene.RemoveNode(overlay)
 
         global nodeName
         nodeName = saveImageName
+
+        # Layout, field of view and window/level are only set up for a new overlay, so slider updates stay cheap
+        if not created:
+            red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
+            if red_logic.GetSliceCompositeNode().GetBackgroundVolumeID() != volumeNode.GetID():
+                slicer.util.setSliceViewerLayers(background=volumeNode, foreground=None)
+            return
+
+        slicer.util.setSliceViewerLayers(background=volumeNode, foreground=None)
+
         # Set slice view to display Red window only
         lm = slicer.app.layoutManager()
         lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
@@ -1089,11 +1678,65 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         widget.UpdateWindowLevelFromRectangle(0, [p1, p1], [p2, p2])
         # widget.UpdateWindowLevelFromRectangle(0, [60, 60], [45, 45])
 
+    def thumbnailSources(self, channelNodes):
+        """
+        (identity, voxels) of each channel for the thumbnail cache. A channel read from a file is identified by the
+        file's path, size and modification time, and one opened lazily from a TITAN project by its project array.
+        Channels in the scene give their display pyramid's coarsest level of at least THUMBNAIL_SIZE when it has
+        been built; otherwise a copy of their first slice, which makeThumbnail reduces in the worker. Workers never
+        read the VTK image buffers, which the scene may change while they run
+        """
+        sources = []
+        for node in channelNodes:
+            identity = None
+            projectArray = node.GetAttribute("TITAN.ProjectArray")
+            storageNode = node.GetStorageNode()
+            fileName = storageNode.GetFileName() if storageNode is not None else None
+            if projectArray is not None and titanProject is not None:
+                indexPath = os.path.join(titanProject.path, "index.json")
+                identity = (os.path.abspath(titanProject.path), projectArray, os.stat(indexPath).st_mtime)
+                sources.append((identity, titanProject.array(projectArray)))
+                continue
+            if fileName and os.path.isfile(fileName) and not node.GetModifiedSinceRead():
+                fileStat = os.stat(fileName)
+                identity = (os.path.abspath(fileName), fileStat.st_size, fileStat.st_mtime)
+            loadArray = lambda node=node: np.array(slicer.util.arrayFromVolume(node)[:1])
+            sources.append((identity, channelPyramids.levelAtLeast(node.GetID(), node.GetImageData().GetMTime(),
+                                                                   loadArray, THUMBNAIL_SIZE, build=False)))
+        return sources
+
+    def thumbnailCacheRun(self, runner=None):
+        """
+        Make the thumbnails of every channel of every ROI in the background, so thumbnail overviews are assembled
+        from the cache
+        """
+        channelNodes = []
+        for node in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
+            if node.IsA("vtkMRMLVectorVolumeNode") or node.IsA("vtkMRMLLabelMapVolumeNode"):
+                continue
+            if any(substring in node.GetName() for substring in ["Mask", "Density", "Clustering", "Thumbnail"]):
+                continue
+            if node.GetImageData() is None:
+                continue
+            channelNodes.append(node)
+        if not channelNodes:
+            return None
+
+        job = BackgroundJob("Thumbnails",
+                            functools.partial(self.thumbnailCacheCompute, self.thumbnailSources(channelNodes)))
+        return self.runJob(job, runner, ["PIL"])
+
+    def thumbnailCacheCompute(self, sources, job):
+        """
+        Fill the thumbnail cache. Does not touch the MRML scene
+        """
+        cachedThumbnails(resultStore, sources, load=False, job=job)
+
     def thumbnails(self):
         """
         Generate thumbnails for all loaded images
         """
-        from PIL import Image, ImageOps
+        Image = requireModule("PIL.Image")
 
         existingOverviews = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
 
@@ -1121,19 +1764,10 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
                     # itemId = shNode.GetItemByDataNode(node)
                     channelNodes.append(node)
 
-        size = 400,400
-        thumbnailArrays = []
-        for node in channelNodes:
-            array = slicer.util.arrayFromVolume(node)
-            img = Image.fromarray(array[0])
-            img = img.convert("L")
-            img.thumbnail(size)
-            img = ImageOps.autocontrast(img)
-            # img = ImageOps.equalize(img)
-            thumbArr = np.array(img)
-            thumbnailArrays.append(thumbArr)
-
-        from skimage.util import montage
+        # Thumbnails are usually already in the cache; missing ones are made in parallel
+        thumbnailArrays = cachedThumbnails(resultStore, self.thumbnailSources(channelNodes))
+
+        montage = requireModule("skimage.util").montage
         arrIn = np.stack(thumbnailArrays, axis=0)
         mont = montage(arrIn)
         img = Image.fromarray(mont)
@@ -1194,6 +1828,85 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         # widget.UpdateWindowLevelFromRectangle(0, [800, 800], [500,500])
 
 
+    def cohortMontageRun(self, runner=None, tileSize=256):
+        """
+        Montage of every ROI (rows) by every selected channel (columns), for checking staining across a cohort
+        """
+        rows = [roi for roi in roiNames if roi != "Scene"]
+        nodeRows = []
+        for roi in rows:
+            pos = roiDict[roi]
+            nodeRow = []
+            for channel in selectedChannel:
+                name = channel if pos == 0 else channel + "_" + str(pos)
+                nodeRow.append(slicer.mrmlScene.GetFirstNodeByName(name))
+            nodeRows.append(nodeRow)
+
+        # Channels that are missing in an ROI are left blank
+        sourceNodes = [node for nodeRow in nodeRows for node in nodeRow if node is not None]
+        sources = self.thumbnailSources(sourceNodes)
+        sourceIndex = {}
+        for index, node in enumerate(sourceNodes):
+            sourceIndex[node.GetID()] = index
+        layout = [[sourceIndex[node.GetID()] if node is not None else None for node in nodeRow]
+                  for nodeRow in nodeRows]
+
+        job = BackgroundJob("Cohort montage",
+                            functools.partial(self.cohortMontageCompute, sources, layout, tileSize),
+                            functools.partial(self.cohortMontageDisplay, rows, list(selectedChannel)))
+        return self.runJob(job, runner, ["PIL"])
+
+    def cohortMontageCompute(self, sources, layout, tileSize, job):
+        """
+        Downsample every image to a tile and contrast each channel from cached statistics. Does not touch the MRML
+        scene
+        """
+        statistics = cachedStatistics(resultStore, sources, job=job)
+        tiles = [reduceToTile(array, tileSize) for identity, array in sources]
+
+        # One contrast range per channel, shared by all ROIs so staining can be compared between them
+        nColumns = len(layout[0]) if layout else 0
+        lows = []
+        highs = []
+        for column in range(nColumns):
+            columnStatistics = [statistics[row[column]] for row in layout if row[column] is not None]
+            lows.append(min([stats["p1"] for stats in columnStatistics], default=0.0))
+            highs.append(max([stats["p99"] for stats in columnStatistics], default=0.0))
+
+        tileRows = [[tiles[index] if index is not None else None for index in row] for row in layout]
+        return cohortMontage(tileRows, lows, highs, tileSize)
+
+    def cohortMontageDisplay(self, rows, columns, grid):
+        """
+        Show the cohort montage. Must run on the main thread
+        """
+        existingMontages = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
+        for node in existingMontages:
+            if "Cohort Montage" in node.GetName():
+                slicer.mrmlScene.RemoveNode(node)
+
+        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "Cohort Montage")
+        volumeNode.SetIJKToRASDirections([[-1, 0, 0], [0, -1, 0], [0, 0, 1]])
+        slicer.util.updateVolumeFromArray(volumeNode, grid[np.newaxis])
+        volumeNode.CreateDefaultDisplayNodes()
+        # Rows and columns of the montage, in order
+        volumeNode.SetAttribute("TITAN.MontageRows", ",".join(rows))
+        volumeNode.SetAttribute("TITAN.MontageColumns", ",".join(columns))
+        logging.info("Cohort montage rows: " + ", ".join(rows) + "; columns: " + ", ".join(columns))
+
+        displayNode = volumeNode.GetScalarVolumeDisplayNode()
+        displayNode.AutoWindowLevelOff()
+        displayNode.SetWindowLevelMinMax(0, 255)
+
+        slicer.util.setSliceViewerLayers(background=volumeNode, foreground=None)
+
+        # Set slice view to display Red window only
+        lm = slicer.app.layoutManager()
+        lm.setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutOneUpRedSliceView)
+
+        slicer.util.resetSliceViews()
+        return volumeNode
+
     def saveVisualization(self, fileName):
         viewNodeID = 'vtkMRMLSliceNodeRed'
         import ScreenCapture
@@ -1208,11 +1921,11 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         except:
             subprocess.Popen(["open", defaultPath])
 
-    def crtMasksRun(self, nucleiMin, nucleiMax, cellDimInput):
+    def crtMasksRun(self, nucleiMin, nucleiMax, cellDimInput, runner=None):
         """
-        Perform threshold segmentation on the nucleiImageInput
+        Perform threshold segmentation on the nucleiImageInput.
+        Runs synchronously and returns the number of cells per ROI, or runs on the given JobRunner and returns the job.
         """
-
         positions = []
         channelItems = []
         shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
@@ -1233,6 +1946,127 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
                     itemId = shNode.GetItemByDataNode(node)
                     channelItems.append(itemId)
 
+        # Each ROI's masks are a pipeline stage that depends on its nucleus channel
+        maskStages = []
+        for itemId in channelItems:
+            parent = shNode.GetItemParent(itemId)  # ROI
+            roiName = shNode.GetItemName(parent)
+            dnaName = shNode.GetItemName(itemId)
+            dnaNode = slicer.util.getNode(dnaName)
+            maskKey = ("segmentation", roiName)
+            analysisPipeline.define(maskKey, self.segmentCells, [self.volumeStage(dnaNode)],
+                                    {"nucleiMin": nucleiMin, "nucleiMax": nucleiMax, "cellDimInput": cellDimInput})
+            maskStages.append((roiName, dnaNode.GetID(), maskKey))
+
+        job = BackgroundJob("Mask creation", functools.partial(self.crtMasksCompute, maskStages),
+                            self.crtMasksDisplay)
+        return self.runJob(job, runner, ["SimpleITK"])
+
+    def crtMasksCompute(self, maskStages, job):
+        """
+        Bring the mask stages of all ROIs up to date, segmenting independent ROIs in parallel.
+        Does not touch the MRML scene
+        """
+        results = analysisPipeline.run([maskKey for roiName, dnaNodeId, maskKey in maskStages], job)
+
+        masks = []
+        for roiName, dnaNodeId, maskKey in maskStages:
+            masks.append((roiName, dnaNodeId) + results[maskKey])
+
+        job.setProgress(100, "Creating mask volumes")
+        return masks
+
+    def segmentCells(self, dnaArray, nucleiMin, nucleiMax, cellDimInput):
+        """
+        Segment nucleus, cell and cytoplasm masks from a nucleus channel array, and measure the morphology of the
+        cells (see cellMorphology)
+        """
+        sitk = requireModule("SimpleITK")
+
+        dnaImg = sitk.GetImageFromArray(dnaArray)
+
+        # Rescale image
+        filter = sitk.RescaleIntensityImageFilter()
+        filter.SetOutputMinimum(0)
+        filter.SetOutputMaximum(255)
+        rescaled = filter.Execute(dnaImg)
+        # Adjust contrast
+        filter = sitk.AdaptiveHistogramEqualizationImageFilter()
+        contrasted = filter.Execute(rescaled)
+        # Otsu thresholding
+        filter = sitk.OtsuThresholdImageFilter()
+        t_otsu = filter.Execute(contrasted)
+        # Closing
+        filter = sitk.BinaryMorphologicalClosingImageFilter()
+        binImg = filter.Execute(t_otsu)
+
+        # Connected-component labeling
+        min_img = sitk.RegionalMinima(binImg, backgroundValue=0, foregroundValue=1.0, fullyConnected=False,
+                                      flatIsMinima=True)
+        labeled = sitk.ConnectedComponent(min_img)
+        # Fill holes in image
+        filter = sitk.BinaryFillholeImageFilter()
+        filled = filter.Execute(binImg)
+        # Distance Transform
+        dist = sitk.SignedMaurerDistanceMap(filled != 0, insideIsPositive=False, squaredDistance=False,
+                                            useImageSpacing=False)
+        # Get seeds
+        # if dnaImg.GetSpacing()[0] <= 0.001:
+        #     sigma = dnaImg.GetSpacing()[0]
+        # else:
+        #     sigma = 0.001
+        sigma = 0.0001
+        seeds = sitk.ConnectedComponent(dist < -sigma)
+        seeds = sitk.RelabelComponent(seeds)
+
+        # Invert distance transform to use with watershed
+        distInvert = -1*dist
+        # Watershed using distance transform
+        ws = sitk.MorphologicalWatershedFromMarkers(distInvert, seeds)
+        ws = sitk.Mask(ws, sitk.Cast(labeled, ws.GetPixelID()))
+        ws = sitk.ConnectedComponent(ws)
+
+        # Generate nucleus mask array
+        nucleusMaskArray = sitk.GetArrayFromImage(ws)
+
+        # Remove nuclei too small or large, and border cells, in one pass over the mask
+        stats = sitk.LabelShapeStatisticsImageFilter()
+        stats.Execute(ws)
+
+        removedLabels = [label for label in stats.GetLabels()
+                         if stats.GetNumberOfPixels(label) > nucleiMax or stats.GetNumberOfPixels(label) < nucleiMin]
+        removeCells(nucleusMaskArray, np.concatenate((removedLabels, borderLabels(nucleusMaskArray))))
+
+        # Create simpleitk object of nucleus mask
+        nucleusMaskObject = sitk.GetImageFromArray(nucleusMaskArray)
+
+        # Create cell mask
+        # cellDilate = sitk.BinaryDilate(nucleusMaskObject!=0, cellDimInput)
+        filter = sitk.BinaryDilateImageFilter()
+        filter.SetKernelRadius(cellDimInput)
+        cellDilate = filter.Execute(nucleusMaskObject!=0)
+        distCell = sitk.SignedMaurerDistanceMap(nucleusMaskObject != 0, insideIsPositive=False, squaredDistance=False,
+                                                useImageSpacing=False)
+        wsdCell = sitk.MorphologicalWatershedFromMarkers(distCell, nucleusMaskObject, markWatershedLine=False)
+        cellMask = sitk.Mask(wsdCell, cellDilate)
+        cellMaskArray = sitk.GetArrayFromImage(cellMask)
+
+        # Manually remove border cells
+        removeCells(cellMaskArray, borderLabels(cellMaskArray))
+
+        # Create cytoplasm mask
+        cytoplasmMaskArray = np.copy(cellMaskArray)
+        cytoplasmMaskArray[cytoplasmMaskArray == nucleusMaskArray] = 0
+
+        # Shape of every final cell, measured once here and kept with the masks
+        morphology = cellMorphology(cellMaskArray)
+
+        return nucleusMaskArray, cellMaskArray, cytoplasmMaskArray, morphology
+
+    def crtMasksDisplay(self, masks):
+        """
+        Create the mask volumes computed by crtMasksCompute and display them. Must run on the main thread
+        """
         # Set dictionary for number of cells of each mask
         nCells = {}
 
@@ -1241,17 +2075,11 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         cellMaskVolume = None
         cytoplasmMaskVolume = None
         dnaNode = None
+        dnaArray = None
 
-        # For each nucleus mask, run this loop; parentDict length should be number of ROI's
-        for itemId in channelItems:
-            # Get array of channel
-            parent = shNode.GetItemParent(itemId)  # ROI
-            roiName = shNode.GetItemName(parent)
-            dnaName = shNode.GetItemName(itemId)
-            dnaNode = slicer.util.getNode(dnaName)
-            dnaArray = slicer.util.arrayFromVolume(dnaNode)#[47]
-            # dnaArray = np.expand_dims(dnaArray, axis=0)
-            dnaImg = sitk.GetImageFromArray(dnaArray)
+        for roiName, dnaNodeId, nucleusMaskArray, cellMaskArray, cytoplasmMaskArray, morphology in masks:
+            dnaNode = slicer.mrmlScene.GetNodeByID(dnaNodeId)
+            dnaArray = slicer.util.arrayFromVolume(dnaNode)
 
             # Delete any existing masks
             existingVolumes = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
@@ -1264,86 +2092,6 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
                 elif roiName + " Cytoplasm Mask" in img.GetName():
                     slicer.mrmlScene.RemoveNode(img)
 
-            # Rescale image
-            filter = sitk.RescaleIntensityImageFilter()
-            filter.SetOutputMinimum(0)
-            filter.SetOutputMaximum(255)
-            rescaled = filter.Execute(dnaImg)
-            # Adjust contrast
-            filter = sitk.AdaptiveHistogramEqualizationImageFilter()
-            contrasted = filter.Execute(rescaled)
-            # Otsu thresholding
-            filter = sitk.OtsuThresholdImageFilter()
-            t_otsu = filter.Execute(contrasted)
-            # Closing
-            filter = sitk.BinaryMorphologicalClosingImageFilter()
-            binImg = filter.Execute(t_otsu)
-
-            # Connected-component labeling
-            min_img = sitk.RegionalMinima(binImg, backgroundValue=0, foregroundValue=1.0, fullyConnected=False,
-                                          flatIsMinima=True)
-            labeled = sitk.ConnectedComponent(min_img)
-            # Fill holes in image
-            filter = sitk.BinaryFillholeImageFilter()
-            filled = filter.Execute(binImg)
-            # Distance Transform
-            dist = sitk.SignedMaurerDistanceMap(filled != 0, insideIsPositive=False, squaredDistance=False,
-                                                useImageSpacing=False)
-            # Get seeds
-            # if dnaImg.GetSpacing()[0] <= 0.001:
-            #     sigma = dnaImg.GetSpacing()[0]
-            # else:
-            #     sigma = 0.001
-            sigma = 0.0001
-            seeds = sitk.ConnectedComponent(dist < -sigma)
-            seeds = sitk.RelabelComponent(seeds)
-
-            # Invert distance transform to use with watershed
-            distInvert = -1*dist
-            # Watershed using distance transform
-            ws = sitk.MorphologicalWatershedFromMarkers(distInvert, seeds)
-            ws = sitk.Mask(ws, sitk.Cast(labeled, ws.GetPixelID()))
-            ws = sitk.ConnectedComponent(ws)
-
-            # Generate nucleus mask array
-            nucleusMaskArray = sitk.GetArrayFromImage(ws)
-
-            # Remove nuclei too small or large
-            stats = sitk.LabelShapeStatisticsImageFilter()
-            stats.Execute(ws)
-
-            labelSizes = {}
-
-            for label in stats.GetLabels():
-                labelSizes[label] = stats.GetNumberOfPixels(label)
-
-            for i in labelSizes:
-                if i != 0:
-                    if labelSizes[i] > nucleiMax:
-                        nucleusMaskArray[nucleusMaskArray == i] = 0
-                    elif labelSizes[i] < nucleiMin:
-                        nucleusMaskArray[nucleusMaskArray == i] = 0
-
-            # Manually remove border cells
-            nucMaskShape = nucleusMaskArray.shape
-            for i in range(nucMaskShape[2]):
-                label = nucleusMaskArray[0][0][i]
-                if label != 0:
-                    nucleusMaskArray[nucleusMaskArray == label] = 0
-                label = nucleusMaskArray[0][nucMaskShape[1]-1][i]
-                if label != 0:
-                    nucleusMaskArray[nucleusMaskArray == label] = 0
-            for i in range(nucMaskShape[1]):
-                label = nucleusMaskArray[0][i][0]
-                if label != 0:
-                    nucleusMaskArray[nucleusMaskArray == label] = 0
-                label = nucleusMaskArray[0][i][nucMaskShape[2] - 1]
-                if label != 0:
-                    nucleusMaskArray[nucleusMaskArray == label] = 0
-
-            # Create simpleitk object of nucleus mask
-            nucleusMaskObject = sitk.GetImageFromArray(nucleusMaskArray)
-
             # Create new volume using the nucleus mask array
             name = roiName + " Nucleus Mask"
             nucleusMaskVolume = slicer.modules.volumes.logic().CloneVolume(dnaNode, name)
@@ -1354,34 +2102,6 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
             nucleusDisplayNode = nucleusMaskVolume.GetScalarVolumeDisplayNode()
             nucleusDisplayNode.SetAndObserveColorNodeID(labels.GetID())
 
-            # Create cell mask
-            # cellDilate = sitk.BinaryDilate(nucleusMaskObject!=0, cellDimInput)
-            filter = sitk.BinaryDilateImageFilter()
-            filter.SetKernelRadius(cellDimInput)
-            cellDilate = filter.Execute(nucleusMaskObject!=0)
-            distCell = sitk.SignedMaurerDistanceMap(nucleusMaskObject != 0, insideIsPositive=False, squaredDistance=False,
-                                                    useImageSpacing=False)
-            wsdCell = sitk.MorphologicalWatershedFromMarkers(distCell, nucleusMaskObject, markWatershedLine=False)
-            cellMask = sitk.Mask(wsdCell, cellDilate)
-            cellMaskArray = sitk.GetArrayFromImage(cellMask)
-
-            # Manually remove border cells
-            cellMaskShape = cellMaskArray.shape
-            for i in range(cellMaskShape[2]):
-                label = cellMaskArray[0][0][i]
-                if label != 0:
-                    cellMaskArray[cellMaskArray == label] = 0
-                label = cellMaskArray[0][cellMaskShape[1] - 1][i]
-                if label != 0:
-                    cellMaskArray[cellMaskArray == label] = 0
-            for i in range(cellMaskShape[1]):
-                label = cellMaskArray[0][i][0]
-                if label != 0:
-                    cellMaskArray[cellMaskArray == label] = 0
-                label = cellMaskArray[0][i][cellMaskShape[2] - 1]
-                if label != 0:
-                    cellMaskArray[cellMaskArray == label] = 0
-
             nCells[roiName] = len(np.unique(cellMaskArray)) - 1 # subtracting 1 for the "0" labels
 
             # Create new volume using cell mask array
@@ -1390,16 +2110,14 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
             slicer.util.updateVolumeFromArray(cellMaskVolume, cellMaskArray)
             global globalCellMask
             globalCellMask[roiName] = cellMaskVolume
+            cellMorphologies[roiName] = morphology
+            morphologyVersions[roiName] = morphologyVersions.get(roiName, 0) + 1
 
             # Change colormap of volume
             labels = slicer.util.getFirstNodeByName("Labels")
             cellDisplayNode = cellMaskVolume.GetScalarVolumeDisplayNode()
             cellDisplayNode.SetAndObserveColorNodeID(labels.GetID())
 
-            # Create cytoplasm mask
-            cytoplasmMaskArray = cellMaskArray[:]
-            cytoplasmMaskArray[cytoplasmMaskArray == nucleusMaskArray] = 0
-
             # Create new volume using cytoplasm mask array
             name = roiName + " Cytoplasm Mask"
             cytoplasmMaskVolume = slicer.modules.volumes.logic().CloneVolume(dnaNode, name)
@@ -1689,139 +2407,95 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
                     channelItems.append(itemId)
 
         # channels = list(parentDict.keys())
-        # Get ROI name or Selected Cells mask
+        # Get ROI name or Selected Cells masks
         if checkboxState == False:
             parent = shNode.GetItemParent(channelItems[0])  # ROI
-            roiName = shNode.GetItemName(parent)
+            sources = [shNode.GetItemName(parent)]
         else:
-            roiName = selectedGates[0]
+            sources = list(selectedGates)
+        roiName = sources[0]
 
         # Get array of channel
 
         channelOneName = shNode.GetItemName(channelItems[0])
         channelOneNode = slicer.util.getNode(channelOneName)
-        channelOneArray = slicer.util.arrayFromVolume(channelOneNode)
         channelTwoName = shNode.GetItemName(channelItems[1])
         channelTwoNode = slicer.util.getNode(channelTwoName)
-        channelTwoArray = slicer.util.arrayFromVolume(channelTwoNode)
 
-        if arcsinState == True:
-            channelOneTransform = np.interp(channelOneArray, (channelOneArray.min(), channelOneArray.max()), (0, 1))
-            channelTwoTransform = np.interp(channelTwoArray, (channelTwoArray.min(), channelTwoArray.max()), (0, 1))
-            channelOneTransform = np.sqrt(channelOneTransform)
-            channelTwoTransform = np.sqrt(channelTwoTransform)
-            channelOneArray = np.arcsin(channelOneTransform)
-            channelTwoArray = np.arcsin(channelTwoTransform)
-
-        if logState == True:
-            channelOneArray = np.log(channelOneArray+1)
-            channelTwoArray = np.log(channelTwoArray+1)
+        def channelArray(channelNode):
+            array = slicer.util.arrayFromVolume(channelNode)
+            if arcsinState == True:
+                array = np.arcsin(np.sqrt(np.interp(array, (array.min(), array.max()), (0, 1))))
+            if logState == True:
+                array = np.log(array+1)
+            return array
 
         # Get arrays for cell mask and channels
-        cellMask = globalCellMask[roiName]
+        cellMask = self.cellMaskNode(roiName)
         cellMaskArray = slicer.util.arrayFromVolume(cellMask)
 
-        # Get counts of pixels in each cell
-        cell, counts = np.unique(cellMaskArray, return_counts=True)
-        cellPixelCounts = dict(zip(cell, counts))
-
-        # Create list of mean intensities for all cells for each channel
-        channelOneMeanIntens = []
-        channelTwoMeanIntens = []
-        cellLabels = []
-
-        for cell in range(cellMaskArray.max() + 1):
-            if cell != 0:
-                if cell in cellPixelCounts.keys():
-                    # Channel one
-                    blank, i, j = np.nonzero(cellMaskArray == cell)
-                    cellPixels = channelOneArray[:, i, j]
-                    sumIntens = np.sum(cellPixels)
-                    totalPixels = cellPixels.shape[1]
-                    nonZeroes = np.where(cellPixels != 0)
-                    numNonZeroes = nonZeroes[1].shape[0]
-                    if numNonZeroes == 0:
-                        avg = 0
-                    else:
-                        avg = float(sumIntens) / float(totalPixels)
-                    # print("Sum Intensity: " + str(sumIntens) + " total pixels: " + str(totalPixels) + " avg: " + str(avg))
-                    channelOneMeanIntens.append(avg)
-                    # Channel two
-                    cellPixelsTwo = channelTwoArray[:, i, j]
-                    sumIntensTwo = np.sum(cellPixelsTwo)
-                    totalPixelsTwo = cellPixelsTwo.shape[1]
-                    nonZeroesTwo = np.where(cellPixelsTwo != 0)
-                    numNonZeroesTwo = nonZeroesTwo[1].shape[0]
-                    if numNonZeroesTwo == 0:
-                        avgTwo = 0
-                    else:
-                        avgTwo = float(sumIntensTwo) / float(totalPixelsTwo)
-                    channelTwoMeanIntens.append(avgTwo)
-                    # Cell label
-                    cellLabels.append(cell)
-
-        # Set x and y values
-        x = channelOneMeanIntens
-        y = channelTwoMeanIntens
-        z = cellLabels
-        nPoints = len(x)
+        # Mean intensities of both channels in every cell of each ROI or gate, gates taking the channels of their own
+        # ROI. A gate's cells are taken from its ROI's cached features (transformed intensities are not cached)
+        sourceFeatures = []
+        for source in sources:
+            channelNodes = [channelOneNode, channelTwoNode]
+            if source in gatingTree and gatingTree[source].roi not in selectedRoi:
+                channelNodes = self.sourceChannelNodes(source, [selectedChannel[0], selectedChannel[1]])
+            if source in gatingTree and not arcsinState and not logState:
+                sourceFeatures.append(self.gateFeatures(source, channelNodes))
+            else:
+                sourceMaskArray = slicer.util.arrayFromVolume(self.cellMaskNode(source))
+                sourceFeatures.append(cellMeanIntensities(sourceMaskArray, *[channelArray(node)
+                                                                             for node in channelNodes]))
 
-        # Create table with x and y columns
-        tableName = roiName + ": " + channelOneName + " x " + channelTwoName + " data"
-        tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", tableName)
+        # Create plot chart node
+        plotChartName = roiName + ": " + channelOneName + " x " + channelTwoName
+        plotChartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotChartNode", plotChartName)
 
         # Delete existing tables with same data
-        for table in existingTables:
-            if tableName in table.GetName():
-                slicer.mrmlScene.RemoveNode(table)
-
-        table = tableNode.GetTable()
-
-        arrX = vtk.vtkFloatArray()
-        arrX.SetName(channelOneName)
-        table.AddColumn(arrX)
-
-        arrY = vtk.vtkFloatArray()
-        arrY.SetName(channelTwoName)
-        table.AddColumn(arrY)
+        for chart in existingPlots:
+            if roiName in chart.GetName():
+                slicer.mrmlScene.RemoveNode(chart)
 
-        arrZ = vtk.vtkIntArray()
-        arrZ.SetName("Cell Label")
-        table.AddColumn(arrZ)
+        # One table and plot series per ROI or gate, so selected points can be traced back to their cells
+        colours = categoryColours(len(sources)) if len(sources) > 1 else [(0.46, 0.67, 0.96)]
+        for source, features, colour in zip(sources, sourceFeatures, colours):
+            # Create table with x and y columns
+            tableName = source + ": " + channelOneName + " x " + channelTwoName + " data"
+            tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", tableName)
 
-        # Fill in table with values
-        table.SetNumberOfRows(nPoints)
-        for i in range(nPoints):
-            table.SetValue(i, 0, x[i])
-            table.SetValue(i, 1, y[i])
-            table.SetValue(i, 2, z[i])
+            # Delete existing tables with same data
+            for table in existingTables:
+                if tableName in table.GetName():
+                    slicer.mrmlScene.RemoveNode(table)
 
-        # Create plot series nodes
-        plotSeriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", roiName)
+            # Fill in table with values
+            self.addTableColumns(tableNode.GetTable(), [(channelOneName, features[:, 1], np.float32),
+                                                        (channelTwoName, features[:, 2], np.float32),
+                                                        ("Cell Label", features[:, 0], np.int32)])
 
-        # Delete existing tables with same data
-        for plotSeries in existingSeriesNodes:
-            if roiName in plotSeries.GetName():
-                slicer.mrmlScene.RemoveNode(plotSeries)
+            # Create plot series nodes
+            plotSeriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", source)
+            plotSeriesNode.SetAttribute("TITAN.Source", source)
 
-        plotSeriesNode.SetAndObserveTableNodeID(tableNode.GetID())
-        plotSeriesNode.SetXColumnName(channelOneName)
-        plotSeriesNode.SetYColumnName(channelTwoName)
-        plotSeriesNode.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
-        plotSeriesNode.SetLineStyle(slicer.vtkMRMLPlotSeriesNode.LineStyleNone)
-        plotSeriesNode.SetMarkerStyle(slicer.vtkMRMLPlotSeriesNode.MarkerStyleCircle)
-        plotSeriesNode.SetColor(0.46, 0.67, 0.96)
+            # Delete existing tables with same data
+            for plotSeries in existingSeriesNodes:
+                if source in plotSeries.GetName():
+                    slicer.mrmlScene.RemoveNode(plotSeries)
 
-        # Create plot chart node
-        plotChartName = roiName + ": " + channelOneName + " x " + channelTwoName
-        plotChartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotChartNode", plotChartName)
+            plotSeriesNode.SetAndObserveTableNodeID(tableNode.GetID())
+            plotSeriesNode.SetXColumnName(channelOneName)
+            plotSeriesNode.SetYColumnName(channelTwoName)
+            plotSeriesNode.SetPlotType(slicer.vtkMRMLPlotSeriesNode.PlotTypeScatter)
+            plotSeriesNode.SetLineStyle(slicer.vtkMRMLPlotSeriesNode.LineStyleNone)
+            plotSeriesNode.SetMarkerStyle(slicer.vtkMRMLPlotSeriesNode.MarkerStyleCircle)
+            plotSeriesNode.SetColor(*colour[:3])
+            plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode.GetID())
 
-        # Delete existing tables with same data
-        for chart in existingPlots:
-            if roiName in chart.GetName():
-                slicer.mrmlScene.RemoveNode(chart)
+        # Set x and y values of every plotted cell
+        x = np.concatenate([features[:, 1] for features in sourceFeatures])
+        y = np.concatenate([features[:, 2] for features in sourceFeatures])
 
-        plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode.GetID())
         plotChartNode.SetTitle(roiName + ": " + channelOneName + " x " + channelTwoName)
         plotChartNode.SetXAxisTitle(channelOneName)
         plotChartNode.SetYAxisTitle(channelTwoName)
@@ -1836,23 +2510,10 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         red_logic.GetSliceCompositeNode().SetBackgroundVolumeID(cellMask.GetID())
 
         # Create density plot with matplotlib
-        # Install necessary libraries
-        try:
-            import matplotlib
-        except ModuleNotFoundError:
-            import pip
-            slicer.util.pip_install("matplotlib")
-            import matplotlib
-
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-        from pylab import savefig
-
-        from scipy.stats import gaussian_kde
+        plt = requirePyplot()
 
-        # Calculate point density
-        xy = np.vstack([x,y])
-        densColour = gaussian_kde(xy)(xy)
+        # Calculate point density on a grid and interpolate it back to the points
+        densColour = binnedDensity(x, y)
 
         # Sort points by density
         idx = densColour.argsort()
@@ -1861,55 +2522,18 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         xArr, yArr, densColour = xArr[idx], yArr[idx], densColour[idx]
 
         fig, ax = plt.subplots()
-        ax.scatter(xArr, yArr, c=densColour, s=10)
+        scatterPoints(ax, xArr, yArr, densColour, how="mean")
 
         ax.set_xlabel(channelOneName)
         ax.set_ylabel(channelTwoName)
         ax.set_title(roiName + ": " + channelOneName + " x " + channelTwoName, wrap=True)
 
-        # Display heatmap
-        defaultPath = slicer.app.defaultScenePath
-        pathName = defaultPath + '/' + "densityScatter.jpg"
-        savefig(pathName)
-        densScatterImg = sitk.ReadImage(pathName)
-        densScatterArray = sitk.GetArrayFromImage(densScatterImg)
-        arraySize = densScatterArray.shape
-        plt.close()
-
-        # Create new volume "Density Scatter Plot"
-        imageSize = [arraySize[1], arraySize[0], 1]
-        voxelType = vtk.VTK_UNSIGNED_CHAR
-        imageOrigin = [0.0, 0.0, 0.0]
-        imageSpacing = [1.0, 1.0, 1.0]
-        imageDirections = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
-        fillVoxelValue = 0
-
-        # Create an empty image volume, filled with fillVoxelValue
-        imageData = vtk.vtkImageData()
-        imageData.SetDimensions(imageSize)
-        imageData.AllocateScalars(voxelType, 3)
-        imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
-
-        # Create volume node
-        # Needs to be a vector volume in order to show in colour
+        # Display density scatter plot
         volumeNodeName = roiName + ": " + channelOneName + " x " + channelTwoName + " Density Scatter"
-        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", volumeNodeName)
+        volumeNode = self.showFigure(fig, volumeNodeName)
         for img in existingNodes:
-            if volumeNodeName in img.GetName():
+            if volumeNodeName in img.GetName() and img is not volumeNode:
                 slicer.mrmlScene.RemoveNode(img)
-        volumeNode.SetOrigin(imageOrigin)
-        volumeNode.SetSpacing(imageSpacing)
-        volumeNode.SetIJKToRASDirections(imageDirections)
-        volumeNode.SetAndObserveImageData(imageData)
-        volumeNode.CreateDefaultDisplayNodes()
-        volumeNode.CreateDefaultStorageNode()
-
-        voxels = slicer.util.arrayFromVolume(volumeNode)
-        voxels[:] = densScatterArray
-
-        volumeNode.Modified()
-        volumeNode.GetDisplayNode().AutoWindowLevelOff()
-        volumeNode.GetDisplayNode().SetWindowLevel((arraySize[1] // 8), 127)
 
         # Set yellow slice to display density scatter plot
         yellow_widget = slicer.app.layoutManager().sliceWidget("Yellow")
@@ -1948,29 +2572,66 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         scatterPlotRoi = roiName
 
 
-    def saveTableData(self):
+    def saveTableData(self, runner=None):
+        """
+        Save every table to a .csv file. The tables are written in parallel, straight from their column buffers and a
+        chunk of rows at a time, so saving does not copy them
+        """
         # Get table node
-        print("working")
         tables = slicer.util.getNodesByClass("vtkMRMLTableNode")
-        savedPaths = []
+        if len(tables) == 0:
+            return None
+        files = []
         # Save table to .csv file
         for table in tables:
             fileName = table.GetName() + ".csv"
             defaultPath = slicer.app.defaultScenePath
             pathName = defaultPath + '/' + fileName
-            slicer.util.saveNode(table, pathName)
-            savedPaths.append(pathName)
+            header, columns = self.tableColumns(table)
+            files.append((pathName, header, [columns]))
+
+        job = BackgroundJob("Save tables", functools.partial(writeCsvFiles, files), self.openSavedTables)
+        return self.runJob(job, runner)
+
+    def openSavedTables(self, savedPaths):
         import subprocess
         try:
             subprocess.Popen('explorer savedPaths[0]')
         except:
             subprocess.Popen(["open", savedPaths[0]])
-        print("done")
 
-    def heatmapChannelRun(self):
+    def tableColumns(self, tableNode):
+        """
+        Column names and values of a table node. Numeric columns are views of their VTK arrays, which they keep
+        alive, so they stay valid if the node is removed while being written
+        """
+        from vtk.util import numpy_support
+        table = tableNode.GetTable()
+        header = []
+        columns = []
+        for index in range(table.GetNumberOfColumns()):
+            column = table.GetColumn(index)
+            name = column.GetName() or "Column " + str(index)
+            if isinstance(column, vtk.vtkDataArray):
+                # The view holds a reference to the buffer of the VTK array
+                values = numpy_support.vtk_to_numpy(column)
+            else:
+                values = np.array([column.GetVariantValue(row).ToString()
+                                   for row in range(column.GetNumberOfValues())], dtype=object)
+            if values.ndim > 1:
+                for component in range(values.shape[1]):
+                    header.append(name + " " + str(component))
+                    columns.append(values[:, component])
+            else:
+                header.append(name)
+                columns.append(values)
+        return header, columns
+
+    def heatmapChannelRun(self, statistic="positive fraction"):
 
         """
-        Create heatmap of the selected channel overlaid onto the cell mask
+        Create heatmap of the selected channel overlaid onto the cell mask. Each cell is coloured by statistic, one
+        of CELL_STATISTICS
         """
 
         # Delete any existing heatmap images
@@ -2011,28 +2672,11 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         cellMask = globalCellMask[roiName]
         cellMaskArray = slicer.util.arrayFromVolume(cellMask)
 
-        # Get counts of pixels in each cell
-        cell, counts = np.unique(cellMaskArray, return_counts=True)
-        cellPixelCounts = dict(zip(cell, counts))
+        # Compute the statistic of every cell at once, indexed by cell label
+        cellValues = cellStatisticLut(cellMaskArray, channelArray, statistic).astype(np.float32)
 
-        # Create dictionary of heatmap percentages for all cells
-        hmapPercentages = {0: 0}
-
-        for cell in range(cellMaskArray.max() + 1):
-            if cell != 0:
-                if cell in cellPixelCounts.keys():
-                    blank, i, j = np.nonzero(cellMaskArray == cell)
-                    cellPixels = channelArray[:, i, j]
-                    nActivePixels = np.count_nonzero(cellPixels)
-                    perc = float(nActivePixels) / float(cellPixelCounts[cell])
-                    hmapPercentages[cell] = perc
-
-        # Map percentages to the cell mask array
-        cellMaskHeatmap = np.copy(cellMaskArray)
-        for cell in range(cellMaskHeatmap.max() + 1):
-            if cell != 0:
-                if cell in cellPixelCounts.keys():
-                    cellMaskHeatmap = np.where(cellMaskHeatmap == cell, hmapPercentages[cell], cellMaskHeatmap)
+        # Map the values to the cell mask array in one lookup
+        cellMaskHeatmap = cellValues[cellMaskArray]
 
         # Display image of cellMaskHeatmap
         # Create new volume "Heatmap on Channel"
@@ -2065,20 +2709,21 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
             slicer.mrmlScene.RemoveNode(table)
 
         # Compute histogram values
-        histValues = np.array(list(hmapPercentages.values()))
-        histogram = np.histogram(histValues[histValues!=0], bins=20)
+        histogram = np.histogram(cellValues[cellValues != 0], bins=20)
+        statisticName = {"positive fraction": "Marker:Cell Ratio", "mean": "Mean Intensity",
+                         "median": "Median Intensity"}[statistic]
 
         # Save results to a new table node
         tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", volumeNode.GetName() + ' data')
         slicer.util.updateTableFromArray(tableNode, histogram)
         tableNode.GetTable().GetColumn(0).SetName("Count")
-        tableNode.GetTable().GetColumn(1).SetName("Marker:Cell Ratio")
+        tableNode.GetTable().GetColumn(1).SetName(statisticName)
 
         # Create plot
         plotSeriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode",
                                                             volumeNode.GetName() + " plot")
         plotSeriesNode.SetAndObserveTableNodeID(tableNode.GetID())
-        plotSeriesNode.SetXColumnName("Marker:Cell Ratio")
+        plotSeriesNode.SetXColumnName(statisticName)
         plotSeriesNode.SetYColumnName("Count")
         plotSeriesNode.SetPlotType(plotSeriesNode.PlotTypeScatterBar)
         plotSeriesNode.SetColor(0.46, 0.67, 0.96)
@@ -2087,8 +2732,8 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         plotChartNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotChartNode",
                                                            volumeNode.GetName() + 'histogram')
         plotChartNode.AddAndObservePlotSeriesNodeID(plotSeriesNode.GetID())
-        plotChartNode.SetTitle("Histogram of Marker:Cell Ratio")
-        plotChartNode.SetXAxisTitle("Marker:Cell Ratio")
+        plotChartNode.SetTitle("Histogram of " + statisticName)
+        plotChartNode.SetXAxisTitle(statisticName)
         plotChartNode.SetYAxisTitle("Count")
 
         # Show plot in layout
@@ -2215,19 +2860,66 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         HypModuleLogic().heatmapRunHelper(channelRows, roiColumns, meanIntensities)
         return True
 
-    def heatmapRunHelper(self, channelRows, roiColumns, meanIntensities):
+    def addTableColumns(self, table, columns):
+        """
+        Add columns, a list of (name, values, dtype), to a vtkTable. Each column is converted from one NumPy buffer
+        (float32 gives a vtkFloatArray, int32 a vtkIntArray) without any per-value calls
+        """
+        from vtk.util import numpy_support
 
-        # Install necessary libraries
-        try:
-            import matplotlib
-        except ModuleNotFoundError:
-            import pip
-            slicer.util.pip_install("matplotlib")
-            import matplotlib
+        for columnName, values, dtype in columns:
+            column = numpy_support.numpy_to_vtk(np.ascontiguousarray(np.ravel(values), dtype=dtype), deep=True)
+            column.SetName(columnName)
+            table.AddColumn(column)
+        table.Modified()
 
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-        from pylab import savefig
+    def showFigure(self, figure, volumeNodeName, windowDivisor=8):
+        """
+        Draw a matplotlib figure in memory and show it in the vector volume of that name, which is reused when it
+        already exists. The image data is only replaced when the plot size changed. The figure is closed. Returns
+        the volume node
+        """
+        plt = requirePyplot()
+        rgba = drawFigure(figure)
+        imageSize = [rgba.shape[1], rgba.shape[0], 1]
+
+        volumeNode = None
+        for plotNode in slicer.util.getNodesByClass("vtkMRMLVectorVolumeNode"):
+            if plotNode.GetAttribute("TITAN.Plot") == volumeNodeName:
+                volumeNode = plotNode
+                break
+        if volumeNode is None:
+            imageDirections = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
+
+            # Create volume node
+            # Needs to be a vector volume in order to show in colour
+            volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", volumeNodeName)
+            volumeNode.SetOrigin([0.0, 0.0, 0.0])
+            volumeNode.SetSpacing([1.0, 1.0, 1.0])
+            volumeNode.SetIJKToRASDirections(imageDirections)
+            volumeNode.CreateDefaultDisplayNodes()
+            volumeNode.CreateDefaultStorageNode()
+            volumeNode.SetAttribute("TITAN.Plot", volumeNodeName)
+
+        if volumeNode.GetImageData() is None or volumeNode.GetImageData().GetDimensions() != tuple(imageSize):
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(imageSize)
+            imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 3)
+            volumeNode.SetAndObserveImageData(imageData)
+
+        # Copy the canvas pixels straight into the volume's own buffer
+        voxels = slicer.util.arrayFromVolume(volumeNode)
+        voxels[0] = rgba[..., :3]
+        plt.close(figure)
+        slicer.util.arrayFromVolumeModified(volumeNode)
+
+        volumeNode.GetDisplayNode().AutoWindowLevelOff()
+        volumeNode.GetDisplayNode().SetWindowLevel((imageSize[0] // windowDivisor), 127)
+        return volumeNode
+
+    def heatmapRunHelper(self, channelRows, roiColumns, meanIntensities):
+
+        plt = requirePyplot()
 
         # Create heatmap
         # plt.rcParams.update({'font.size': 6})
@@ -2257,43 +2949,7 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         cbar.ax.set_ylabel("Mean Intensity", rotation = -90, va = "bottom")
 
         # Display heatmap
-        defaultPath = slicer.app.defaultScenePath
-        pathName = defaultPath + '/' + "heatmap.jpg"
-        savefig(pathName)
-        heatmapImg = sitk.ReadImage(pathName)
-        heatmapArray = sitk.GetArrayFromImage(heatmapImg)
-        arraySize = heatmapArray.shape
-        plt.close()
-        # Create new volume "Heatmap"
-        imageSize = [arraySize[1], arraySize[0], 1]
-        voxelType = vtk.VTK_UNSIGNED_CHAR
-        imageOrigin = [0.0, 0.0, 0.0]
-        imageSpacing = [1.0, 1.0, 1.0]
-        imageDirections = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
-        fillVoxelValue = 0
-
-        # Create an empty image volume, filled with fillVoxelValue
-        imageData = vtk.vtkImageData()
-        imageData.SetDimensions(imageSize)
-        imageData.AllocateScalars(voxelType, 3)
-        imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
-
-        # Create volume node
-        # Needs to be a vector volume in order to show in colour
-        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", "Heatmap")
-        volumeNode.SetOrigin(imageOrigin)
-        volumeNode.SetSpacing(imageSpacing)
-        volumeNode.SetIJKToRASDirections(imageDirections)
-        volumeNode.SetAndObserveImageData(imageData)
-        volumeNode.CreateDefaultDisplayNodes()
-        volumeNode.CreateDefaultStorageNode()
-
-        voxels = slicer.util.arrayFromVolume(volumeNode)
-        voxels[:] = heatmapArray
-
-        volumeNode.Modified()
-        volumeNode.GetDisplayNode().AutoWindowLevelOff()
-        volumeNode.GetDisplayNode().SetWindowLevel((arraySize[1]//8), 127)
+        volumeNode = self.showFigure(fig, "Heatmap")
 
         slicer.util.setSliceViewerLayers(background=volumeNode, foreground=None)
 
@@ -2311,113 +2967,55 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         # imgWidget.show()
         # return True
 
-    def rawDataRun(self):
+    def rawDataRun(self, runner=None, fileFormat="CSV"):
         """
-        Generate raw data tables for all ROI and channels
+        Generate raw data tables for all ROI and channels, saved in fileFormat (one of CELL_TABLE_FORMATS)
         """
+        # Every ROI is needed, so page in any volumes of an opened project that have not been read yet
+        self.pageInVolumes()
+
         existingTables = slicer.util.getNodesByClass("vtkMRMLTableNode")
 
         for table in existingTables:
             slicer.mrmlScene.RemoveNode(table)
 
-        # Get list of all channels
-        allChannels = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
-        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-
+        # The raw data tables are the ROIs of the cohort cell table
+        tableKey = self.cellTableStage([roi for roi in roiNames if roi != "Scene"])
 
-        #
-        # df = pd.DataFrame(columns=["ROI", "Cell Label"])
-        #
-        # for channel in channelNames:
-        #     df[channel] = ""
+        job = BackgroundJob("Raw data table",
+                            functools.partial(self.rawDataCompute, tableKey, slicer.app.defaultScenePath, fileFormat),
+                            self.rawDataDisplay)
+        formatModules = {"Parquet": ["pyarrow"], "Feather": ["pyarrow"], "HDF5": ["h5py"]}
+        return self.runJob(job, runner, formatModules.get(fileFormat, []))
 
-        # Create list of mean intensities for all cells for each channel
-        # Create empty matrix of mean intensities
-        roiIntensitiesDict = {}
-        roiCellMaskArrays = {}
-        roiPixelCounts = {}
-        for roi in roiNames:
-            if roi == "Scene":
-                continue
-            # Get cell mask array
-            cellMask = globalCellMask[roi]
-            cellMaskArray = slicer.util.arrayFromVolume(cellMask)
-            roiCellMaskArrays[roi] = cellMaskArray
-            # Get counts of pixels in each cell
-            cell, counts = np.unique(cellMaskArray, return_counts=True)
-            cellPixelCounts = dict(zip(cell, counts))
-            roiPixelCounts[roi] = cellPixelCounts
-            roiIntensitiesDict[roi] = np.full((len(cell) - 1, len(channelNames) + 1), 0.00)
+    def rawDataCompute(self, tableKey, defaultPath, fileFormat, job):
+        """
+        Compute the mean intensity of every channel in every cell and write one .csv file per ROI, or one Parquet,
+        Feather or HDF5 file for all ROIs. Does not touch the MRML scene
+        """
+        cells = analysisPipeline.run([tableKey], job)[tableKey]
+        channelNameList = cells.columnNames
 
+        job.checkCancelled()
+        job.setProgress(0, "Saving tables")
 
+        # Binary formats hold the whole cohort in one file, written ROI by ROI
+        if fileFormat != "CSV":
+            pathName = defaultPath + "/rawData" + CELL_TABLE_FORMATS[fileFormat]
+            writeCellTable(cells, pathName, fileFormat, job)
+            return defaultPath
 
-        for channelNode in allChannels:
-            itemId = shNode.GetItemByDataNode(channelNode)  # Channel
-            parent = shNode.GetItemParent(itemId)  # ROI
-            roiName = shNode.GetItemName(parent)
-            channelName = shNode.GetItemName(itemId)
-            if ".ome" not in channelName:
-                continue
-            if re.findall(r"_[0-9]\b", channelName) != []:
-                channelName = channelName[:-2]
-            if roiName == "Scene":
-                roiName = "ROI"
-            # Get column index for mean intensities array
-            columnPos = channelNames.index(channelName) + 1
-            # Get arrays for cell mask and channels
-            cellMaskArray = roiCellMaskArrays[roiName]
-            # Get counts of pixels in each cell
-            cellPixelCounts = roiPixelCounts[roiName]
-            # Get intensities for each cell
-            for cell in range(cellMaskArray.max() + 1):
-                if cell != 0:
-                    if cell in cellPixelCounts.keys():
-                        # Channel one
-                        blank, i, j = np.nonzero(cellMaskArray == cell)
-                        # Get array of channel
-                        channelArray = slicer.util.arrayFromVolume(channelNode)
-                        # Get mean intensity of channel
-                        cellPixels = channelArray[:, i, j]
-                        sumIntens = np.sum(cellPixels)
-                        totalPixels = cellPixels.shape[1]
-                        nonZeroes = np.where(cellPixels != 0)
-                        numNonZeroes = nonZeroes[1].shape[0]
-                        if numNonZeroes == 0:
-                            avg = 0
-                        else:
-                            avg = float(sumIntens) / float(totalPixels)
-                        # Update meanIntensities matrix with this value
-                        rowPos = list(cellPixelCounts.keys()).index(cell) - 1
-                        roiIntensitiesDict[roiName][rowPos, columnPos] = avg
-                        roiIntensitiesDict[roiName][rowPos, 0] = cell
-
-        # Create dataframe of all arrays
-        try:
-            import pandas as pd
-        except ModuleNotFoundError:
-            import pip
-            slicer.util.pip_install("pandas")
-            import pandas as pd
-
-        pathName = ""
-
-        for roi in roiIntensitiesDict:
-            arr = roiIntensitiesDict[roi]
-            # Convert array to dataframe
-            df = pd.DataFrame(data=arr)
-            df.insert(0, "ROI", roi)
-            # Rename the columns
-            df = df.rename(columns = {0: "Cell Label"})
-            for i in range(len(channelNames)):
-                df = df.rename(columns = {i + 1: channelNames[i]})
-            # # Delete any columns with all zeros (these are DNA channels that we don't calculate for)
-            # df = df.loc[:, (df != 0).any(axis=0)]
-            # Save dataframe to .csv file
+        # One .csv file per ROI, streamed from the cell table's columns, several ROIs at a time
+        files = []
+        for roi in cells.rois:
             filename = "rawData_" + roi + ".csv"
-            defaultPath = slicer.app.defaultScenePath
             pathName = defaultPath + '/' + filename
-            df.to_csv(pathName, index=False)
+            files.append((pathName, ["ROI", "Cell Label"] + channelNameList, cellTableBlocks(cells, [roi])))
+        writeCsvFiles(files, job=job)
+
+        return defaultPath
 
+    def rawDataDisplay(self, defaultPath):
         # Open file location in explorer
         import subprocess
         try:
@@ -2426,66 +3024,16 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         except:
             subprocess.Popen(["open", defaultPath])
 
-
-
-    def tsnePCARun(self, plotType, checkState):
+    def tsnePCARun(self, plotType, checkState, runner=None):
         """
         Create t-sne plot of selected channels
         """
 
-        # Delete any existing plots
-        existingPlots = slicer.util.getNodesByClass("vtkMRMLPlotChartNode")
-        existingSeriesNodes = slicer.util.getNodesByClass("vtkMRMLPlotSeriesNode")
-        existingTables = slicer.util.getNodesByClass("vtkMRMLTableNode")
-
-        for table in existingTables:
-            slicer.mrmlScene.RemoveNode(table)
+        # The cells of each selected ROI, or of each selected gate
+        sources = list(selectedGates) if checkState == True else list(selectedRoi)
+        cellMask = self.cellMaskNode(sources[0])
 
-        for plot in existingPlots:
-            slicer.mrmlScene.RemoveNode(plot)
-
-        for series in existingSeriesNodes:
-            slicer.mrmlScene.RemoveNode(series)
-
-        # Get list of all channels
-        allChannels = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
-
-        # Create dictionary of each channel with its respective ROI
-        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-
-        # Create list of mean intensities for all cells for each channel
-        # Create empty matrix of mean intensities
-        roiIntensitiesDict = {}
-        roiCellMaskArrays = {}
-        roiPixelCounts = {}
-        if checkState == True:
-            roi = selectedGates[0]
-            # Get cell mask array
-            cellMask = globalCellMask[roi]
-            cellMaskArray = slicer.util.arrayFromVolume(cellMask)
-            roiCellMaskArrays[roi] = cellMaskArray
-            # Get counts of pixels in each cell
-            cell, counts = np.unique(cellMaskArray, return_counts=True)
-            cellPixelCounts = dict(zip(cell, counts))
-            roiPixelCounts[roi] = cellPixelCounts
-            roiIntensitiesDict[roi] = np.full((len(cell) - 1, len(selectedChannel) + 1), 0.00)
-        else:
-            for roi in selectedRoi:
-                # if roi == "Scene":
-                #     continue
-                # Get cell mask array
-                cellMask = globalCellMask[roi]
-                cellMaskArray = slicer.util.arrayFromVolume(cellMask)
-                roiCellMaskArrays[roi] = cellMaskArray
-                # Get counts of pixels in each cell
-                cell, counts = np.unique(cellMaskArray, return_counts=True)
-                cellPixelCounts = dict(zip(cell, counts))
-                roiPixelCounts[roi] = cellPixelCounts
-                roiIntensitiesDict[roi] = np.full((len(cell) - 1, len(selectedChannel)+1), 0.00)
-
-        # cellLabels = []
         displayList = []
-        channelItems = []
         positions = []
 
         for roi in selectedRoi:
@@ -2495,110 +3043,121 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
             for pos in positions:
                 if pos == 0:
                     node = slicer.util.getNode(channel)
-                    itemId = shNode.GetItemByDataNode(node)
-                    channelItems.append(itemId)
                     if len(displayList) <= 2:
                         displayList.append(node)
                 else:
                     suffix = "_" + str(pos)
                     name = channel + suffix
                     node = slicer.util.getNode(name)
-                    itemId = shNode.GetItemByDataNode(node)
-                    channelItems.append(itemId)
                     if len(displayList) <= 2:
                         displayList.append(node)
 
-        for channel in channelItems:
-            channelName = shNode.GetItemName(channel)
-            if checkState == True:
-                roiName = selectedGates[0]
-            else:
-                roiName = shNode.GetItemName(shNode.GetItemParent(channel))
-            # Get column index for mean intensities array
-            if re.findall(r"_[0-9]\b", channelName) != []:
-                channelName = channelName[:-2]
-            columnPos = channelNames.index(channelName)
-            # Get arrays for cell mask and channels
-            cellMaskArray = roiCellMaskArrays[roiName]
-            # Get counts of pixels in each cell
-            cellPixelCounts = roiPixelCounts[roiName]
-            # Get intensities for each cell
-            for cell in range(cellMaskArray.max() + 1):
-                if cell != 0:
-                    if cell in cellPixelCounts.keys():
-                        # Channel one
-                        blank, i, j = np.nonzero(cellMaskArray == cell)
-                        # Get array of channel
-                        channelNode = shNode.GetItemDataNode(channel)
-                        channelArray = slicer.util.arrayFromVolume(channelNode)
-                        # Get mean intensity of channel
-                        cellPixels = channelArray[:, i, j]
-                        sumIntens = np.sum(cellPixels)
-                        totalPixels = cellPixels.shape[1]
-                        nonZeroes = np.where(cellPixels != 0)
-                        numNonZeroes = nonZeroes[1].shape[0]
-                        if numNonZeroes == 0:
-                            avg = 0
-                        else:
-                            avg = float(sumIntens) / float(totalPixels)
-                        # Update meanIntensities matrix with this value
-                        rowPos = list(cellPixelCounts.keys()).index(cell) - 1
-                        roiIntensitiesDict[roiName][rowPos, columnPos] = avg
-                        roiIntensitiesDict[roiName][rowPos, 0] = cell
-
-        # Perform 99th-percentile normalization on each ROI array
-        for roiName, array in roiIntensitiesDict.items():
-            cellLabels = array[:,0]
-            newArray = array[:,1:]
-            percentile = np.percentile(newArray, 99)
-            normArray = array/percentile
-            finalArray = np.insert(normArray, 0, values=cellLabels, axis=1)
-            roiIntensitiesDict[roiName] = finalArray
-
-
-        # Append the arrays for each ROI together
-        concatArray = list(roiIntensitiesDict.values())[0]
-        count = 0
+        # The cells are read from the cohort cell table of their ROIs; a gate's cells are picked out by its bitset,
+        # a source stage that only changes when the gate does
+        groups = []
+        gateKeys = []
+        for source in sources:
+            gate = gatingTree.get(source)
+            groups.append((source, gate.roi if gate is not None else source, gate is not None))
+            if gate is not None:
+                gateKey = ("gateCells", source)
+                analysisPipeline.setSource(gateKey, gate.bits.tobytes(), gate.flags)
+                gateKeys.append(gateKey)
+        tableKey = self.cellTableStage(list(dict.fromkeys(roi for name, roi, gated in groups)))
+        embeddingKey = ("embedding", plotType, tableKey) + tuple(gateKeys)
+        analysisPipeline.define(embeddingKey, self.embedCells, [tableKey] + gateKeys,
+                                {"plotType": plotType, "groups": groups, "columnNames": list(selectedChannel)})
+
+        # Everything the display step needs from the current selection
+        plotInfo = {
+            "checkState": checkState,
+            "roiName": selectedGates[0] if checkState == True else selectedRoi[0],
+            "cellMaskId": cellMask.GetID(),
+            "displayIds": [node.GetID() for node in displayList],
+        }
+
+        job = BackgroundJob(plotType.upper(),
+                            functools.partial(self.tsnePCACompute, embeddingKey),
+                            functools.partial(self.tsnePCADisplay, plotInfo))
+        return self.runJob(job, runner, ["sklearn", "SimpleITK"])
+
+    def tsnePCACompute(self, embeddingKey, job):
+        """
+        Bring the feature and embedding stages up to date. Does not touch the MRML scene
+        """
+        return analysisPipeline.run([embeddingKey], job)[embeddingKey]
 
-        for roi in roiIntensitiesDict:
-            if count == 0:
-                count += 1
-            else:
-                array = roiIntensitiesDict[roi]
-                concatArray = np.append(concatArray, array, axis=0)
+    def embedCells(self, cohortCells, *gateFlags, plotType, groups, columnNames):
+        """
+        Normalize each group's per-cell mean intensities by the 99th percentile of each channel and embed all cells
+        with t-SNE or PCA. groups are (name, ROI, gated): the cells of a ROI in the cohort cell table, or only those
+        flagged in the next of gateFlags (indexed by cell label). Groups without cells are left out
+        """
+        # Copy the columns of each group into one cell table, so normalizing leaves the cohort table untouched
+        cells = CellTable(columnNames)
+        gateFlags = iter(gateFlags)
+        for name, roi, gated in groups:
+            features = cohortCells.features(roi, columnNames)
+            if gated:
+                flags = next(gateFlags)
+                labels = features[:, 0].astype(np.int64)
+                inside = labels < len(flags)
+                inside[inside] = flags[labels[inside]]
+                features = features[inside]
+            if len(features):
+                cells.appendFeatures(name, features, columnNames)
+        if len(cells) == 0:
+            raise ValueError("The selected ROIs and masks have no cells")
+
+        # Perform 99th-percentile normalization of each channel of each ROI in place
+        for roi in cells.rois:
+            percentileNormalize(cells.matrix(roi=roi))
 
         # Create tsne array
-        try:
-            import sklearn
-        except ModuleNotFoundError:
-            import pip
-            slicer.util.pip_install("sklearn")
-
         if plotType == "tsne":
-            from sklearn.manifold import TSNE
+            TSNE = requireModule("sklearn.manifold").TSNE
 
-            plotValues = TSNE().fit_transform(concatArray[:,1:])
+            plotValues = TSNE().fit_transform(cells.matrix())
             name = "t-SNE"
 
         else:
-            from sklearn.decomposition import PCA
+            PCA = requireModule("sklearn.decomposition").PCA
 
-            plotValues = PCA(n_components=2).fit_transform(concatArray[:,1:])
+            plotValues = PCA(n_components=2).fit_transform(cells.matrix())
             name = "PCA"
 
-        # If only one ROI in t-sne, create plot that allows gating
-        if len(roiCellMaskArrays) == 1:
-            if checkState == True:
-                roiName = selectedGates[0] #list(roiCellMaskArrays.keys())[0]
-            else:
-                roiName = selectedRoi[0]
-            x = []
-            y = []
-            z = concatArray[:,0]
+        return {"name": name, "plotValues": plotValues, "cells": cells}
+
+    def tsnePCADisplay(self, plotInfo, computed):
+        """
+        Show the embedding computed by tsnePCACompute as a plot. Must run on the main thread
+        """
+        name = computed["name"]
+        plotValues = computed["plotValues"]
+        cells = computed["cells"]
+        cellMask = slicer.mrmlScene.GetNodeByID(plotInfo["cellMaskId"])
+        displayList = [slicer.mrmlScene.GetNodeByID(nodeId) for nodeId in plotInfo["displayIds"]]
+
+        # Delete any existing plots
+        existingPlots = slicer.util.getNodesByClass("vtkMRMLPlotChartNode")
+        existingSeriesNodes = slicer.util.getNodesByClass("vtkMRMLPlotSeriesNode")
+        existingTables = slicer.util.getNodesByClass("vtkMRMLTableNode")
 
-            for i in plotValues:
-                x.append(i[0])
-                y.append(i[1])
+        for table in existingTables:
+            slicer.mrmlScene.RemoveNode(table)
+
+        for plot in existingPlots:
+            slicer.mrmlScene.RemoveNode(plot)
+
+        for series in existingSeriesNodes:
+            slicer.mrmlScene.RemoveNode(series)
+
+        # If only one ROI in t-sne, create plot that allows gating
+        if len(cells.rois) == 1:
+            roiName = plotInfo["roiName"]
+            x = plotValues[:, 0]
+            y = plotValues[:, 1]
+            z = cells.labels()
 
             # Create table with x and y columns
             tableName = roiName + ": "  + name + " data"
@@ -2609,33 +3168,15 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
                 if tableName in table.GetName():
                     slicer.mrmlScene.RemoveNode(table)
 
-            table = tableNode.GetTable()
-
-            arrX = vtk.vtkFloatArray()
-            arrX.SetName(name + " 1")
-            table.AddColumn(arrX)
-
-            arrY = vtk.vtkFloatArray()
-            arrY.SetName(name + " 2")
-            table.AddColumn(arrY)
-
-            arrZ = vtk.vtkFloatArray()
-            arrZ.SetName("Cell Label")
-            table.AddColumn(arrZ)
-
             # Fill in table with values
-            table.SetNumberOfRows(len(plotValues))
-            for i in range(len(plotValues)):
-                arrX.InsertNextValue(x[i])
-                arrY.InsertNextValue(y[i])
-                arrZ.InsertNextValue(z[i])
-
-            for i in range(len(plotValues)):
-                table.RemoveRow(0)
+            self.addTableColumns(tableNode.GetTable(), [(name + " 1", x, np.float32),
+                                                        (name + " 2", y, np.float32),
+                                                        ("Cell Label", z, np.float32)])
 
             # Create plot series nodes
             seriesName = roiName + ": " + name + " Points"
             plotSeriesNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLPlotSeriesNode", seriesName)
+            plotSeriesNode.SetAttribute("TITAN.Source", roiName)
 
             # Delete existing plot series with same data
             for series in existingSeriesNodes:
@@ -2702,91 +3243,33 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
         # If multiple ROI, create matplotlib plot and pandas excel table
         else:
             # Create dataframe of all arrays
-            try:
-                import pandas as pd
-            except ModuleNotFoundError:
-                import pip
-                slicer.util.pip_install("pandas")
-                import pandas as pd
-
-            roiNamesList = []
-            roiColourLabels = {}
-            count = 0
+            pd = requireModule("pandas")
 
-            for roi in roiIntensitiesDict:
-                # Map a colour to each ROI
-                roiColourLabels[roi] = count
-                count += 1
-                array = roiIntensitiesDict[roi]
-                for i in range(len(array)):
-                    roiNamesList.append(roi)
+            # Each ROI has a colour, indexed by its position in the cell table
+            roiCategories = cells.roiIndices()
 
             df = pd.DataFrame(data = plotValues, columns = ["Dim 1", "Dim 2"])
-            df.insert(0, "Cell Label", concatArray[:, 0])
-            df.insert(0, "ROI", roiNamesList)
+            df.insert(0, "Cell Label", cells.labels().astype(np.float64))
+            df.insert(0, "ROI", np.array(cells.rois, dtype=object)[roiCategories])
 
             # Create matplot scatter plot
-            try:
-                import matplotlib
-            except ModuleNotFoundError:
-                import pip
-                slicer.util.pip_install("matplotlib")
-                import matplotlib
-
-            matplotlib.use("Agg")
-            import matplotlib.pyplot as plt
-            from pylab import savefig
+            plt = requirePyplot()
 
             fig, ax = plt.subplots(figsize = (15,10))
             axis_font = {'fontname': 'Arial', 'size': '18'}
 
-            scatter = ax.scatter(df["Dim 1"], df["Dim 2"], c=df["ROI"].apply(lambda x: roiColourLabels[x]), s=10)
+            # Large pooled cohorts are drawn as one image of per-pixel ROI colours
+            scatterPoints(ax, df["Dim 1"].to_numpy(), df["Dim 2"].to_numpy(), roiCategories, how="category")
 
             ax.set_xlabel("Dimension 1", **axis_font)
             ax.set_ylabel("Dimension 2", **axis_font)
             ax.set_title(name, **axis_font)
 
-            legend1 = ax.legend(handles = scatter.legend_elements()[0], loc = "best", title = "ROI", labels = selectedRoi, fontsize = 14)
+            handles = [ax.scatter([], [], color=colour, s=10) for colour in categoryColours(len(cells.rois))]
+            legend1 = ax.legend(handles = handles, loc = "best", title = "ROI", labels = cells.rois, fontsize = 14)
 
-            # Display cluster plot
-            defaultPath = slicer.app.defaultScenePath
-            pathName = defaultPath + '/' + "dimReduction.jpg"
-            savefig(pathName)
-            dimRedImg = sitk.ReadImage(pathName)
-            dimRedArray = sitk.GetArrayFromImage(dimRedImg)
-            arraySize = dimRedArray.shape
-            plt.close()
-
-            # Create new volume "K-Means Clustering"
-            imageSize = [arraySize[1], arraySize[0], 1]
-            voxelType = vtk.VTK_UNSIGNED_CHAR
-            imageOrigin = [0.0, 0.0, 0.0]
-            imageSpacing = [1.0, 1.0, 1.0]
-            imageDirections = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
-            fillVoxelValue = 0
-
-            # Create an empty image volume, filled with fillVoxelValue
-            imageData = vtk.vtkImageData()
-            imageData.SetDimensions(imageSize)
-            imageData.AllocateScalars(voxelType, 3)
-            imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
-
-            # Create volume node
-            # Needs to be a vector volume in order to show in colour
-            volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", "Dimension Reduction Plot")
-            volumeNode.SetOrigin(imageOrigin)
-            volumeNode.SetSpacing(imageSpacing)
-            volumeNode.SetIJKToRASDirections(imageDirections)
-            volumeNode.SetAndObserveImageData(imageData)
-            volumeNode.CreateDefaultDisplayNodes()
-            volumeNode.CreateDefaultStorageNode()
-
-            voxels = slicer.util.arrayFromVolume(volumeNode)
-            voxels[:] = dimRedArray
-
-            volumeNode.Modified()
-            volumeNode.GetDisplayNode().AutoWindowLevelOff()
-            volumeNode.GetDisplayNode().SetWindowLevel((arraySize[1] // 6), 127)
+            # Display dimension reduction plot
+            volumeNode = self.showFigure(fig, "Dimension Reduction Plot", windowDivisor=6)
 
             # Show plot in layout
             slicer.app.layoutManager().setLayout(
@@ -2809,49 +3292,69 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
                 subprocess.Popen(["open", defaultPath])
 
             global tsnePcaData
+            global tsnePcaVersion
             tsnePcaData = df
+            tsnePcaVersion += 1
 
         slicer.util.resetSliceViews()
 
 
 
-    def clusterRun(self, nClusters, clusterType):
+    def clusterRun(self, nClusters, clusterType, runner=None):
         """
         Create k-means clustering based on an already created t-sne or pca plot.
         """
 
-        # Get columns from t-sne/pca table
+        # Get columns from t-sne/pca table; the clusters are only recomputed when the table or parameters change
         if slicer.util.getNodesByClass("vtkMRMLTableNode") != []:
             tableNode = slicer.util.getNodesByClass("vtkMRMLTableNode")[-1]
-            nRows = tableNode.GetNumberOfRows()
-            kmeansArray = np.full((nRows, 2), 0.00)
-            dim1 = []
-            dim2 = []
-            cellLabels = []
-            for row in range(nRows):
-                dim1Val = float(tableNode.GetCellText(row, 0))
-                dim2Val = float(tableNode.GetCellText(row, 1))
-                kmeansArray[row,0] = dim1Val
-                kmeansArray[row, 1] = dim2Val
-                dim1.append(dim1Val)
-                dim2.append(dim2Val)
-                cellLabels.append(int(tableNode.GetCellText(row, 2)))
+            sourceKey = ("embeddingTable", tableNode.GetID())
+            analysisPipeline.setSource(sourceKey, tableNode.GetMTime(),
+                                       functools.partial(self.embeddingFromTable, tableNode))
 
         else:
-            kmeansArray = tsnePcaData.iloc[:,2:]
-            dim1 = tsnePcaData["Dim 1"]
-            dim2 = tsnePcaData["Dim 2"]
-            cellLabels = tsnePcaData["Cell Label"]
+            sourceKey = ("embeddingTable", "tsnePcaData")
+            analysisPipeline.setSource(sourceKey, tsnePcaVersion,
+                                       lambda: (tsnePcaData.iloc[:,2:], tsnePcaData["Dim 1"], tsnePcaData["Dim 2"],
+                                                tsnePcaData["Cell Label"]))
+
+        kmeansArray, dim1, dim2, labels = analysisPipeline.result(sourceKey)
+        clusterKey = ("clusters", sourceKey)
+        analysisPipeline.define(clusterKey, self.clusterCells, [sourceKey],
+                                {"nClusters": nClusters, "clusterType": clusterType})
+
+        job = BackgroundJob("Clustering",
+                            functools.partial(self.clusterCompute, clusterKey),
+                            functools.partial(self.clusterDisplay, dim1, dim2, labels))
+        return self.runJob(job, runner, ["sklearn"])
+
+    def embeddingFromTable(self, tableNode):
+        """
+        Read the embedding coordinates and cell labels from a t-sne/pca table, a whole column at a time
+        """
+        header, columns = self.tableColumns(tableNode)
+        dim1 = np.asarray(columns[0], dtype=np.float64)
+        dim2 = np.asarray(columns[1], dtype=np.float64)
+        labels = np.rint(np.asarray(columns[2], dtype=np.float64)).astype(np.int64)
+        return np.column_stack([dim1, dim2]), dim1, dim2, labels
 
-        # Compute k-means
-        try:
-            import sklearn
-        except ModuleNotFoundError:
-            import pip
-            slicer.util.pip_install("sklearn")
+    def clusterCompute(self, clusterKey, job):
+        """
+        Bring the cluster stage up to date. Does not touch the MRML scene
+        """
+        job.setProgress(0, "Clustering")
+        return analysisPipeline.run([clusterKey], job)[clusterKey]
+
+    def clusterCells(self, embedding, nClusters, clusterType):
+        """
+        Cluster the embedding coordinates with k-means or hierarchical clustering
+        """
+        kmeansArray = embedding[0]
 
-        from sklearn.cluster import KMeans
-        from sklearn.cluster import AgglomerativeClustering
+        # Compute k-means
+        sklearnCluster = requireModule("sklearn.cluster")
+        KMeans = sklearnCluster.KMeans
+        AgglomerativeClustering = sklearnCluster.AgglomerativeClustering
 
         if clusterType == "kmeans":
             clusLabels = KMeans(n_clusters = nClusters, random_state = 0).fit_predict(kmeansArray)
@@ -2860,97 +3363,34 @@ class HypModuleLogic(ScriptedLoadableModuleLogic):
             clusLabels = AgglomerativeClustering(n_clusters=nClusters).fit_predict(kmeansArray)
             name = "Hierarchical Clustering"
 
+        return clusLabels, name
+
+    def clusterDisplay(self, dim1, dim2, labels, computed):
+        """
+        Show the clusters computed by clusterCompute. Must run on the main thread
+        """
+        clusLabels, name = computed
 
         # Create table with x and y columns
         kMeansTableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode", name + " Data")
-        table = kMeansTableNode.GetTable()
-
-        arrX = vtk.vtkFloatArray()
-        arrX.SetName("Dim 1")
-        table.AddColumn(arrX)
-
-        arrY = vtk.vtkFloatArray()
-        arrY.SetName("Dim 2")
-        table.AddColumn(arrY)
-
-        arrZ = vtk.vtkFloatArray()
-        arrZ.SetName("Cell Label")
-        table.AddColumn(arrZ)
-
-        arrK = vtk.vtkFloatArray()
-        arrK.SetName("Cluster Label")
-        table.AddColumn(arrK)
-
 
         # Fill in table with values
-        table.SetNumberOfRows(len(dim1))
-        for i in range(len(dim1)):
-            arrX.InsertNextValue(dim1[i])
-            arrY.InsertNextValue(dim2[i])
-            arrZ.InsertNextValue(cellLabels[i])
-            arrK.InsertNextValue(clusLabels[i])
-
-        for i in range(len(dim1)):
-            table.RemoveRow(0)
+        self.addTableColumns(kMeansTableNode.GetTable(), [("Dim 1", dim1, np.float32),
+                                                          ("Dim 2", dim2, np.float32),
+                                                          ("Cell Label", labels, np.float32),
+                                                          ("Cluster Label", clusLabels, np.float32)])
 
         # Create cluster plot with matplotlib
-        # Install necessary libraries
-        try:
-            import matplotlib
-        except ModuleNotFoundError:
-            import pip
-            slicer.util.pip_install("matplotlib")
-            import matplotlib
-
-        matplotlib.use("Agg")
-        import matplotlib.pyplot as plt
-        from pylab import savefig
+        plt = requirePyplot()
 
         fig, ax = plt.subplots(figsize=(15,10))
-        ax.scatter(dim1, dim2, c=clusLabels, s=10)
+        scatterPoints(ax, dim1, dim2, clusLabels, how="category")
         ax.set_xlabel("Dimension 1")
         ax.set_ylabel("Dimension 2")
         ax.set_title(name)
 
         # Display cluster plot
-        defaultPath = slicer.app.defaultScenePath
-        pathName = defaultPath + '/' + "kMeans.jpg"
-        savefig(pathName)
-        kMeansImg = sitk.ReadImage(pathName)
-        kMeansArray = sitk.GetArrayFromImage(kMeansImg)
-        arraySize = kMeansArray.shape
-        plt.close()
-
-        # Create new volume "K-Means Clustering"
-        imageSize = [arraySize[1], arraySize[0], 1]
-        voxelType = vtk.VTK_UNSIGNED_CHAR
-        imageOrigin = [0.0, 0.0, 0.0]
-        imageSpacing = [1.0, 1.0, 1.0]
-        imageDirections = [[-1, 0, 0], [0, -1, 0], [0, 0, 1]]
-        fillVoxelValue = 0
-
-        # Create an empty image volume, filled with fillVoxelValue
-        imageData = vtk.vtkImageData()
-        imageData.SetDimensions(imageSize)
-        imageData.AllocateScalars(voxelType, 3)
-        imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
-
-        # Create volume node
-        # Needs to be a vector volume in order to show in colour
-        volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", name)
-        volumeNode.SetOrigin(imageOrigin)
-        volumeNode.SetSpacing(imageSpacing)
-        volumeNode.SetIJKToRASDirections(imageDirections)
-        volumeNode.SetAndObserveImageData(imageData)
-        volumeNode.CreateDefaultDisplayNodes()
-        volumeNode.CreateDefaultStorageNode()
-
-        voxels = slicer.util.arrayFromVolume(volumeNode)
-        voxels[:] = kMeansArray
-
-        volumeNode.Modified()
-        volumeNode.GetDisplayNode().AutoWindowLevelOff()
-        volumeNode.GetDisplayNode().SetWindowLevel((arraySize[1] // 8), 127)
+        volumeNode = self.showFigure(fig, name)
 
         # Set yellow slice to display density scatter plot
         red_widget = slicer.app.layoutManager().sliceWidget("Red")
@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class CellTable:
+    """
+    Columnar table of the cells of a whole cohort: the ROI and cell label of every cell and any number of named
+    float columns (marker means, morphology, centroids). Rows are grouped by ROI in the order the ROIs were appended,
+    and the cells of the i-th ROI are rows offsets[i]:offsets[i + 1], so the cells of one ROI, a column, or a block
+    of columns of one ROI are views into the table rather than copies.
+
+    The values are kept in one column-major array that grows by doubling, so appending ROIs one at a time costs
+    amortized linear time and every column stays contiguous
+    """
+
+    def __init__(self, columnNames=(), fill=0.0):
+        self.columnNames = []
+        self.fill = fill
+        self.rois = []
+        self._offsets = [0]
+        self._labels = np.zeros(0, dtype=np.int64)
+        self._values = np.zeros((0, 0), dtype=np.float64, order="F")
+        self._addColumns(columnNames)
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def __contains__(self, roi):
+        return roi in self.rois
+
+    @property
+    def offsets(self):
+        """
+        Row offsets of the ROIs: the cells of rois[i] are rows offsets[i]:offsets[i + 1]
+        """
+        return np.array(self._offsets, dtype=np.int64)
+
+    def _reserve(self, nRows, nColumns):
+        capacity, width = self._values.shape
+        if nRows <= capacity and nColumns <= width:
+            return
+        if nRows > capacity:
+            capacity = max(nRows, 2 * capacity, 1024)
+        values = np.full((capacity, max(nColumns, width)), self.fill, dtype=np.float64, order="F")
+        values[:len(self), :width] = self._values[:len(self)]
+        self._values = values
+        if capacity > len(self._labels):
+            labels = np.zeros(capacity, dtype=np.int64)
+            labels[:len(self)] = self._labels[:len(self)]
+            self._labels = labels
+
+    def _addColumns(self, names):
+        names = [name for name in dict.fromkeys(names) if name not in self.columnNames]
+        if names:
+            self._reserve(len(self), len(self.columnNames) + len(names))
+            self.columnNames += names
+
+    def append(self, roi, labels, columns):
+        """
+        Add the cells of a ROI: their labels and a mapping {column name: one value per cell}. Columns the table does
+        not have yet are added (earlier ROIs get the fill value); columns the ROI lacks get the fill value. A ROI
+        that is already in the table is replaced
+        """
+        if roi in self.rois:
+            self.remove(roi)
+        labels = np.asarray(labels).ravel()
+        self._addColumns(columns)
+        start = len(self)
+        end = start + len(labels)
+        self._reserve(end, len(self.columnNames))
+        self._labels[start:end] = labels
+        self._values[start:end] = self.fill
+        for name, values in columns.items():
+            self._values[start:end, self.columnNames.index(name)] = np.asarray(values).ravel()
+        self.rois.append(roi)
+        self._offsets.append(end)
+
+    def appendFeatures(self, roi, features, columnNames):
+        """
+        Add the cells of a ROI from a per-cell feature matrix: the cell label in column 0, then one column per name
+        """
+        self.append(roi, features[:, 0].astype(np.int64),
+                    {name: features[:, column + 1] for column, name in enumerate(columnNames)})
+
+    def remove(self, roi):
+        """
+        Drop the cells of a ROI, moving the rows of the ROIs after it up
+        """
+        index = self.rois.index(roi)
+        start, end = self._offsets[index], self._offsets[index + 1]
+        total = len(self)
+        self._labels[start:total - (end - start)] = self._labels[end:total]
+        self._values[start:total - (end - start)] = self._values[end:total]
+        del self.rois[index]
+        self._offsets = self._offsets[:index + 1] + [offset - (end - start) for offset in self._offsets[index + 2:]]
+
+    def rows(self, roi):
+        """
+        Slice of the rows of a ROI's cells
+        """
+        index = self.rois.index(roi)
+        return slice(self._offsets[index], self._offsets[index + 1])
+
+    def labels(self, roi=None):
+        """
+        Cell labels of a ROI, or of every cell
+        """
+        return self._labels[self.rows(roi) if roi is not None else slice(0, len(self))]
+
+    def roiIndices(self):
+        """
+        Index into rois of the ROI of every cell
+        """
+        return np.repeat(np.arange(len(self.rois)), np.diff(self._offsets))
+
+    def column(self, name, roi=None):
+        """
+        Values of one column for a ROI, or for every cell
+        """
+        return self._values[self.rows(roi) if roi is not None else slice(0, len(self)), self.columnNames.index(name)]
+
+    def matrix(self, names=None, roi=None):
+        """
+        cells x columns values of the named columns (all by default) for a ROI or every cell. Adjacent columns in
+        table order give a view; other selections are gathered into a copy
+        """
+        rows = self.rows(roi) if roi is not None else slice(0, len(self))
+        if names is None:
+            return self._values[rows, :len(self.columnNames)]
+        indices = [self.columnNames.index(name) for name in names]
+        if indices and indices == list(range(indices[0], indices[0] + len(indices))):
+            return self._values[rows, indices[0]:indices[0] + len(indices)]
+        return self._values[rows][:, indices]
+
+    def features(self, roi, names=None):
+        """
+        Per-cell feature matrix of a ROI in the layout of cellMeanIntensities: the cell label, then the named columns
+        """
+        values = self.matrix(names, roi)
+        features = np.empty((values.shape[0], values.shape[1] + 1))
+        features[:, 0] = self.labels(roi)
+        features[:, 1:] = values
+        return features
@@ -0,0 +1,137 @@
+import collections
+
+import numpy as np
+
+# RGB weights of the overlay colours offered in the Visualization tab
+OVERLAY_COLOURS = {
+    "red": (1.0, 0.0, 0.0),
+    "green": (0.0, 1.0, 0.0),
+    "blue": (0.0, 0.0, 1.0),
+    "yellow": (1.0, 1.0, 0.0),
+    "cyan": (0.0, 1.0, 1.0),
+    "magenta": (1.0, 0.0, 1.0),
+    "white": (1.0, 1.0, 1.0),
+}
+
+
+def colourMatrix(colours):
+    """
+    N x 3 colour matrix from a list of colour names (see OVERLAY_COLOURS) and/or RGB triples in [0, 1]
+    """
+    rows = [OVERLAY_COLOURS[colour] if isinstance(colour, str) else colour for colour in colours]
+    return np.array(rows, dtype=np.float32).reshape(len(rows), 3)
+
+
+def compositeChannels(channelArrays, colours, threshMin=0, threshMax=0, intensityRanges=None, out=None):
+    """
+    Blend N channels into one uint8 RGB overlay.
+
+    Each channel is scaled from its (min, max) intensity range to 0-255 and weighted by its row of the N x 3 colour
+    matrix; the weighted channels are summed with a single einsum. The sum is clipped to uint8, then components below
+    threshMin are set to 0 and those above 255 - threshMax to 255 through a 256-entry lookup table.
+    intensityRanges, if given, is one (min, max) pair per channel and saves a pass over the data. Returns an array of
+    shape channel shape + (3,), written into out if given
+    """
+    colours = np.asarray(colours, dtype=np.float32)
+    if len(channelArrays) != colours.shape[0]:
+        raise ValueError("One colour is needed per channel")
+    shape = np.shape(channelArrays[0]) if len(channelArrays) else (0,)
+    if out is None:
+        out = np.zeros(shape + (3,), dtype=np.uint8)
+    if not len(channelArrays):
+        out[...] = 0
+        return out
+
+    # Fold the per-channel contrast stretch into the colour matrix: rgb = sum_n (x_n - low_n) * gain_n * colour_n
+    if intensityRanges is None:
+        intensityRanges = [(array.min(), array.max()) for array in channelArrays]
+    lows = np.array([low for low, high in intensityRanges], dtype=np.float32)
+    spans = np.array([high - low for low, high in intensityRanges], dtype=np.float32)
+    gains = np.divide(255.0, spans, out=np.zeros_like(spans), where=spans > 0)
+    weights = colours * gains[:, None]
+    offset = (lows * gains) @ colours
+
+    stack = np.empty((len(channelArrays),) + shape, dtype=np.float32)
+    for index, array in enumerate(channelArrays):
+        stack[index] = array
+    rgb = np.einsum("n...,nc->...c", stack, weights, optimize=True)
+    rgb -= offset
+    np.clip(rgb, 0, 255, out=rgb)
+    out[...] = rgb
+    np.take(thresholdLut(threshMin, threshMax), out, out=out)
+    return out
+
+
+def thresholdLut(threshMin=0, threshMax=0):
+    """
+    256-entry uint8 lookup table that zeroes values below threshMin and saturates values above 255 - threshMax
+    """
+    lut = np.arange(256, dtype=np.uint8)
+    lut[:max(int(threshMin), 0)] = 0
+    lut[max(256 - int(threshMax), 0):] = 255
+    return lut
+
+
+def normalizedPreview(array, intensityRange=None):
+    """
+    uint8 copy of a channel with its (min, max) intensity range stretched to 0-255
+    """
+    low, high = intensityRange if intensityRange is not None else (array.min(), array.max())
+    span = float(high) - float(low)
+    gain = 255.0 / span if span > 0 else 0.0
+    preview = np.empty(np.shape(array), dtype=np.uint8)
+    scaled = (np.asarray(array, dtype=np.float32) - np.float32(low)) * np.float32(gain)
+    np.clip(scaled, 0, 255, out=scaled)
+    np.rint(scaled, out=scaled)
+    preview[...] = scaled
+    return preview
+
+
+class OverlayCompositor:
+    """
+    Caches a normalized uint8 preview of every channel shown in the overlay, and the unthresholded composite of the
+    current channel/colour selection. A colour change re-blends the cached previews; a threshold change is a single
+    256-entry table lookup per pixel. Previews are keyed by channel and invalidated when the channel's version
+    (e.g. its image MTime) changes; at most maxPreviews are kept, least recently used first out
+    """
+
+    def __init__(self, maxPreviews=32):
+        self.maxPreviews = maxPreviews
+        self._previews = collections.OrderedDict()
+        self._compositeKey = None
+        self._composite = None
+
+    def preview(self, key, version, loadArray):
+        """
+        Return the uint8 preview of a channel, calling loadArray() to normalize it only when it is not cached
+        """
+        cached = self._previews.get(key)
+        if cached is not None and cached[0] == version:
+            self._previews.move_to_end(key)
+            return cached[1]
+        preview = normalizedPreview(loadArray())
+        self._previews[key] = (version, preview)
+        self._previews.move_to_end(key)
+        while len(self._previews) > self.maxPreviews:
+            self._previews.popitem(last=False)
+        return preview
+
+    def composite(self, channels, colours, threshMin=0, threshMax=0, out=None):
+        """
+        Overlay of channels, a list of (key, version, loadArray), in the given colours (see colourMatrix)
+        """
+        colours = np.asarray(colours, dtype=np.float32)
+        compositeKey = (tuple((key, version) for key, version, loadArray in channels), colours.tobytes())
+        if compositeKey != self._compositeKey:
+            previews = [self.preview(key, version, loadArray) for key, version, loadArray in channels]
+            self._composite = compositeChannels(previews, colours, intensityRanges=[(0, 255)] * len(previews))
+            self._compositeKey = compositeKey
+        if out is None:
+            out = np.empty(self._composite.shape, dtype=np.uint8)
+        np.take(thresholdLut(threshMin, threshMax), self._composite, out=out)
+        return out
+
+    def clear(self):
+        self._previews.clear()
+        self._compositeKey = None
+        self._composite = None
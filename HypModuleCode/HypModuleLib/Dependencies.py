@@ -0,0 +1,127 @@
+import importlib
+import importlib.util
+import logging
+import shutil
+import subprocess
+import threading
+
+# Third-party packages used by TITAN, mapped to the name they are installed under with pip
+REQUIRED_PACKAGES = {
+    "matplotlib": "matplotlib",
+    "PIL": "Pillow",
+    "skimage": "scikit-image",
+    "scipy": "scipy",
+    "sklearn": "scikit-learn",
+    "pandas": "pandas",
+    "SimpleITK": "SimpleITK",
+    "pyarrow": "pyarrow",
+    "h5py": "h5py",
+}
+
+# Modules that have already been imported through requireModule
+_loadedModules = {}
+
+# pip names of the packages an installPackages call is installing
+_pendingPackages = set()
+
+# Guards _loadedModules and _pendingPackages; never held while importing or running pip
+_lock = threading.Lock()
+_installed = threading.Condition(_lock)
+
+
+def missingPackages(moduleNames=None):
+    """
+    Return the pip names of the packages of the given modules (all required packages by default) that cannot be
+    found, without importing any of them
+    """
+    missing = []
+    for moduleName in REQUIRED_PACKAGES if moduleNames is None else moduleNames:
+        topLevelName = moduleName.split(".")[0]
+        pipName = REQUIRED_PACKAGES.get(topLevelName, topLevelName)
+        if topLevelName not in _loadedModules and importlib.util.find_spec(topLevelName) is None \
+                and pipName not in missing:
+            missing.append(pipName)
+    return missing
+
+
+def installPackages(pipNames):
+    """
+    Install packages in one pip process run with Slicer's Python. Only starts a process and waits for it, without
+    touching Qt, so it may run in a BackgroundJob. Packages another call is already installing are waited for
+    instead of being installed twice
+    """
+    pipNames = list(pipNames)
+    if not pipNames:
+        return []
+    pythonSlicer = shutil.which("PythonSlicer")
+    if pythonSlicer is None:
+        raise RuntimeError("PythonSlicer executable not found, cannot install " + ", ".join(pipNames))
+    with _installed:
+        ownNames = [pipName for pipName in pipNames if pipName not in _pendingPackages]
+        _pendingPackages.update(ownNames)
+    try:
+        if ownNames:
+            logging.info("TITAN: installing missing packages " + ", ".join(ownNames))
+            process = subprocess.run([pythonSlicer, "-m", "pip", "install"] + ownNames, capture_output=True,
+                                     text=True)
+            if process.returncode != 0:
+                raise RuntimeError("Installing " + ", ".join(ownNames) + " failed:\n" + process.stderr[-2000:])
+            importlib.invalidate_caches()
+    finally:
+        with _installed:
+            _pendingPackages.difference_update(ownNames)
+            _installed.notify_all()
+    with _installed:
+        _installed.wait_for(lambda: _pendingPackages.isdisjoint(pipNames))
+    return pipNames
+
+
+def checkDependencies():
+    """
+    Install all missing packages in a single pip call. Run once after the module is set up, never at import time
+    """
+    return installPackages(missingPackages())
+
+
+def requireModule(moduleName):
+    """
+    Import a third-party module on first use. Never installs anything: missing packages are installed in the
+    background when the module starts and by jobs beforehand (see installPackages), so a package that is still
+    being installed or failed to install raises ModuleNotFoundError at once rather than blocking the caller
+    """
+    with _lock:
+        module = _loadedModules.get(moduleName)
+    if module is not None:
+        return module
+
+    topLevelName = moduleName.split(".")[0]
+    if topLevelName != moduleName:
+        # Load the package first so it is configured before any submodule is imported
+        requireModule(topLevelName)
+
+    try:
+        module = importlib.import_module(moduleName)
+    except ModuleNotFoundError:
+        pipName = REQUIRED_PACKAGES.get(topLevelName, topLevelName)
+        with _lock:
+            installing = pipName in _pendingPackages
+        if installing:
+            raise ModuleNotFoundError("TITAN: package %s is still being installed, try again when the installation "
+                                      "has finished" % pipName, name=moduleName)
+        raise ModuleNotFoundError("TITAN: package %s is not installed; install it with pip in Slicer's Python "
+                                  "console" % pipName, name=moduleName)
+
+    # Plots are always rendered off-screen
+    if moduleName == "matplotlib":
+        module.use("Agg")
+
+    with _lock:
+        module = _loadedModules.setdefault(moduleName, module)
+    return module
+
+
+def requirePyplot():
+    """
+    Return matplotlib.pyplot configured for the off-screen Agg backend
+    """
+    return requireModule("matplotlib.pyplot")
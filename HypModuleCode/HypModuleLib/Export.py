@@ -0,0 +1,162 @@
+import concurrent.futures
+import os
+
+import numpy as np
+
+from .Dependencies import requireModule
+
+# File formats cell tables can be exported to, with their file extensions
+CELL_TABLE_FORMATS = {"CSV": ".csv", "Parquet": ".parquet", "Feather": ".feather", "HDF5": ".h5"}
+
+# Rows formatted at a time when writing CSV, which bounds the memory used for the text
+CSV_CHUNK_ROWS = 65536
+
+
+def _csvField(value):
+    # Quote text containing separators, quotes or line breaks
+    text = str(value)
+    if any(character in text for character in ',"\n\r'):
+        text = '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def _csvFormat(column):
+    # printf-style format of one column: a constant is written into the format itself
+    if np.ndim(column) == 0:
+        return _csvField(column).replace("%", "%%")
+    kind = column.dtype.kind
+    if kind in "iub":
+        return "%d"
+    if kind == "f":
+        # repr of a float64 is the shortest text that reads back to the same value
+        return "%r" if column.dtype.itemsize == 8 else "%.9g"
+    return "%s"
+
+
+def writeCsv(file, header, blocks, chunkRows=CSV_CHUNK_ROWS):
+    """
+    Write a CSV file from blocks of columns, without building a DataFrame or the whole text in memory. file is a
+    path or an open text file; header is the list of column names; blocks is an iterable of lists of columns, one
+    per header name, each a 1D array or a constant for the whole block (e.g. a ROI name). Blocks are formatted
+    chunkRows rows at a time
+    """
+    if isinstance(file, str):
+        with open(file, "w", newline="") as stream:
+            return writeCsv(stream, header, blocks, chunkRows)
+    file.write(",".join(_csvField(name) for name in header) + "\n")
+    for columns in blocks:
+        arrays = [(index, np.asarray(column)) for index, column in enumerate(columns) if np.ndim(column) > 0]
+        nRows = len(arrays[0][1]) if arrays else 0
+        lineFormat = ",".join(_csvFormat(np.asarray(column) if np.ndim(column) else column)
+                              for column in columns) + "\n"
+        for start in range(0, nRows, chunkRows):
+            chunk = []
+            for index, array in arrays:
+                values = array[start:start + chunkRows].tolist()
+                if array.dtype.kind not in "iubf":
+                    values = [_csvField(value) for value in values]
+                chunk.append(values)
+            file.write("".join(lineFormat % row for row in zip(*chunk)))
+
+
+def writeCsvFiles(files, maxWorkers=None, job=None):
+    """
+    Write several CSV files with writeCsv in a thread pool; files is a list of (path, header, blocks). Each worker
+    only holds the text of one chunk, so memory stays bounded whatever the size of the tables. job, if given, is a
+    BackgroundJob used for progress and cancellation. Returns the paths
+    """
+    maxWorkers = maxWorkers or min(4, os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        futures = [pool.submit(writeCsv, path, header, blocks) for path, header, blocks in files]
+        try:
+            for done, future in enumerate(concurrent.futures.as_completed(futures)):
+                future.result()
+                if job is not None:
+                    job.checkCancelled()
+                    job.setProgress(100 * (done + 1) // len(files), "Saving tables")
+        finally:
+            for future in futures:
+                future.cancel()
+    return [path for path, header, blocks in files]
+
+
+def cellTableBlocks(cells, rois=None):
+    """
+    Blocks of (ROI, cell label, column ...) columns of a CellTable for writeCsv, one per ROI. The columns are views
+    into the table
+    """
+    for roi in rois if rois is not None else cells.rois:
+        yield [roi, cells.labels(roi)] + [cells.column(name, roi) for name in cells.columnNames]
+
+
+def _arrowBatch(pa, cells, roiIndex):
+    # Record batch of one ROI's cells; the ROI is dictionary-encoded against every ROI of the table
+    roi = cells.rois[roiIndex]
+    nRows = len(cells.labels(roi))
+    roiColumn = pa.DictionaryArray.from_arrays(pa.array(np.full(nRows, roiIndex, dtype=np.int32)),
+                                               pa.array(cells.rois, type=pa.string()))
+    columns = [roiColumn, pa.array(cells.labels(roi))]
+    columns += [pa.array(np.ascontiguousarray(cells.column(name, roi))) for name in cells.columnNames]
+    return pa.RecordBatch.from_arrays(columns, ["ROI", "Cell Label"] + list(cells.columnNames))
+
+
+def writeCellTable(cells, path, fileFormat, job=None):
+    """
+    Write a CellTable to one file in one of CELL_TABLE_FORMATS, streamed ROI by ROI so only one ROI's rows are
+    converted at a time: a compressed row group per ROI for Parquet, a compressed record batch per ROI for Feather
+    (Arrow IPC), chunked compressed datasets grown per ROI for HDF5 (with the ROI names and row offsets), or
+    formatted text for CSV. job, if given, is a BackgroundJob used for progress and cancellation
+    """
+    def progress(index):
+        if job is not None:
+            job.checkCancelled()
+            job.setProgress(100 * (index + 1) // max(len(cells.rois), 1), "Writing " + fileFormat)
+
+    if fileFormat == "CSV":
+        def blocks():
+            for index, block in enumerate(cellTableBlocks(cells)):
+                yield block
+                progress(index)
+        writeCsv(path, ["ROI", "Cell Label"] + list(cells.columnNames), blocks())
+
+    elif fileFormat in ("Parquet", "Feather"):
+        pa = requireModule("pyarrow")
+        schema = pa.schema([("ROI", pa.dictionary(pa.int32(), pa.string())), ("Cell Label", pa.int64())]
+                           + [(name, pa.float64()) for name in cells.columnNames])
+        if fileFormat == "Parquet":
+            writer = requireModule("pyarrow.parquet").ParquetWriter(path, schema, compression="zstd")
+            write = lambda batch: writer.write_table(pa.Table.from_batches([batch], schema))
+        else:
+            writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+            write = writer.write_batch
+        try:
+            for index in range(len(cells.rois)):
+                write(_arrowBatch(pa, cells, index))
+                progress(index)
+        finally:
+            writer.close()
+
+    elif fileFormat == "HDF5":
+        h5py = requireModule("h5py")
+        with h5py.File(path, "w") as file:
+            group = file.create_group("cells")
+            datasets = []
+            for name, dtype in [("ROI", np.int32), ("Cell Label", np.int64)] + [(name, np.float64)
+                                                                              for name in cells.columnNames]:
+                datasets.append(group.create_dataset(name.replace("/", "_"), (0,), dtype=dtype, maxshape=(None,),
+                                                     chunks=True, compression="gzip", shuffle=True))
+            file.create_dataset("ROI names", data=np.array(cells.rois, dtype=object),
+                                dtype=h5py.string_dtype())
+            file.create_dataset("ROI offsets", data=cells.offsets)
+            for index, roi in enumerate(cells.rois):
+                rows = cells.rows(roi)
+                columns = [np.full(rows.stop - rows.start, index, dtype=np.int32), cells.labels(roi)]
+                columns += [cells.column(name, roi) for name in cells.columnNames]
+                for dataset, column in zip(datasets, columns):
+                    dataset.resize((rows.stop,))
+                    dataset[rows.start:rows.stop] = column
+                progress(index)
+
+    else:
+        raise ValueError("Unknown export format " + repr(fileFormat))
+    return path
@@ -0,0 +1,223 @@
+import numpy as np
+
+from .Dependencies import requireModule
+
+
+def cellLabels(cellMaskArray):
+    """
+    Return the sorted, non-zero cell labels present in a label image
+    """
+    labels = np.unique(cellMaskArray)
+    return labels[labels != 0]
+
+
+def cellMeanIntensities(cellMaskArray, *channelArrays):
+    """
+    Mean intensity of each channel in each cell, computed with one bincount pass per channel.
+    Returns an array of shape (cells, 1 + channels): the cell label followed by one column per channel
+    """
+    maskFlat = cellMaskArray.ravel()
+    labels = cellLabels(cellMaskArray)
+    pixelCounts = np.bincount(maskFlat)
+    features = np.zeros((len(labels), len(channelArrays) + 1))
+    features[:, 0] = labels
+    for column, channelArray in enumerate(channelArrays):
+        sums = np.bincount(maskFlat, weights=channelArray.ravel(), minlength=len(pixelCounts))
+        features[:, column + 1] = sums[labels] / pixelCounts[labels]
+    return features
+
+
+# Compartments quantified per cell: the whole cell, its nucleus and its cytoplasm (the cell without its nucleus)
+COMPARTMENTS = ("Cell", "Nucleus", "Cytoplasm")
+
+
+def compartmentColumnNames(channelNames):
+    """
+    Names of the feature columns of compartmentMeanIntensities: the channel names for the whole cell, then
+    "<channel> (Nucleus)" and "<channel> (Cytoplasm)"
+    """
+    return [name + (" (" + compartment + ")" if compartment != "Cell" else "")
+            for compartment in COMPARTMENTS for name in channelNames]
+
+
+def compartmentMeanIntensities(cellMaskArray, nucleusMaskArray, *channelArrays):
+    """
+    Mean intensity of each channel in the whole cell, the nucleus and the cytoplasm of each cell, from one pass over
+    a combined label image: a pixel of cell L is labelled 2L + 1 if it is in L's nucleus and 2L otherwise, so one
+    bincount per channel sums both compartments, and the whole cell is their sum.
+    Returns an array of shape (cells, 1 + 3 * channels): the cell label, then one column per channel for each of
+    COMPARTMENTS in turn (see compartmentColumnNames), so the first 1 + channels columns are cellMeanIntensities.
+    Compartments without pixels have mean 0
+    """
+    cellFlat = _labelIndices(cellMaskArray).ravel()
+    inNucleus = (np.asarray(nucleusMaskArray).ravel() == cellFlat) & (cellFlat != 0)
+    combined = 2 * cellFlat.astype(np.intp) + inNucleus
+    labels = cellLabels(cellMaskArray)
+    pixelCounts = np.bincount(combined)
+    nChannels = len(channelArrays)
+    counts = [pixelCounts[2 * labels] + pixelCounts[2 * labels + 1], pixelCounts[2 * labels + 1],
+              pixelCounts[2 * labels]]
+
+    features = np.zeros((len(labels), 3 * nChannels + 1))
+    features[:, 0] = labels
+    for column, channelArray in enumerate(channelArrays):
+        sums = np.bincount(combined, weights=channelArray.ravel(), minlength=len(pixelCounts))
+        compartmentSums = [sums[2 * labels] + sums[2 * labels + 1], sums[2 * labels + 1], sums[2 * labels]]
+        for compartment in range(len(COMPARTMENTS)):
+            present = counts[compartment] > 0
+            features[present, compartment * nChannels + column + 1] = (compartmentSums[compartment][present]
+                                                                       / counts[compartment][present])
+    return features
+
+
+# Per-cell statistics offered for the heatmap on a channel
+CELL_STATISTICS = ("positive fraction", "mean", "median")
+
+
+def cellStatisticLut(cellMaskArray, channelArray, statistic="positive fraction"):
+    """
+    Per-cell statistic of a channel as a lookup table indexed by cell label, so lut[cellMaskArray] paints it back
+    onto the mask in one gather. statistic is one of CELL_STATISTICS: the fraction of a cell's pixels that are
+    non-zero, or the mean or median intensity of its pixels. Background and labels without pixels map to 0
+    """
+    maskFlat = np.asarray(cellMaskArray).ravel()
+    values = np.asarray(channelArray).ravel()
+    pixelCounts = np.bincount(maskFlat)
+    present = pixelCounts > 0
+    present[0] = False
+    lut = np.zeros(len(pixelCounts))
+
+    if statistic == "positive fraction":
+        positive = np.bincount(maskFlat, weights=values != 0, minlength=len(pixelCounts))
+        lut[present] = positive[present] / pixelCounts[present]
+    elif statistic == "mean":
+        sums = np.bincount(maskFlat, weights=values, minlength=len(pixelCounts))
+        lut[present] = sums[present] / pixelCounts[present]
+    elif statistic == "median":
+        # Sort the pixels by cell, then by value, and take the middle of every cell's run
+        order = np.lexsort((values, maskFlat))
+        sortedValues = values[order].astype(np.float64)
+        starts = np.concatenate(([0], np.cumsum(pixelCounts)[:-1]))
+        labels = np.nonzero(present)[0]
+        lower = starts[labels] + (pixelCounts[labels] - 1) // 2
+        upper = starts[labels] + pixelCounts[labels] // 2
+        lut[labels] = (sortedValues[lower] + sortedValues[upper]) / 2
+    else:
+        raise ValueError("Unknown cell statistic " + repr(statistic))
+    return lut
+
+
+def _labelIndices(cellMaskArray):
+    # Label image usable as an index array
+    cellMaskArray = np.asarray(cellMaskArray)
+    return cellMaskArray if cellMaskArray.dtype.kind in "iu" else cellMaskArray.astype(np.intp)
+
+
+def selectCells(cellMaskArray, labels):
+    """
+    Copy of a label image that keeps only the given cell labels and sets every other pixel to 0, built with one
+    boolean lookup table over the labels and one gather
+    """
+    indices = _labelIndices(cellMaskArray)
+    maxLabel = int(indices.max()) if indices.size else 0
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    keep = np.zeros(maxLabel + 1, dtype=bool)
+    keep[labels[(labels > 0) & (labels <= maxLabel)]] = True
+    lut = np.where(keep, np.arange(maxLabel + 1), 0).astype(np.asarray(cellMaskArray).dtype)
+    return lut[indices]
+
+
+def removeCells(cellMaskArray, labels):
+    """
+    Set the pixels of the given cell labels to 0, in place, with one boolean lookup table over the labels
+    """
+    indices = _labelIndices(cellMaskArray)
+    maxLabel = int(indices.max()) if indices.size else 0
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    removed = np.zeros(maxLabel + 1, dtype=bool)
+    removed[labels[(labels > 0) & (labels <= maxLabel)]] = True
+    cellMaskArray[removed[indices]] = 0
+    return cellMaskArray
+
+
+def borderLabels(cellMaskArray):
+    """
+    Sorted, non-zero labels of the cells touching the edge of the first slice of a label image
+    """
+    image = np.asarray(cellMaskArray)[0]
+    labels = np.unique(np.concatenate((image[0, :], image[-1, :], image[:, 0], image[:, -1])))
+    return labels[labels != 0]
+
+
+def labelsUnderSelection(cellMaskArray, selectionArray):
+    """
+    Sorted, non-zero labels of the cells with at least one pixel where selectionArray is non-zero
+    """
+    touched = np.bincount(_labelIndices(cellMaskArray)[np.asarray(selectionArray) != 0].ravel(), minlength=1)
+    labels = np.nonzero(touched)[0]
+    return labels[labels != 0]
+
+
+# Per-cell shape features, in pixels, measured by SimpleITK's LabelShapeStatisticsImageFilter
+MORPHOLOGY_FEATURES = ("Area", "Centroid X", "Centroid Y", "Bounding Box X", "Bounding Box Y", "Bounding Box Width",
+                       "Bounding Box Height", "Perimeter", "Elongation", "Equivalent Diameter")
+
+
+def shapeFeatures(stats, labels=None):
+    """
+    Per-cell morphology from an executed LabelShapeStatisticsImageFilter (with perimeters computed): an array of
+    shape (cells, 1 + len(MORPHOLOGY_FEATURES)) holding the cell label followed by MORPHOLOGY_FEATURES, for the given
+    labels (all labels of the filter by default)
+    """
+    labels = sorted(stats.GetLabels()) if labels is None else labels
+    morphology = np.zeros((len(labels), len(MORPHOLOGY_FEATURES) + 1))
+    for row, label in enumerate(labels):
+        centroid = stats.GetCentroid(label)
+        box = stats.GetBoundingBox(label)
+        dimension = len(box) // 2
+        morphology[row] = (label, stats.GetNumberOfPixels(label), centroid[0], centroid[1], box[0], box[1],
+                           box[dimension], box[dimension + 1], stats.GetPerimeter(label), stats.GetElongation(label),
+                           2 * stats.GetEquivalentSphericalRadius(label))
+    return morphology
+
+
+def cellMorphology(cellMaskArray):
+    """
+    Per-cell morphology of a label image (see shapeFeatures), measured in one LabelShapeStatisticsImageFilter pass.
+    A single-slice volume is measured as a 2D image, so perimeters are outlines rather than surfaces
+    """
+    sitk = requireModule("SimpleITK")
+    cellMaskArray = np.asarray(cellMaskArray)
+    if cellMaskArray.ndim == 3 and cellMaskArray.shape[0] == 1:
+        cellMaskArray = cellMaskArray[0]
+    stats = sitk.LabelShapeStatisticsImageFilter()
+    stats.ComputePerimeterOn()
+    stats.Execute(sitk.GetImageFromArray(cellMaskArray.astype(np.uint32)))
+    return shapeFeatures(stats)
+
+
+def joinCellFeatures(features, other):
+    """
+    Per-cell matrix features (cell label in column 0) with the feature columns of other appended, matching rows by
+    cell label; other is sorted by label. Cells missing from other get 0
+    """
+    nColumns = features.shape[1]
+    joined = np.zeros((features.shape[0], nColumns + other.shape[1] - 1))
+    joined[:, :nColumns] = features
+    if len(other):
+        order = np.minimum(np.searchsorted(other[:, 0], features[:, 0]), len(other) - 1)
+        found = other[order, 0] == features[:, 0]
+        joined[found, nColumns:] = other[order[found], 1:]
+    return joined
+
+
+def percentileNormalize(values, percentile=99):
+    """
+    Divide each column of a cells x columns array in place by its given percentile over the cells. Columns whose
+    percentile is 0 (a marker absent from almost every cell) are left as they are, and so is an array without cells.
+    Returns values
+    """
+    if len(values):
+        scale = np.percentile(values, percentile, axis=0)
+        values /= np.where(scale > 0, scale, 1.0)
+    return values
@@ -0,0 +1,239 @@
+import numpy as np
+
+from .Features import selectCells
+
+# Number of set bits in every byte value
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def labelBits(labels, nBits):
+    """
+    Packed bitset of length nBits with the bits of the given cell labels set
+    """
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    flags = np.zeros(nBits, dtype=bool)
+    flags[labels[(labels >= 0) & (labels < nBits)]] = True
+    return np.packbits(flags)
+
+
+class CellGate:
+    """
+    Set of cells of one ROI, stored as a bitset over the ROI's cell labels (one bit per label, so 10,000 cells take
+    1.25 kB). Every gate keeps the bitset of its ROI's whole population, shared between all gates of that ROI, so
+    gates combine with & (and), | (or), - (difference) and ~ (not, within the population). A full-resolution mask is
+    only made by mask() when it is needed for display
+    """
+
+    def __init__(self, roi, bits, populationBits):
+        self.roi = roi
+        self.bits = bits
+        self.populationBits = populationBits
+
+    @classmethod
+    def population(cls, roi, labels):
+        """
+        Gate holding every cell of a ROI, given its non-zero cell labels
+        """
+        labels = np.asarray(labels, dtype=np.int64).ravel()
+        bits = labelBits(labels, int(labels.max()) + 1 if len(labels) else 1)
+        return cls(roi, bits, bits)
+
+    def subset(self, labels):
+        """
+        Gate holding the given cells of this gate; labels outside it are ignored
+        """
+        bits = labelBits(labels, self.nBits) & self.bits
+        return CellGate(self.roi, bits, self.populationBits)
+
+    @property
+    def nBits(self):
+        return len(self.populationBits) * 8
+
+    def _combine(self, other, bits):
+        if other.roi != self.roi or other.populationBits.shape != self.populationBits.shape:
+            raise ValueError("Gates of different ROIs cannot be combined")
+        return CellGate(self.roi, bits, self.populationBits)
+
+    def __and__(self, other):
+        return self._combine(other, self.bits & other.bits)
+
+    def __or__(self, other):
+        return self._combine(other, self.bits | other.bits)
+
+    def __sub__(self, other):
+        return self._combine(other, self.bits & ~other.bits)
+
+    def __invert__(self):
+        return CellGate(self.roi, self.populationBits & ~self.bits, self.populationBits)
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, label):
+        return 0 <= label < self.nBits and bool(self.bits[label >> 3] & (0x80 >> (label & 7)))
+
+    def count(self):
+        """
+        Number of cells in the gate
+        """
+        return int(_POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def fraction(self):
+        """
+        Fraction of the ROI's cells that are in the gate
+        """
+        total = int(_POPCOUNT[self.populationBits].sum(dtype=np.int64))
+        return self.count() / total if total else 0.0
+
+    def flags(self):
+        """
+        Boolean array indexed by cell label, True for the cells in the gate
+        """
+        return np.unpackbits(self.bits).astype(bool)
+
+    def labels(self):
+        """
+        Sorted labels of the cells in the gate
+        """
+        return np.flatnonzero(np.unpackbits(self.bits))
+
+    def mask(self, cellMaskArray):
+        """
+        Copy of the ROI's label image keeping only the cells in the gate, made with one gather
+        """
+        return selectCells(cellMaskArray, self.labels())
+
+
+class GatingTree:
+    """
+    Gates by name. Each gate is a child of its ROI (parent None) or of the gate it was gated from, and caches the
+    rows of a ROI's per-cell feature matrix that belong to it, per-marker summary statistics and its cell count.
+    A child's rows are taken from its parent's cached rows when they are there, so re-plotting a gate or its
+    children does not go back to the pixels. Replacing a gate drops the caches of the gate and its descendants, and
+    rows and statistics cached for an older version of the feature matrix are computed again
+    """
+
+    def __init__(self):
+        self._gates = {}
+        self._parents = {}
+        self._cache = {}
+
+    def add(self, name, gate, parent=None):
+        """
+        Add or replace a gate under parent (a gate name, or None for its ROI). A gate gated from itself keeps its
+        old parent; a parent that is not a gate, or is the gate's own descendant, is ignored
+        """
+        if parent == name:
+            parent = self._parents.get(name)
+        if parent is not None and (parent not in self._gates or
+                                   (name in self._gates and parent in {child for child, depth in self.walk(name)})):
+            parent = None
+        self.invalidate(name)
+        self._gates[name] = gate
+        self._parents[name] = parent
+
+    def __contains__(self, name):
+        return name in self._gates
+
+    def __getitem__(self, name):
+        return self._gates[name]
+
+    def __len__(self):
+        return len(self._gates)
+
+    def get(self, name, default=None):
+        return self._gates.get(name, default)
+
+    def items(self):
+        return self._gates.items()
+
+    def parent(self, name):
+        return self._parents.get(name)
+
+    def children(self, name):
+        return [child for child, parent in self._parents.items() if parent == name]
+
+    def walk(self, name=None, depth=0):
+        """
+        Yield (name, depth) for a gate and its descendants depth first, or for every gate when name is None
+        """
+        if name is None:
+            for root in [gate for gate, parent in self._parents.items() if parent is None]:
+                yield from self.walk(root)
+            return
+        yield name, depth
+        for child in self.children(name):
+            yield from self.walk(child, depth + 1)
+
+    def invalidate(self, name):
+        """
+        Drop the cached rows, statistics and counts of a gate and all its descendants
+        """
+        names = {gate for gate, depth in self.walk(name)} if name in self._gates else {name}
+        for key in [key for key in self._cache if key[0] in names]:
+            del self._cache[key]
+
+    def _cached(self, key, compute, version=None):
+        # Entries are (version, value); one cached for another version is replaced
+        entry = self._cache.get(key)
+        if entry is None or entry[0] != version:
+            entry = self._cache[key] = (version, compute())
+        return entry[1]
+
+    def count(self, name):
+        return self._cached((name, "count"), self._gates[name].count)
+
+    def fraction(self, name):
+        """
+        Fraction of the cells of the gate's parent (or ROI) that are in the gate
+        """
+        parent = self._parents.get(name)
+        if parent is None:
+            return self._gates[name].fraction()
+        total = self.count(parent)
+        return self.count(name) / total if total else 0.0
+
+    def rows(self, name, featureKey, features, version=None):
+        """
+        Rows of a per-cell feature matrix of the gate's ROI (cell label in column 0) that belong to the gate, cached
+        under featureKey. version identifies the contents of the matrix, e.g. the generation of the pipeline stage
+        it came from; rows cached for another version are not reused
+        """
+        def compute():
+            parent = self._parents.get(name)
+            source = self.rows(parent, featureKey, features, version) if parent is not None else features
+            flags = self._gates[name].flags()
+            labels = source[:, 0].astype(np.int64)
+            inside = (labels >= 0) & (labels < len(flags))
+            inside[inside] = flags[labels[inside]]
+            return source[inside]
+        return self._cached((name, "rows", featureKey), compute, version)
+
+    def statistics(self, name, featureKey, features, columnNames, version=None):
+        """
+        Per-marker summary of the gate's cells: {column name: {"count", "mean", "median", "std", "min", "max"}} for
+        the feature columns after the cell label, cached under featureKey and version like rows
+        """
+        def compute():
+            rows = self.rows(name, featureKey, features, version)
+            summary = {}
+            for column, columnName in enumerate(columnNames):
+                values = rows[:, column + 1]
+                if len(values):
+                    summary[columnName] = {"count": len(values), "mean": float(values.mean()),
+                                           "median": float(np.median(values)), "std": float(values.std()),
+                                           "min": float(values.min()), "max": float(values.max())}
+                else:
+                    summary[columnName] = {"count": 0}
+            return summary
+        return self._cached((name, "statistics", featureKey), compute, version)
+
+    def summaries(self, name):
+        """
+        Every per-marker summary cached for a gate so far, merged into one {column name: statistics} dict
+        """
+        merged = {}
+        for key, (version, value) in self._cache.items():
+            if key[0] == name and key[1] == "statistics":
+                merged.update(value)
+        return merged
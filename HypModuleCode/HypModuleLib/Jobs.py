@@ -0,0 +1,179 @@
+import collections
+import logging
+import queue
+import threading
+import traceback
+
+import qt
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job's compute function when the user has cancelled it
+    """
+    pass
+
+
+class BackgroundJob:
+    """
+    A long-running analysis split into a compute part, which may run on a worker thread and must not touch the
+    MRML scene, and a display part, which always runs on the main thread and receives the compute result.
+
+    The compute function is called with the job itself so that it can report progress and check for cancellation.
+    """
+
+    def __init__(self, name, compute, display=None):
+        self.name = name
+        self.compute = compute
+        self.display = display
+        self.status = "pending"
+        self.result = None
+        self.error = None
+        self._cancelEvent = threading.Event()
+        self._events = None
+        self._finishedCallbacks = []
+
+    def setProgress(self, value, message=""):
+        """
+        Report progress (0-100). Safe to call from the worker thread; ignored when the job is run synchronously
+        """
+        if self._events is not None:
+            self._events.put(("progress", self, (value, message)))
+
+    def cancel(self):
+        self._cancelEvent.set()
+
+    def isCancelled(self):
+        return self._cancelEvent.is_set()
+
+    def checkCancelled(self):
+        """
+        Raise JobCancelled if the job has been cancelled; call between units of work in the compute function
+        """
+        if self._cancelEvent.is_set():
+            raise JobCancelled(self.name)
+
+    def addFinishedCallback(self, callback):
+        """
+        Call callback(result) on the main thread once the display step is done
+        """
+        if self.status == "done":
+            callback(self.result)
+        else:
+            self._finishedCallbacks.append(callback)
+
+    def runNow(self):
+        """
+        Run compute and display synchronously on the calling thread and return the display result
+        """
+        self.status = "running"
+        computed = self.compute(self)
+        return self._finish(computed)
+
+    def _finish(self, computed):
+        if self.display is not None:
+            self.result = self.display(computed)
+        else:
+            self.result = computed
+        self.status = "done"
+        for callback in self._finishedCallbacks:
+            callback(self.result)
+        self._finishedCallbacks = []
+        return self.result
+
+
+class JobRunner:
+    """
+    Runs BackgroundJobs one at a time on a worker thread. Progress, results and errors are passed back through a
+    queue that a QTimer drains on the main thread, so Qt and MRML are only ever touched from the main thread.
+
+    stateCallback(job) is called when a job starts and again when it ends; job.status tells which.
+    """
+
+    def __init__(self, progressCallback=None, stateCallback=None, pollInterval=100):
+        self.progressCallback = progressCallback
+        self.stateCallback = stateCallback
+        self.currentJob = None
+        self._pending = collections.deque()
+        self._events = queue.Queue()
+        self._timer = qt.QTimer()
+        self._timer.setInterval(pollInterval)
+        self._timer.connect("timeout()", self._processEvents)
+
+    def start(self, job):
+        """
+        Queue a job; it starts as soon as no other job is running
+        """
+        job._events = self._events
+        self._pending.append(job)
+        if self.currentJob is None:
+            self._startNext()
+        return job
+
+    def isBusy(self):
+        return self.currentJob is not None
+
+    def cancel(self):
+        """
+        Cancel the running job and drop any queued jobs
+        """
+        for job in self._pending:
+            job.cancel()
+            job.status = "cancelled"
+        self._pending.clear()
+        if self.currentJob is not None:
+            self.currentJob.cancel()
+
+    def _startNext(self):
+        if not self._pending:
+            self.currentJob = None
+            self._timer.stop()
+            return
+        job = self._pending.popleft()
+        self.currentJob = job
+        job.status = "running"
+        if self.stateCallback is not None:
+            self.stateCallback(job)
+        thread = threading.Thread(target=self._work, args=(job,), name="TITAN " + job.name, daemon=True)
+        thread.start()
+        self._timer.start()
+
+    def _work(self, job):
+        # Worker thread: never touch Qt or MRML here
+        try:
+            computed = job.compute(job)
+            job.checkCancelled()
+            self._events.put(("done", job, computed))
+        except JobCancelled:
+            self._events.put(("cancelled", job, None))
+        except Exception:
+            self._events.put(("error", job, traceback.format_exc()))
+
+    def _processEvents(self):
+        # Main thread: drain everything the worker has posted since the last tick
+        while True:
+            try:
+                kind, job, payload = self._events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                if self.progressCallback is not None:
+                    self.progressCallback(job, payload[0], payload[1])
+                continue
+            if kind == "done":
+                try:
+                    job._finish(payload)
+                except Exception:
+                    job.status = "error"
+                    job.error = traceback.format_exc()
+                    logging.error("TITAN: " + job.name + " failed\n" + job.error)
+            elif kind == "cancelled":
+                job.status = "cancelled"
+                logging.info("TITAN: " + job.name + " cancelled")
+            else:
+                job.status = "error"
+                job.error = payload
+                logging.error("TITAN: " + job.name + " failed\n" + payload)
+            if self.stateCallback is not None:
+                self.stateCallback(job)
+            self._startNext()
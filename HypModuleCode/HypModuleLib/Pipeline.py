@@ -0,0 +1,234 @@
+import concurrent.futures
+import os
+import threading
+
+from .ResultStore import contentKey
+
+
+class StageScheduler:
+    """
+    Dependency-aware scheduler for the analysis stages (channels -> masks -> features -> embedding -> clusters).
+
+    Every stage is identified by a key such as ("masks", roiName). Source stages hold data copied from the scene
+    together with a version, e.g. the MTime of the volume it came from. Computed stages have a function, the keys of
+    the stages they depend on and the parameters they were defined with; the function is called as
+    function(*dependencyResults, **parameters).
+
+    Results are kept until a stage's version or parameters change, at which point the stage and everything
+    downstream of it is invalidated. run() only recomputes stale stages, and runs stages whose dependencies are
+    ready in parallel.
+
+    With a ResultStore, every computed result is also saved under a content key derived from the stage's function,
+    its parameters and the content keys of its inputs (source stages are keyed by a hash of their data), and is loaded
+    from the store instead of recomputed when the same inputs are seen again, also in a later session. Sources are
+    hashed by run(), on the thread running it, rather than when they are set; a stage with an input that has no
+    content key is computed without the store.
+    """
+
+    def __init__(self, maxWorkers=None, store=None):
+        self.maxWorkers = maxWorkers or min(4, os.cpu_count() or 1)
+        self.store = store
+        self._stages = {}
+        self._results = {}
+        self._generations = {}
+        self._contentKeys = {}
+        self._lock = threading.RLock()
+
+    def setSource(self, key, version, loader):
+        """
+        Declare a source stage. loader() is only called, and downstream stages only invalidated, when version changed
+        """
+        with self._lock:
+            stage = self._stages.get(key)
+            if stage is not None and stage["version"] == version and key in self._results:
+                return
+            self.invalidate(key)
+            self._stages[key] = {"function": None, "dependencies": (), "parameters": {}, "version": version}
+        value = loader()
+        with self._lock:
+            self._results[key] = value
+
+    def define(self, key, function, dependencies=(), parameters=None):
+        """
+        Declare a computed stage. Redefining it with other dependencies or parameters invalidates its result
+        """
+        dependencies = tuple(dependencies)
+        parameters = dict(parameters or {})
+        with self._lock:
+            stage = self._stages.get(key)
+            if stage is None or stage["dependencies"] != dependencies or stage["parameters"] != parameters:
+                self.invalidate(key)
+            self._stages[key] = {"function": function, "dependencies": dependencies, "parameters": parameters,
+                                 "version": None}
+
+    def dependents(self, key):
+        """
+        Return the keys of all stages downstream of key
+        """
+        with self._lock:
+            found = set()
+            frontier = [key]
+            while frontier:
+                current = frontier.pop()
+                for otherKey, stage in self._stages.items():
+                    if current in stage["dependencies"] and otherKey not in found:
+                        found.add(otherKey)
+                        frontier.append(otherKey)
+            return found
+
+    def invalidate(self, key):
+        """
+        Drop the result of key and of every stage downstream of it
+        """
+        with self._lock:
+            for staleKey in {key} | self.dependents(key):
+                self._results.pop(staleKey, None)
+                self._contentKeys.pop(staleKey, None)
+                self._generations[staleKey] = self._generations.get(staleKey, 0) + 1
+
+    def generation(self, key):
+        """
+        Number of times the result of key has been dropped because the stage or a stage upstream of it changed.
+        Caches derived from a result key on it to notice that the result they came from is out of date
+        """
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def isStale(self, key):
+        with self._lock:
+            return key not in self._results
+
+    def hasResult(self, key):
+        return not self.isStale(key)
+
+    def result(self, key):
+        with self._lock:
+            return self._results[key]
+
+    def remove(self, key):
+        """
+        Forget a stage and everything downstream of it
+        """
+        with self._lock:
+            staleKeys = {key} | self.dependents(key)
+            self.invalidate(key)
+            for staleKey in staleKeys:
+                self._stages.pop(staleKey, None)
+
+    def _plan(self, targets):
+        # Stages needed for the targets, in dependency order
+        order = []
+        visited = set()
+
+        def visit(key, path):
+            if key in visited:
+                return
+            if key in path:
+                raise ValueError("Cyclic dependency at stage " + str(key))
+            if key not in self._stages:
+                raise KeyError("Stage " + str(key) + " has not been defined")
+            for dependency in self._stages[key]["dependencies"]:
+                visit(dependency, path | {key})
+            visited.add(key)
+            order.append(key)
+
+        for target in targets:
+            visit(target, frozenset())
+        return order
+
+    def run(self, targets, job=None):
+        """
+        Bring the target stages up to date and return {key: result}. job, if given, is a BackgroundJob used for
+        progress and cancellation
+        """
+        targets = list(targets)
+        with self._lock:
+            pending = [key for key in self._plan(targets) if key not in self._results]
+        for key in pending:
+            if self._stages[key]["function"] is None:
+                raise ValueError("Source stage " + str(key) + " has no data")
+
+        total = len(pending)
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            if pending and self.store is not None:
+                if job is not None:
+                    job.setProgress(0, "Hashing inputs")
+                self._hashSources(self._plan(targets), pool)
+
+            while pending or running:
+                if job is not None:
+                    job.checkCancelled()
+
+                # Submit every stage whose dependencies are available
+                with self._lock:
+                    ready = [key for key in pending
+                             if all(dependency in self._results for dependency in self._stages[key]["dependencies"])]
+                    for key in ready:
+                        pending.remove(key)
+                        stage = self._stages[key]
+                        inputs = [self._results[dependency] for dependency in stage["dependencies"]]
+                        stageKey = self._stageContentKey(key)
+                        future = pool.submit(self._compute, stage, inputs, stageKey)
+                        running[future] = (key, self._generations.get(key, 0), stageKey)
+
+                if not running:
+                    raise RuntimeError("Stages " + ", ".join(str(key) for key in pending) +
+                                       " were invalidated while running")
+
+                done, notDone = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    key, generation, stageKey = running.pop(future)
+                    value = future.result()
+                    with self._lock:
+                        # A stage invalidated while it was computing keeps no result
+                        if self._generations.get(key, 0) == generation:
+                            self._results[key] = value
+                            self._contentKeys[key] = stageKey
+                        elif key in self._stages:
+                            pending.append(key)
+                if job is not None and total:
+                    job.setProgress(100 * (total - len(pending) - len(running)) // total,
+                                    str(key[0]) if isinstance(key, tuple) else str(key))
+
+        with self._lock:
+            return {key: self._results[key] for key in targets}
+
+    def _hashSources(self, keys, pool):
+        # Content keys of the source stages among keys that have none yet, hashed in parallel (hashlib releases the
+        # GIL). A source set again meanwhile keeps no key
+        with self._lock:
+            unhashed = [(key, self._results[key], self._generations.get(key, 0)) for key in keys
+                        if self._stages[key]["function"] is None and key in self._results
+                        and self._contentKeys.get(key) is None]
+        futures = {pool.submit(contentKey, value): (key, generation) for key, value, generation in unhashed}
+        for future in concurrent.futures.as_completed(futures):
+            key, generation = futures[future]
+            valueKey = future.result()
+            with self._lock:
+                if self._generations.get(key, 0) == generation:
+                    self._contentKeys[key] = valueKey
+
+    def _stageContentKey(self, key):
+        # Called with the lock held, once all dependencies have results
+        if self.store is None:
+            return None
+        stage = self._stages[key]
+        dependencyKeys = [self._contentKeys.get(dependency) for dependency in stage["dependencies"]]
+        if None in dependencyKeys:
+            return None
+        function = stage["function"]
+        return contentKey(key[0] if isinstance(key, tuple) else key,
+                          getattr(function, "__qualname__", repr(function)),
+                          stage["parameters"], dependencyKeys)
+
+    def _compute(self, stage, inputs, stageKey):
+        # Worker thread: reuse a stored result when the same inputs have been seen before
+        if stageKey is not None:
+            value = self.store.load(stageKey)
+            if value is not None:
+                return value
+        value = stage["function"](*inputs, **stage["parameters"])
+        if stageKey is not None:
+            self.store.save(stageKey, value)
+        return value
@@ -0,0 +1,217 @@
+import itertools
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+
+PROJECT_VERSION = 1
+INDEX_NAME = "index.json"
+
+
+def defaultChunks(shape, chunkSize=256):
+    """
+    Chunk shape for an image stack: chunkSize x chunkSize tiles of the last two axes, one plane of every other axis
+    """
+    chunks = [1] * len(shape)
+    for axis in range(max(len(shape) - 2, 0), len(shape)):
+        chunks[axis] = min(chunkSize, shape[axis]) or 1
+    return tuple(chunks)
+
+
+class ChunkedArray:
+    """
+    Read-only, lazily paged array stored as zlib-compressed chunks in a TITAN project. Only the chunks covering the
+    requested region are read and decompressed; read() with no region pages in the whole array
+    """
+
+    def __init__(self, directory, shape, dtype, chunks):
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(chunks)
+        self.ndim = len(self.shape)
+
+    def _chunkPath(self, chunkIndex):
+        return os.path.join(self.directory, ".".join(str(i) for i in chunkIndex) + ".z")
+
+    def _readChunk(self, chunkIndex):
+        chunkShape = tuple(min(size, total - index * size)
+                           for index, size, total in zip(chunkIndex, self.chunks, self.shape))
+        path = self._chunkPath(chunkIndex)
+        if not os.path.isfile(path):
+            # Chunks that were all zeros are not written
+            return np.zeros(chunkShape, self.dtype)
+        with open(path, "rb") as chunkFile:
+            data = zlib.decompress(chunkFile.read())
+        return np.frombuffer(data, self.dtype).reshape(chunkShape)
+
+    def read(self, region=None):
+        """
+        Return the array, or the part of it given by a tuple of indices and slices (steps are not supported), as a
+        NumPy array
+        """
+        if region is None:
+            region = ()
+        if not isinstance(region, tuple):
+            region = (region,)
+        region = region + (slice(None),) * (self.ndim - len(region))
+        bounds = []
+        droppedAxes = []
+        for axis, (axisSlice, total) in enumerate(zip(region, self.shape)):
+            if not isinstance(axisSlice, slice):
+                index = int(axisSlice) + (total if axisSlice < 0 else 0)
+                axisSlice = slice(index, index + 1)
+                droppedAxes.append(axis)
+            start, stop, step = axisSlice.indices(total)
+            if step != 1:
+                raise ValueError("ChunkedArray regions must be contiguous")
+            bounds.append((start, max(start, stop)))
+
+        out = np.zeros(tuple(stop - start for start, stop in bounds), self.dtype)
+        chunkRanges = [range(start // size, (stop - 1) // size + 1) if stop > start else range(0)
+                       for (start, stop), size in zip(bounds, self.chunks)]
+        for chunkIndex in itertools.product(*chunkRanges):
+            chunk = self._readChunk(chunkIndex)
+            source = []
+            target = []
+            for index, size, (start, stop) in zip(chunkIndex, self.chunks, bounds):
+                chunkStart = index * size
+                low = max(start, chunkStart)
+                high = min(stop, chunkStart + size)
+                source.append(slice(low - chunkStart, high - chunkStart))
+                target.append(slice(low - start, high - start))
+            out[tuple(target)] = chunk[tuple(source)]
+        return out.squeeze(axis=tuple(droppedAxes)) if droppedAxes else out
+
+    def __getitem__(self, region):
+        return self.read(region)
+
+    def __array__(self, dtype=None):
+        array = self.read()
+        return array if dtype is None else array.astype(dtype)
+
+
+class TitanProject:
+    """
+    TITAN project folder: an index.json with all metadata (ROIs, channels, masks, gates, tables, embeddings) and one
+    folder of compressed chunks per array. Opening a project only reads the index; arrays are paged in on demand.
+
+    Layout:
+        <project>/index.json
+        <project>/arrays/<arrayId>/<chunk index>.z
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self.index = {"version": PROJECT_VERSION, "arrays": {}, "metadata": {}}
+        indexPath = os.path.join(path, INDEX_NAME)
+        if os.path.isfile(indexPath):
+            with open(indexPath) as indexFile:
+                self.index = json.load(indexFile)
+            if self.index.get("version", 0) > PROJECT_VERSION:
+                raise ValueError("TITAN project " + path + " was written by a newer version of TITAN")
+
+    @staticmethod
+    def isProject(path):
+        return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+    def save(self):
+        """
+        Write the index. Arrays are already on disk when writeArray returns
+        """
+        os.makedirs(self.path, exist_ok=True)
+        indexPath = os.path.join(self.path, INDEX_NAME)
+        with self._lock:
+            with open(indexPath + ".tmp", "w") as indexFile:
+                json.dump(self.index, indexFile, indent=1)
+            os.replace(indexPath + ".tmp", indexPath)
+
+    def setMetadata(self, key, value):
+        with self._lock:
+            self.index["metadata"][key] = value
+
+    def metadata(self, key, default=None):
+        return self.index["metadata"].get(key, default)
+
+    def arrayNames(self):
+        return list(self.index["arrays"])
+
+    def hasArray(self, name):
+        return name in self.index["arrays"]
+
+    def writeArray(self, name, array, chunks=None, attributes=None, compressionLevel=1):
+        """
+        Store array under name in compressed chunks, replacing any array of that name. attributes is a JSON-able
+        dict kept in the index (e.g. volume origin and spacing)
+        """
+        array = np.ascontiguousarray(array)
+        chunks = tuple(chunks or defaultChunks(array.shape))
+        with self._lock:
+            entry = self.index["arrays"].get(name)
+            if entry is None:
+                entry = {"id": "a%d" % len(self.index["arrays"])}
+                while any(other["id"] == entry["id"] for other in self.index["arrays"].values()):
+                    entry["id"] += "_"
+            directory = os.path.join(self.path, "arrays", entry["id"])
+            os.makedirs(directory, exist_ok=True)
+            for fileName in os.listdir(directory):
+                os.remove(os.path.join(directory, fileName))
+
+        for chunkIndex in itertools.product(*[range(-(-total // size)) for total, size in zip(array.shape, chunks)]):
+            chunk = array[tuple(slice(index * size, (index + 1) * size) for index, size in zip(chunkIndex, chunks))]
+            if not chunk.any():
+                continue
+            chunkPath = os.path.join(directory, ".".join(str(i) for i in chunkIndex) + ".z")
+            with open(chunkPath, "wb") as chunkFile:
+                chunkFile.write(zlib.compress(np.ascontiguousarray(chunk).tobytes(), compressionLevel))
+
+        entry.update({"shape": list(array.shape), "dtype": array.dtype.str, "chunks": list(chunks),
+                      "attributes": attributes or {}})
+        with self._lock:
+            self.index["arrays"][name] = entry
+
+    def array(self, name):
+        """
+        Return a lazily paged ChunkedArray; nothing is read until it is indexed
+        """
+        entry = self.index["arrays"][name]
+        return ChunkedArray(os.path.join(self.path, "arrays", entry["id"]), entry["shape"], entry["dtype"],
+                            entry["chunks"])
+
+    def arrayAttributes(self, name):
+        return self.index["arrays"][name].get("attributes", {})
+
+    def writeTable(self, name, columns):
+        """
+        Store a table given as an ordered {column name: 1D array or list} dict. Numeric columns are stored as arrays,
+        text columns in the index
+        """
+        columnEntries = []
+        for columnName, values in columns.items():
+            values = np.asarray(values)
+            if values.dtype.kind in "biuf":
+                arrayName = "table/" + name + "/" + str(columnName)
+                self.writeArray(arrayName, values, chunks=(max(len(values), 1),))
+                columnEntries.append({"name": str(columnName), "array": arrayName})
+            else:
+                columnEntries.append({"name": str(columnName), "values": [str(value) for value in values]})
+        with self._lock:
+            self.index["metadata"].setdefault("tables", {})[name] = columnEntries
+
+    def tableNames(self):
+        return list(self.metadata("tables", {}))
+
+    def readTable(self, name):
+        """
+        Return the table as an ordered {column name: array or list} dict
+        """
+        columns = {}
+        for column in self.metadata("tables", {})[name]:
+            if "array" in column:
+                columns[column["name"]] = self.array(column["array"]).read()
+            else:
+                columns[column["name"]] = column["values"]
+        return columns
@@ -0,0 +1,94 @@
+import collections
+import math
+
+import numpy as np
+
+
+def blockMean(array, factor=2):
+    """
+    Downsample the last two axes of an array by averaging factor x factor blocks. Trailing rows and columns that do
+    not fill a block are dropped
+    """
+    height = array.shape[-2] // factor
+    width = array.shape[-1] // factor
+    cropped = np.asarray(array)[..., :height * factor, :width * factor]
+    blocks = cropped.reshape(cropped.shape[:-2] + (height, factor, width, factor))
+    return blocks.mean(axis=(-3, -1), dtype=np.float32)
+
+
+def buildPyramid(array, minSize=128):
+    """
+    Levels 1, 2, ... of a block-mean image pyramid: each level halves the previous one, down to minSize pixels
+    along the shorter image axis. Level 0 is the array itself and is not copied
+    """
+    levels = []
+    current = array
+    while min(current.shape[-2:]) // 2 >= minSize:
+        current = blockMean(current)
+        levels.append(current)
+    return levels
+
+
+def levelForScale(imagePixelsPerScreenPixel, nLevels):
+    """
+    Coarsest level that still has at least one image pixel per screen pixel
+    """
+    if imagePixelsPerScreenPixel <= 1:
+        return 0
+    return min(int(math.floor(math.log2(imagePixelsPerScreenPixel))), nLevels)
+
+
+class PyramidCache:
+    """
+    Per-channel image pyramids, keyed by channel and rebuilt when the channel's version (e.g. its image MTime)
+    changes. Pyramids of at most maxChannels channels are kept, least recently used first out
+    """
+
+    def __init__(self, maxChannels=64, minSize=128):
+        self.maxChannels = maxChannels
+        self.minSize = minSize
+        self._pyramids = collections.OrderedDict()
+
+    def pyramid(self, key, version, loadArray):
+        """
+        Return the levels (1, 2, ...) of a channel's pyramid, building them from loadArray() when not cached
+        """
+        cached = self._pyramids.get(key)
+        if cached is not None and cached[0] == version:
+            self._pyramids.move_to_end(key)
+            return cached[1]
+        levels = buildPyramid(loadArray(), self.minSize)
+        self._pyramids[key] = (version, levels)
+        self._pyramids.move_to_end(key)
+        while len(self._pyramids) > self.maxChannels:
+            self._pyramids.popitem(last=False)
+        return levels
+
+    def level(self, key, version, loadArray, level):
+        """
+        Return one level of a channel's pyramid; level 0 is loadArray() itself
+        """
+        if level <= 0:
+            return loadArray()
+        levels = self.pyramid(key, version, loadArray)
+        return levels[min(level, len(levels)) - 1] if levels else loadArray()
+
+    def levelAtLeast(self, key, version, loadArray, size, build=True):
+        """
+        Return the coarsest level whose shorter image axis still has at least size pixels. With build=False a
+        pyramid that is not cached is not built, and loadArray() is returned instead
+        """
+        cached = self._pyramids.get(key)
+        if not build and (cached is None or cached[0] != version):
+            return loadArray()
+        levels = self.pyramid(key, version, loadArray)
+        for level in reversed(levels):
+            if min(level.shape[-2:]) >= size:
+                return level
+        return loadArray()
+
+    def remove(self, key):
+        self._pyramids.pop(key, None)
+
+    def clear(self):
+        self._pyramids.clear()
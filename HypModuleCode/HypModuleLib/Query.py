@@ -0,0 +1,204 @@
+import operator
+import re
+
+import numpy as np
+
+# Marker names are runs of word characters and dots that do not read as a number, or are quoted
+_TOKEN = re.compile(r"\s*(?:(?P<quoted>\"[^\"]*\"|'[^']*'|`[^`]*`)"
+                    r"|(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?(?![\w.]))"
+                    r"|(?P<word>[\w.]+)|(?P<symbol>[<>=!]=|[<>&|~()\-+]))")
+
+_COMPARISONS = {">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le, "==": operator.eq,
+                "!=": operator.ne}
+
+_KEYWORDS = {"and": "&", "or": "|", "not": "~"}
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            position += len(text[position:]) - len(text[position:].lstrip())
+            raise ValueError("Unexpected character %r at position %d of query" % (text[position], position))
+        position = match.end()
+        if match.group("quoted") is not None:
+            tokens.append(("name", match.group("quoted")[1:-1]))
+        elif match.group("number") is not None:
+            tokens.append(("number", float(match.group("number"))))
+        elif match.group("word") is not None:
+            word = match.group("word")
+            tokens.append(("symbol", _KEYWORDS[word.lower()]) if word.lower() in _KEYWORDS else ("name", word))
+        else:
+            tokens.append(("symbol", match.group("symbol")))
+    return tokens
+
+
+class _Parser:
+    # Recursive descent over: or := and ("|" and)*, and := not ("&" not)*, not := "~" not | "(" or ")" | comparison,
+    # comparison := operand (op operand)+, operand := ["-" | "+"] (number | name)
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, symbol=None):
+        token = self.peek()
+        if token[0] is None or (symbol is not None and token != ("symbol", symbol)):
+            raise ValueError("Expected %s in query" % (repr(symbol) if symbol else "more input"))
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.orExpression()
+        if self.peek()[0] is not None:
+            raise ValueError("Unexpected %r in query" % (self.peek()[1],))
+        return node
+
+    def orExpression(self):
+        node = self.andExpression()
+        while self.peek() == ("symbol", "|"):
+            self.take()
+            node = ("|", node, self.andExpression())
+        return node
+
+    def andExpression(self):
+        node = self.notExpression()
+        while self.peek() == ("symbol", "&"):
+            self.take()
+            node = ("&", node, self.notExpression())
+        return node
+
+    def notExpression(self):
+        if self.peek() == ("symbol", "~"):
+            self.take()
+            return ("~", self.notExpression())
+        if self.peek() == ("symbol", "("):
+            self.take()
+            node = self.orExpression()
+            self.take(")")
+            return node
+        return self.comparison()
+
+    def comparison(self):
+        # Chained comparisons such as 1 < CD3 <= 5 mean 1 < CD3 & CD3 <= 5
+        left = self.operand()
+        node = None
+        while self.peek()[0] == "symbol" and self.peek()[1] in _COMPARISONS:
+            symbol = self.take()[1]
+            right = self.operand()
+            test = ("compare", symbol, left, right)
+            node = test if node is None else ("&", node, test)
+            left = right
+        if node is None:
+            raise ValueError("Expected a comparison such as CD3 > 2 in query")
+        return node
+
+    def operand(self):
+        sign = 1.0
+        while self.peek() in (("symbol", "-"), ("symbol", "+")):
+            if self.take()[1] == "-":
+                sign = -sign
+        kind, value = self.take()
+        if kind == "number":
+            return ("number", sign * value)
+        if kind == "name":
+            return ("name", value) if sign > 0 else ("negative", value)
+        raise ValueError("Expected a marker name or number in query, found %r" % (value,))
+
+
+def parseQuery(text):
+    """
+    Parse a marker-threshold query such as "CD3 > 2 & CD20 < 0.5" into an expression tree. Comparisons (>, >=, <, <=,
+    ==, !=, chained as in 1 < CD3 < 5) of marker names and numbers are combined with & (and), | (or), ~ (not) and
+    parentheses; "and", "or" and "not" may be written out. Marker names containing other characters are quoted.
+    Raises ValueError for malformed queries
+    """
+    tokens = _tokenize(text)
+    if not tokens:
+        raise ValueError("Empty query")
+    return _Parser(tokens).parse()
+
+
+def queryMarkers(expression):
+    """
+    Marker names used in a parsed query, in order of first use
+    """
+    if expression[0] in ("name", "negative"):
+        return [expression[1]]
+    if expression[0] == "number":
+        return []
+    names = []
+    for child in expression[1:]:
+        if isinstance(child, tuple):
+            names += [name for name in queryMarkers(child) if name not in names]
+    return names
+
+
+def _findMarker(name, columnNames):
+    # Column indices matching a marker name, best matches only
+    if name in columnNames:
+        return [list(columnNames).index(name)]
+    lowered = [columnName.lower() for columnName in columnNames]
+    if name.lower() in lowered:
+        return [lowered.index(name.lower())]
+    matches = [index for index, columnName in enumerate(lowered) if name.lower() in columnName]
+    # Of "CD3(Er170Di).ome" and "CD3(Er170Di).ome (Nucleus)", "CD3" means the one the others extend
+    shortest = [index for index in matches if all(lowered[index] in lowered[other] for other in matches)]
+    return shortest[:1] if len(shortest) == 1 else matches
+
+
+def resolveMarker(name, columnNames):
+    """
+    Index of the column a query marker name refers to: an exact match, else a case-insensitive one, else the only
+    column whose name contains it (so "CD3" finds "CD3(Er170Di).ome", and not "CD3(Er170Di).ome (Nucleus)"). A
+    qualified name such as CD3.nucleus refers to the column "<column of CD3> (Nucleus)". Raises ValueError if there
+    is no such column or several
+    """
+    matches = _findMarker(name, columnNames)
+    if not matches and "." in name:
+        base, qualifier = name.rsplit(".", 1)
+        for index in _findMarker(base, columnNames)[:1]:
+            qualified = (columnNames[index] + " (" + qualifier + ")").lower()
+            matches = [other for other, columnName in enumerate(columnNames) if columnName.lower() == qualified]
+    if len(matches) == 1:
+        return matches[0]
+    if not matches:
+        raise ValueError("Unknown marker %r in query" % name)
+    raise ValueError("Marker %r in query matches %s" % (name, ", ".join(columnNames[index] for index in matches)))
+
+
+def evaluateQuery(expression, columns):
+    """
+    Boolean mask over cells of a parsed query, given columns: a mapping from marker name to one value per cell.
+    Each comparison is one vectorized NumPy operation over all cells
+    """
+    kind = expression[0]
+    if kind == "number":
+        return expression[1]
+    if kind == "name":
+        return columns[expression[1]]
+    if kind == "negative":
+        return -columns[expression[1]]
+    if kind == "compare":
+        return _COMPARISONS[expression[1]](evaluateQuery(expression[2], columns), evaluateQuery(expression[3], columns))
+    if kind == "~":
+        return ~evaluateQuery(expression[1], columns)
+    if kind == "&":
+        return evaluateQuery(expression[1], columns) & evaluateQuery(expression[2], columns)
+    return evaluateQuery(expression[1], columns) | evaluateQuery(expression[2], columns)
+
+
+def queryRows(expression, features, columnNames):
+    """
+    Boolean mask over the rows of a per-cell feature matrix (cell label in column 0, then one column per name in
+    columnNames) of the cells satisfying a parsed query
+    """
+    columns = {name: features[:, resolveMarker(name, columnNames) + 1] for name in queryMarkers(expression)}
+    selected = evaluateQuery(expression, columns)
+    return np.broadcast_to(np.asarray(selected, dtype=bool), (features.shape[0],))
@@ -0,0 +1,150 @@
+import numpy as np
+
+from .Dependencies import requireModule
+
+# Scatter plots with more points than this are drawn as one aggregated image instead of one marker per point
+RASTER_THRESHOLD = 50000
+
+
+def drawFigure(figure):
+    """
+    Draw a matplotlib figure on its Agg canvas and return the canvas pixels as a height x width x 4 uint8 RGBA view,
+    top row first. The view shares the canvas buffer and is only valid until the figure is drawn again or closed
+    """
+    figure.canvas.draw()
+    return np.asarray(figure.canvas.buffer_rgba())
+
+
+def figureToRgb(figure, out=None):
+    """
+    Height x width x 3 uint8 RGB image of a matplotlib figure, drawn in memory and written into out if given
+    """
+    rgba = drawFigure(figure)
+    if out is None:
+        out = np.empty(rgba.shape[:2] + (3,), dtype=np.uint8)
+    out[...] = rgba[..., :3]
+    return out
+
+
+def aggregatePoints(x, y, shape, xRange, yRange, values=None, how="count"):
+    """
+    Bin points into a height x width pixel grid, bottom row first, covering xRange x yRange. how is
+        "count": the number of points in each pixel
+        "mean": the mean of values over the points in each pixel
+        "category": the value of the last point in each pixel, i.e. the one a scatter plot would draw on top
+    Pixels without points are NaN for "mean" and "category"
+    """
+    height, width = shape
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    columns = np.floor((x - xRange[0]) / (xRange[1] - xRange[0]) * width).astype(np.intp)
+    rows = np.floor((y - yRange[0]) / (yRange[1] - yRange[0]) * height).astype(np.intp)
+    inside = (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+    pixels = rows[inside] * width + columns[inside]
+
+    counts = np.bincount(pixels, minlength=height * width).astype(np.float64)
+    if how == "count":
+        return counts.reshape(height, width)
+    values = np.asarray(values, dtype=np.float64).ravel()[inside]
+    grid = np.full(height * width, np.nan)
+    if how == "mean":
+        filled = counts > 0
+        grid[filled] = np.bincount(pixels, values, height * width)[filled] / counts[filled]
+    elif how == "category":
+        lastPoint = np.full(height * width, -1, dtype=np.intp)
+        np.maximum.at(lastPoint, pixels, np.arange(len(pixels)))
+        filled = lastPoint >= 0
+        grid[filled] = values[lastPoint[filled]]
+    else:
+        raise ValueError("Unknown aggregation " + repr(how))
+    return grid.reshape(height, width)
+
+
+def shadeAggregate(grid, colormap, valueRange=None, spread=1):
+    """
+    RGBA uint8 image of an aggregated grid (see aggregatePoints) through a matplotlib colormap. Empty (NaN) pixels
+    are transparent; with spread > 0 they take the colour of a filled pixel at most spread pixels away, so isolated
+    points stay visible
+    """
+    filled = np.isfinite(grid)
+    values = grid[filled]
+    low, high = valueRange if valueRange is not None else ((values.min(), values.max()) if len(values) else (0, 1))
+    normalized = np.zeros(grid.shape)
+    if high > low:
+        normalized[filled] = (values - low) / (high - low)
+    image = colormap(normalized, bytes=True)
+    image[~filled] = 0
+
+    points = image.copy()
+    for radius in range(1, spread + 1):
+        for rowShift in range(-radius, radius + 1):
+            for columnShift in range(-radius, radius + 1):
+                if max(abs(rowShift), abs(columnShift)) != radius:
+                    continue
+                source = _shifted(points, rowShift, columnShift)
+                empty = (image[..., 3] == 0) & (source[..., 3] > 0)
+                image[empty] = source[empty]
+    return image
+
+
+def _shifted(image, rowShift, columnShift):
+    # image moved by (rowShift, columnShift) pixels, with transparent pixels shifted in
+    shifted = np.zeros_like(image)
+    height, width = image.shape[:2]
+    shifted[max(rowShift, 0):height + min(rowShift, 0), max(columnShift, 0):width + min(columnShift, 0)] = \
+        image[max(-rowShift, 0):height + min(-rowShift, 0), max(-columnShift, 0):width + min(-columnShift, 0)]
+    return shifted
+
+
+def rasterScatter(ax, x, y, c=None, how=None, cmap="viridis", valueRange=None, spread=1, margin=0.05):
+    """
+    Draw points on matplotlib axes as one image of per-pixel aggregates, sized to the axes' extent in the figure, so
+    the drawing time does not depend on the number of points. Without c the points are shaded by count (log
+    scale); with c by "mean" or "category" (see aggregatePoints), "category" by default. Returns the image artist
+    """
+    matplotlib = requireModule("matplotlib")
+    x = np.asarray(x, dtype=np.float64).ravel()
+    y = np.asarray(y, dtype=np.float64).ravel()
+    if how is None:
+        how = "count" if c is None else "category"
+    colormap = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+
+    # Data limits with the same margins matplotlib adds around a scatter plot
+    ranges = []
+    for values in (x, y):
+        low, high = (values.min(), values.max()) if len(values) else (0.0, 1.0)
+        pad = (high - low) * margin if high > low else 0.5
+        ranges.append((low - pad, high + pad))
+    extent = ax.get_window_extent()
+    shape = (max(int(round(extent.height)), 1), max(int(round(extent.width)), 1))
+
+    grid = aggregatePoints(x, y, shape, ranges[0], ranges[1], c, how)
+    if how == "count":
+        grid[grid == 0] = np.nan
+        grid = np.log1p(grid)
+    elif valueRange is None and c is not None and len(c):
+        valueRange = (np.min(c), np.max(c))
+    image = shadeAggregate(grid, colormap, valueRange, spread)
+    artist = ax.imshow(image, origin="lower", extent=(ranges[0][0], ranges[0][1], ranges[1][0], ranges[1][1]),
+                       aspect="auto", interpolation="nearest")
+    ax.set_xlim(ranges[0])
+    ax.set_ylim(ranges[1])
+    return artist
+
+
+def scatterPoints(ax, x, y, c=None, how=None, cmap="viridis", s=10):
+    """
+    ax.scatter for up to RASTER_THRESHOLD points, rasterScatter above that
+    """
+    if len(x) <= RASTER_THRESHOLD:
+        return ax.scatter(x, y, c=c, s=s, cmap=cmap if c is not None else None)
+    return rasterScatter(ax, x, y, c, how, cmap)
+
+
+def categoryColours(nCategories, cmap="viridis"):
+    """
+    RGBA colours that ax.scatter and rasterScatter give to the categories 0 ... nCategories - 1, for legends
+    """
+    matplotlib = requireModule("matplotlib")
+    colormap = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+    return colormap(np.linspace(0, 1, nCategories))
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+# Bump when a stored artifact's format or the algorithm producing it changes, so old entries are not reused
+STORE_VERSION = 1
+
+# Seconds between index writes that only record cache hits
+INDEX_SAVE_INTERVAL = 30
+
+
+def contentKey(*parts):
+    """
+    Hash of the given inputs and parameters. Arrays are hashed by dtype, shape and data; lists, tuples and dicts
+    recursively; anything else by its repr
+    """
+    digest = hashlib.sha256()
+    digest.update(str(STORE_VERSION).encode())
+
+    def feed(value):
+        if isinstance(value, np.ndarray) and value.dtype == object:
+            feed(value.tolist())
+        elif isinstance(value, np.ndarray):
+            digest.update(b"array" + str(value.dtype).encode() + str(value.shape).encode())
+            digest.update(np.ascontiguousarray(value).data)
+        elif isinstance(value, (list, tuple)):
+            digest.update(b"list" + str(len(value)).encode())
+            for item in value:
+                feed(item)
+        elif isinstance(value, dict):
+            digest.update(b"dict" + str(len(value)).encode())
+            for name in sorted(value, key=repr):
+                feed(name)
+                feed(value[name])
+        elif hasattr(value, "to_numpy"):
+            # pandas objects
+            feed(value.to_numpy())
+        else:
+            digest.update(b"value" + repr(value).encode())
+
+    for part in parts:
+        feed(part)
+    return digest.hexdigest()
+
+
+class ResultStore:
+    """
+    Local content-addressed store for masks, feature matrices, embeddings and thumbnails.
+
+    Artifacts are files named after the contentKey of the inputs and parameters they were made from, so a result
+    computed in one session is found again in the next. An index records the size and last use of every entry; when
+    the store grows past maxBytes the least recently used entries are deleted.
+
+    The directory and index are only touched on first use. Cache hits update the index in memory; it is written
+    when entries are added or removed, and otherwise at most every INDEX_SAVE_INTERVAL seconds or on flush()
+    """
+
+    def __init__(self, directory, maxBytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self._lock = threading.RLock()
+        self._indexPath = os.path.join(directory, "index.json")
+        self._loadedIndex = None
+        self._dirty = False
+        self._savedAt = 0.0
+
+    @property
+    def _index(self):
+        with self._lock:
+            if self._loadedIndex is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._loadedIndex = self._loadIndex()
+            return self._loadedIndex
+
+    def _loadIndex(self):
+        try:
+            with open(self._indexPath) as indexFile:
+                index = json.load(indexFile)
+        except (OSError, ValueError):
+            index = {}
+        # Drop entries whose file has gone
+        return {name: entry for name, entry in index.items() if os.path.isfile(os.path.join(self.directory, name))}
+
+    def _saveIndex(self):
+        temporaryPath = self._indexPath + ".tmp"
+        with open(temporaryPath, "w") as indexFile:
+            json.dump(self._index, indexFile)
+        os.replace(temporaryPath, self._indexPath)
+        self._dirty = False
+        self._savedAt = time.time()
+
+    def flush(self):
+        """
+        Write the index if cache hits have changed it since it was last written
+        """
+        with self._lock:
+            if self._dirty:
+                self._saveIndex()
+
+    def path(self, key, suffix=""):
+        return os.path.join(self.directory, key + suffix)
+
+    def totalBytes(self):
+        with self._lock:
+            return sum(entry["size"] for entry in self._index.values())
+
+    def contains(self, key, suffix=""):
+        with self._lock:
+            return key + suffix in self._index
+
+    def get(self, key, suffix=""):
+        """
+        Return the path of a stored artifact and mark it as recently used, or None if it is not in the store
+        """
+        name = key + suffix
+        with self._lock:
+            if name not in self._index:
+                return None
+            if not os.path.isfile(self.path(key, suffix)):
+                del self._index[name]
+                self._dirty = True
+                return None
+            self._index[name]["lastAccess"] = time.time()
+            self._dirty = True
+            if time.time() - self._savedAt > INDEX_SAVE_INTERVAL:
+                self._saveIndex()
+            return self.path(key, suffix)
+
+    def put(self, key, suffix, writer):
+        """
+        Store an artifact written by writer(path) and return its final path. The file is written under a temporary
+        name first, so a partly written artifact is never found
+        """
+        finalPath = self.path(key, suffix)
+        root, extension = os.path.splitext(finalPath)
+        temporaryPath = root + ".%d.%d.tmp" % (os.getpid(), threading.get_ident()) + extension
+        os.makedirs(self.directory, exist_ok=True)
+        writer(temporaryPath)
+        os.replace(temporaryPath, finalPath)
+        with self._lock:
+            self._index[key + suffix] = {"size": os.path.getsize(finalPath), "lastAccess": time.time()}
+            self._evict(keep=key + suffix)
+            self._saveIndex()
+        return finalPath
+
+    def load(self, key):
+        """
+        Return a stored Python object, or None if it is not in the store
+        """
+        path = self.get(key, ".pkl")
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as objectFile:
+                return pickle.load(objectFile)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.remove(key, ".pkl")
+            return None
+
+    def save(self, key, value):
+        """
+        Store a Python object (arrays, tuples, dicts, ...)
+        """
+        def write(path):
+            with open(path, "wb") as objectFile:
+                pickle.dump(value, objectFile, protocol=pickle.HIGHEST_PROTOCOL)
+        return self.put(key, ".pkl", write)
+
+    def remove(self, key, suffix=""):
+        with self._lock:
+            self._index.pop(key + suffix, None)
+            try:
+                os.remove(self.path(key, suffix))
+            except OSError:
+                pass
+            self._saveIndex()
+
+    def setMaxBytes(self, maxBytes):
+        with self._lock:
+            self.maxBytes = maxBytes
+            self._evict()
+            self._saveIndex()
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._index):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+            self._loadedIndex = {}
+            self._saveIndex()
+
+    def _evict(self, keep=None):
+        # Delete least recently used entries until the store fits in maxBytes
+        total = sum(entry["size"] for entry in self._index.values())
+        for name in sorted(self._index, key=lambda name: self._index[name]["lastAccess"]):
+            if total <= self.maxBytes:
+                break
+            if name == keep:
+                continue
+            total -= self._index[name]["size"]
+            del self._index[name]
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
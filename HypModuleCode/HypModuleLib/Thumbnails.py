@@ -0,0 +1,128 @@
+import concurrent.futures
+import os
+
+import numpy as np
+
+from .Dependencies import requireModule
+from .Pyramid import blockMean
+from .ResultStore import contentKey
+
+THUMBNAIL_SIZE = 400
+
+
+def makeThumbnail(array, size=THUMBNAIL_SIZE):
+    """
+    8-bit, autocontrasted thumbnail of the first slice of a channel, at most size x size pixels. The slice is first
+    block-mean reduced to the coarsest pyramid level that is still at least size pixels on its shorter axis
+    """
+    Image = requireModule("PIL.Image")
+    ImageOps = requireModule("PIL.ImageOps")
+    image = np.asarray(array[0])
+    reduced = image
+    while min(reduced.shape) // 2 >= size:
+        reduced = blockMean(reduced)
+    if reduced is not image:
+        reduced = reduced.astype(image.dtype)
+    img = Image.fromarray(np.ascontiguousarray(reduced))
+    img = img.convert("L")
+    img.thumbnail((size, size))
+    img = ImageOps.autocontrast(img)
+    return np.array(img)
+
+
+def cachedPerSource(store, sources, kind, make, maxWorkers=None, load=True, job=None):
+    """
+    Apply make(array) to every source, a list of (identity, array), in a thread pool and keep the results in the
+    store under contentKey(kind, identity) (or the array content when identity is None). Results found in the store
+    are loaded instead. The arrays are only read. With load=False the store is only filled and None is returned for
+    results that were already stored. job, if given, is a BackgroundJob used for progress and cancellation
+    """
+    maxWorkers = maxWorkers or min(8, os.cpu_count() or 1)
+    results = [None] * len(sources)
+
+    def result(index):
+        identity, array = sources[index]
+        key = contentKey(kind, array if identity is None else identity)
+        if not load and store.contains(key, ".pkl"):
+            return index, None
+        cached = store.load(key)
+        if cached is None:
+            cached = make(array)
+            store.save(key, cached)
+        return index, cached
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        futures = [pool.submit(result, index) for index in range(len(sources))]
+        try:
+            for done, future in enumerate(concurrent.futures.as_completed(futures)):
+                index, results[index] = future.result()
+                if job is not None:
+                    job.checkCancelled()
+                    job.setProgress(100 * (done + 1) // len(sources), kind)
+        finally:
+            for future in futures:
+                future.cancel()
+    return results
+
+
+def cachedThumbnails(store, sources, size=THUMBNAIL_SIZE, maxWorkers=None, load=True, job=None):
+    """
+    Thumbnails of sources, a list of (identity, array), made in parallel and cached in the store (see
+    cachedPerSource)
+    """
+    return cachedPerSource(store, sources, "thumbnail %d" % size, lambda array: makeThumbnail(array, size),
+                           maxWorkers, load, job)
+
+
+def channelStatistics(array):
+    """
+    Intensity statistics of the first slice of a channel, used for contrast settings
+    """
+    values = np.asarray(array[0], dtype=np.float32).ravel()
+    p1, p50, p99 = np.percentile(values, [1, 50, 99])
+    return {"min": float(values.min()), "max": float(values.max()), "mean": float(values.mean()),
+            "p1": float(p1), "p50": float(p50), "p99": float(p99)}
+
+
+def cachedStatistics(store, sources, maxWorkers=None, job=None):
+    """
+    channelStatistics of sources, a list of (identity, array), computed in parallel and cached in the store
+    """
+    return cachedPerSource(store, sources, "statistics", channelStatistics, maxWorkers, True, job)
+
+
+def reduceToTile(array, tileSize):
+    """
+    Block-mean downsample the first slice of a channel by the smallest integer factor that fits it in
+    tileSize x tileSize
+    """
+    image = np.asarray(array[0])
+    factor = max(1, -(-max(image.shape) // tileSize))
+    if factor == 1:
+        return image.astype(np.float32)
+    return blockMean(image, factor)
+
+
+def cohortMontage(tiles, lows, highs, tileSize, padding=2):
+    """
+    uint8 grid of tiles[row][column] (2D arrays, or None for a missing image), each centred in a tileSize cell. Every
+    column is contrast-stretched from lows[column] to highs[column], so a channel is shown alike in every row
+    """
+    nRows = len(tiles)
+    nColumns = len(tiles[0]) if nRows else 0
+    cell = tileSize + padding
+    grid = np.zeros((max(nRows * cell - padding, 0), max(nColumns * cell - padding, 0)), dtype=np.uint8)
+    for column in range(nColumns):
+        span = highs[column] - lows[column]
+        gain = 255.0 / span if span > 0 else 0.0
+        for row in range(nRows):
+            tile = tiles[row][column]
+            if tile is None:
+                continue
+            scaled = (tile - np.float32(lows[column])) * np.float32(gain)
+            np.clip(scaled, 0, 255, out=scaled)
+            height, width = scaled.shape
+            top = row * cell + (tileSize - height) // 2
+            left = column * cell + (tileSize - width) // 2
+            grid[top:top + height, left:left + width] = scaled
+    return grid
@@ -0,0 +1,21 @@
+from .Dependencies import (REQUIRED_PACKAGES, checkDependencies, installPackages, missingPackages, requireModule,
+                           requirePyplot)
+from .Jobs import BackgroundJob, JobCancelled, JobRunner
+from .Features import (CELL_STATISTICS, COMPARTMENTS, MORPHOLOGY_FEATURES, borderLabels, cellLabels,
+                       cellMeanIntensities, cellMorphology, cellStatisticLut, compartmentColumnNames,
+                       compartmentMeanIntensities, joinCellFeatures, labelsUnderSelection, percentileNormalize,
+                       removeCells, selectCells, shapeFeatures)
+from .Pipeline import StageScheduler
+from .ResultStore import STORE_VERSION, ResultStore, contentKey
+from .Project import ChunkedArray, TitanProject
+from .Compositing import OVERLAY_COLOURS, OverlayCompositor, colourMatrix, compositeChannels, normalizedPreview, thresholdLut
+from .Pyramid import PyramidCache, blockMean, buildPyramid, levelForScale
+from .Thumbnails import (THUMBNAIL_SIZE, cachedPerSource, cachedStatistics, cachedThumbnails, channelStatistics,
+                         cohortMontage, makeThumbnail, reduceToTile)
+from .Rendering import (RASTER_THRESHOLD, aggregatePoints, categoryColours, drawFigure, figureToRgb, rasterScatter,
+                        scatterPoints, shadeAggregate)
+from .Density import binnedDensity, scottCovariance
+from .Gates import CellGate, GatingTree, labelBits
+from .Query import evaluateQuery, parseQuery, queryMarkers, queryRows, resolveMarker
+from .CellTable import CellTable
+from .Export import CELL_TABLE_FORMATS, CSV_CHUNK_ROWS, cellTableBlocks, writeCellTable, writeCsv, writeCsvFiles
@@ -0,0 +1,81 @@
+import unittest
+
+import numpy as np
+
+from HypModuleLib.CellTable import CellTable
+
+
+class CellTableTest(unittest.TestCase):
+    """
+    Appending, replacing and removing the cells of ROIs in the cohort cell table
+    """
+
+    def setUp(self):
+        self.table = CellTable(["CD3", "CD20"], fill=np.nan)
+        self.table.append("ROI 1", [1, 2, 3], {"CD3": [1.0, 2.0, 3.0], "CD20": [4.0, 5.0, 6.0]})
+        self.table.append("ROI 2", [7, 8], {"CD3": [7.0, 8.0]})
+
+    def test_append(self):
+        self.assertEqual(len(self.table), 5)
+        self.assertIn("ROI 2", self.table)
+        self.assertEqual(self.table.offsets.tolist(), [0, 3, 5])
+        self.assertEqual(self.table.labels().tolist(), [1, 2, 3, 7, 8])
+        self.assertEqual(self.table.column("CD3").tolist(), [1.0, 2.0, 3.0, 7.0, 8.0])
+        self.assertTrue(np.isnan(self.table.column("CD20", "ROI 2")).all())
+
+    def test_newColumnsGetFillValue(self):
+        self.table.append("ROI 3", [1], {"Area": [10.0]})
+        self.assertEqual(self.table.columnNames, ["CD3", "CD20", "Area"])
+        self.assertTrue(np.isnan(self.table.column("Area", "ROI 1")).all())
+        self.assertEqual(self.table.column("Area", "ROI 3").tolist(), [10.0])
+
+    def test_appendingRoiAgainReplacesIt(self):
+        self.table.append("ROI 1", [4, 5], {"CD3": [9.0, 10.0], "CD20": [11.0, 12.0]})
+        self.assertEqual(self.table.rois, ["ROI 2", "ROI 1"])
+        self.assertEqual(self.table.offsets.tolist(), [0, 2, 4])
+        self.assertEqual(self.table.labels("ROI 1").tolist(), [4, 5])
+        self.assertEqual(self.table.labels("ROI 2").tolist(), [7, 8])
+        self.assertEqual(self.table.column("CD3").tolist(), [7.0, 8.0, 9.0, 10.0])
+
+    def test_remove(self):
+        self.table.append("ROI 3", [1, 2], {"CD3": [5.0, 6.0], "CD20": [0.0, 0.0]})
+        self.table.remove("ROI 2")
+        self.assertEqual(self.table.rois, ["ROI 1", "ROI 3"])
+        self.assertEqual(self.table.offsets.tolist(), [0, 3, 5])
+        self.assertEqual(self.table.rows("ROI 3"), slice(3, 5))
+        self.assertEqual(self.table.column("CD3", "ROI 3").tolist(), [5.0, 6.0])
+        self.table.remove("ROI 1")
+        self.table.remove("ROI 3")
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(self.table.offsets.tolist(), [0])
+
+    def test_roiIndices(self):
+        self.assertEqual(self.table.roiIndices().tolist(), [0, 0, 0, 1, 1])
+
+    def test_growsPastInitialCapacity(self):
+        table = CellTable(["CD3"])
+        for index in range(3):
+            table.append(index, np.arange(1, 1001), {"CD3": np.full(1000, float(index))})
+        self.assertEqual(len(table), 3000)
+        self.assertEqual(table.column("CD3", 2).tolist(), [2.0] * 1000)
+        self.assertEqual(table.labels(1)[-1], 1000)
+
+    def test_matrix(self):
+        self.table.append("ROI 3", [1], {"Area": [10.0]})
+        view = self.table.matrix(["CD20", "Area"], "ROI 1")
+        self.assertTrue(np.shares_memory(view, self.table.matrix()))
+        gathered = self.table.matrix(["Area", "CD3"], "ROI 1")
+        self.assertFalse(np.shares_memory(gathered, self.table.matrix()))
+        self.assertEqual(gathered[:, 1].tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(self.table.matrix(roi="ROI 1").shape, (3, 3))
+
+    def test_features(self):
+        features = self.table.features("ROI 1", ["CD20"])
+        self.assertEqual(features.tolist(), [[1.0, 4.0], [2.0, 5.0], [3.0, 6.0]])
+        table = CellTable()
+        table.appendFeatures("ROI 1", features, ["CD20"])
+        self.assertEqual(table.features("ROI 1").tolist(), features.tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
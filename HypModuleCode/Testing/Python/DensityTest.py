@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+
+from HypModuleLib.Density import binnedDensity, scottCovariance
+
+
+def _directDensity(x, y, covariance):
+    # Gaussian kernel density evaluated exactly at every point, as scipy.stats.gaussian_kde does
+    offsets = np.stack([x[:, None] - x[None, :], y[:, None] - y[None, :]], axis=-1)
+    inverse = np.linalg.inv(covariance)
+    exponent = np.einsum("ijk,kl,ijl->ij", offsets, inverse, offsets)
+    normalization = 2 * np.pi * np.sqrt(np.linalg.det(covariance)) * len(x)
+    return np.exp(-0.5 * exponent).sum(axis=1) / normalization
+
+
+class BinnedDensityTest(unittest.TestCase):
+    """
+    Binned FFT kernel density against the exact estimate
+    """
+
+    def test_matchesDirectDensity(self):
+        random = np.random.default_rng(0)
+        x = random.normal(0, 1, 500)
+        y = 0.5 * x + random.normal(0, 2, 500)
+        covariance = scottCovariance(x, y)
+        expected = _directDensity(x, y, covariance)
+        density = binnedDensity(x, y, gridSize=256)
+        np.testing.assert_allclose(density, expected, rtol=0.02, atol=1e-3 * expected.max())
+
+    def test_scottCovariance(self):
+        x = np.arange(8.0)
+        y = x[::-1] * 2
+        np.testing.assert_allclose(scottCovariance(x, y + np.sin(x)), np.cov(x, y + np.sin(x)) * 8 ** (-1.0 / 3))
+
+    def test_degeneratePoints(self):
+        self.assertEqual(scottCovariance([1.0], [2.0]).tolist(), np.eye(2).tolist())
+        covariance = scottCovariance(np.arange(5.0), np.arange(5.0))
+        self.assertGreater(np.linalg.det(covariance), 0)
+        covariance = scottCovariance(np.arange(5.0), np.zeros(5))
+        self.assertEqual(covariance[1, 1], 1.0)
+        for x, y in [([3.0], [4.0]), (np.arange(5.0), np.arange(5.0)), (np.ones(6), np.ones(6))]:
+            density = binnedDensity(x, y, gridSize=32)
+            self.assertTrue(np.all(np.isfinite(density)))
+            self.assertTrue(np.all(density > 0))
+
+    def test_empty(self):
+        self.assertEqual(binnedDensity([], []).shape, (0,))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import csv
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from HypModuleLib.CellTable import CellTable
+from HypModuleLib.Export import writeCellTable, writeCsv, writeCsvFiles
+
+
+def _readCsv(text):
+    return list(csv.reader(io.StringIO(text, newline="")))
+
+
+class WriteCsvTest(unittest.TestCase):
+    """
+    Streaming CSV writer over blocks of columns
+    """
+
+    def write(self, header, blocks, chunkRows=4):
+        stream = io.StringIO(newline="")
+        writeCsv(stream, header, blocks, chunkRows)
+        return stream.getvalue()
+
+    def test_quoting(self):
+        header = ["Name, with comma", 'Quoted "name"', "Line\nbreak"]
+        text = self.write(header, [[np.array(["a,b", 'say "hi"', "x\ny"]), 'ROI "1"', np.array([1, 2, 3])]])
+        rows = _readCsv(text)
+        self.assertEqual(rows[0], header)
+        self.assertEqual(rows[1:], [["a,b", 'ROI "1"', "1"], ['say "hi"', 'ROI "1"', "2"], ["x\ny", 'ROI "1"', "3"]])
+
+    def test_constantColumns(self):
+        text = self.write(["ROI", "Cell Label", "Area"], [["ROI 100%", np.array([1, 2]), 5],
+                                                          ["ROI %d", np.array([3]), 1.5]])
+        self.assertEqual(_readCsv(text)[1:], [["ROI 100%", "1", "5"], ["ROI 100%", "2", "5"], ["ROI %d", "3", "1.5"]])
+
+    def test_emptyBlocks(self):
+        text = self.write(["ROI", "Cell Label"], [["ROI 1", np.zeros(0, dtype=np.int64)], ["ROI 2", 7], []])
+        self.assertEqual(text, "ROI,Cell Label\n")
+        self.assertEqual(self.write(["ROI"], []), "ROI\n")
+
+    def test_floatsReadBack(self):
+        values = np.array([0.1, 1 / 3, 1e-300, -2.5e10, np.pi])
+        rows = _readCsv(self.write(["Value", "Single"], [[values, values.astype(np.float32)]]))[1:]
+        self.assertEqual([float(row[0]) for row in rows], values.tolist())
+        self.assertEqual(np.array([row[1] for row in rows], dtype=np.float32).tolist(),
+                         values.astype(np.float32).tolist())
+
+    def test_chunks(self):
+        labels = np.arange(10)
+        for chunkRows in (1, 3, 10, 100):
+            with self.subTest(chunkRows=chunkRows):
+                rows = _readCsv(self.write(["Cell Label", "ROI"], [[labels, "ROI 1"]], chunkRows))[1:]
+                self.assertEqual([int(row[0]) for row in rows], labels.tolist())
+
+    def test_writeCsvFiles(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = [(os.path.join(directory, "%d.csv" % index), ["Cell Label"], [[np.arange(index)]])
+                     for index in range(5)]
+            self.assertEqual(writeCsvFiles(files, maxWorkers=2), [path for path, header, blocks in files])
+            for index, (path, header, blocks) in enumerate(files):
+                with open(path, newline="") as file:
+                    self.assertEqual(len(list(csv.reader(file))), index + 1)
+
+
+class WriteCellTableTest(unittest.TestCase):
+    """
+    Exporting a cohort cell table ROI by ROI
+    """
+
+    def setUp(self):
+        self.cells = CellTable(["CD3", "Area"])
+        self.cells.append("ROI 1", [1, 2], {"CD3": [0.5, 1.5], "Area": [10.0, 20.0]})
+        self.cells.append("ROI, 2", [5], {"CD3": [2.5], "Area": [30.0]})
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_csv(self):
+        path = writeCellTable(self.cells, os.path.join(self.directory.name, "cells.csv"), "CSV")
+        with open(path, newline="") as file:
+            rows = list(csv.reader(file))
+        self.assertEqual(rows, [["ROI", "Cell Label", "CD3", "Area"], ["ROI 1", "1", "0.5", "10.0"],
+                                ["ROI 1", "2", "1.5", "20.0"], ["ROI, 2", "5", "2.5", "30.0"]])
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_parquet(self):
+        import pyarrow.parquet
+        path = writeCellTable(self.cells, os.path.join(self.directory.name, "cells.parquet"), "Parquet")
+        table = pyarrow.parquet.read_table(path).to_pydict()
+        self.assertEqual(table["ROI"], ["ROI 1", "ROI 1", "ROI, 2"])
+        self.assertEqual(table["Cell Label"], [1, 2, 5])
+        self.assertEqual(table["Area"], [10.0, 20.0, 30.0])
+
+    @unittest.skipUnless(importlib.util.find_spec("h5py"), "h5py is not installed")
+    def test_hdf5(self):
+        import h5py
+        path = writeCellTable(self.cells, os.path.join(self.directory.name, "cells.h5"), "HDF5")
+        with h5py.File(path, "r") as file:
+            self.assertEqual(file["cells/ROI"][:].tolist(), [0, 0, 1])
+            self.assertEqual(file["cells/CD3"][:].tolist(), [0.5, 1.5, 2.5])
+            self.assertEqual(file["ROI offsets"][:].tolist(), [0, 2, 3])
+
+    def test_unknownFormat(self):
+        with self.assertRaises(ValueError):
+            writeCellTable(self.cells, os.path.join(self.directory.name, "cells.xlsx"), "Excel")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+import numpy as np
+
+from HypModuleLib.Features import percentileNormalize
+
+
+class PercentileNormalizeTest(unittest.TestCase):
+    """
+    Per-channel percentile normalization of cell features before embedding
+    """
+
+    def test_columnsScaledByTheirPercentile(self):
+        values = np.column_stack([np.arange(1.0, 101.0), 10 * np.arange(1.0, 101.0)])
+        percentileNormalize(values)
+        np.testing.assert_allclose(values[-1], values[-1, 0])
+        np.testing.assert_allclose(np.percentile(values, 99, axis=0), [1.0, 1.0])
+
+    def test_zeroPercentileColumnKeptFinite(self):
+        # A sparse marker, in 1 of 200 cells
+        sparse = np.zeros(200)
+        sparse[0] = 5.0
+        values = np.column_stack([np.arange(1.0, 201.0), sparse, np.zeros(200)])
+        percentileNormalize(values)
+        self.assertTrue(np.all(np.isfinite(values)))
+        self.assertEqual(values[0, 1], 5.0)
+        self.assertEqual(np.count_nonzero(values[:, 2]), 0)
+
+    def test_noCells(self):
+        values = np.zeros((0, 3))
+        self.assertEqual(percentileNormalize(values).shape, (0, 3))
+
+    def test_inPlaceOnTableView(self):
+        table = np.asfortranarray(np.arange(1.0, 13.0).reshape(4, 3))
+        view = table[:2]
+        self.assertIs(percentileNormalize(view), view)
+        np.testing.assert_allclose(table[2:], [[7.0, 8.0, 9.0], [10.0, 11.0, 12.0]])
+        np.testing.assert_allclose(table[:2], [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]] / np.array([3.97, 4.97, 5.97]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import numpy as np
+
+from HypModuleLib.Gates import CellGate, GatingTree, labelBits
+
+
+class CellGateTest(unittest.TestCase):
+    """
+    Gate algebra on bitsets over cell labels
+    """
+
+    def setUp(self):
+        self.population = CellGate.population("ROI 1", [1, 2, 3, 4, 5, 9])
+        self.first = self.population.subset([1, 2, 3])
+        self.second = self.population.subset([3, 4, 9])
+
+    def test_labelBits(self):
+        bits = labelBits([0, 3, 10, 15, 16, -1], 16)
+        self.assertEqual(len(bits), 2)
+        self.assertEqual(np.flatnonzero(np.unpackbits(bits)).tolist(), [0, 3, 10, 15])
+
+    def test_subsetIgnoresCellsOutsideGate(self):
+        self.assertEqual(self.first.subset([2, 3, 4, 100]).labels().tolist(), [2, 3])
+
+    def test_operators(self):
+        self.assertEqual((self.first & self.second).labels().tolist(), [3])
+        self.assertEqual((self.first | self.second).labels().tolist(), [1, 2, 3, 4, 9])
+        self.assertEqual((self.first - self.second).labels().tolist(), [1, 2])
+        self.assertEqual((~self.first).labels().tolist(), [4, 5, 9])
+        self.assertEqual((~self.population).count(), 0)
+
+    def test_countAndFraction(self):
+        self.assertEqual(self.population.count(), 6)
+        self.assertEqual(len(self.second), 3)
+        self.assertAlmostEqual(self.first.fraction(), 0.5)
+        self.assertEqual(CellGate.population("Empty", []).fraction(), 0.0)
+
+    def test_contains(self):
+        self.assertIn(9, self.second)
+        self.assertNotIn(5, self.second)
+        self.assertNotIn(-1, self.second)
+        self.assertNotIn(1000, self.second)
+
+    def test_differentRoisDoNotCombine(self):
+        other = CellGate.population("ROI 2", [1, 2, 3, 4, 5, 9])
+        with self.assertRaises(ValueError):
+            self.first & other
+
+    def test_mask(self):
+        cellMask = np.array([[[0, 1, 1], [2, 5, 9]]])
+        self.assertEqual(self.second.mask(cellMask).tolist(), [[[0, 0, 0], [0, 0, 9]]])
+
+
+class GatingTreeTest(unittest.TestCase):
+    """
+    Gate hierarchy, counts relative to the parent and cached rows
+    """
+
+    def setUp(self):
+        population = CellGate.population("ROI 1", np.arange(1, 11))
+        self.tree = GatingTree()
+        self.tree.add("T cells", population.subset([1, 2, 3, 4, 5, 6]))
+        self.tree.add("CD4", population.subset([1, 2, 3]), "T cells")
+        self.tree.add("CD8", population.subset([4, 5]), "T cells")
+        self.features = np.column_stack([np.arange(1, 11), np.arange(10, 110, 10)]).astype(np.float64)
+
+    def test_walk(self):
+        self.assertEqual(list(self.tree.walk()), [("T cells", 0), ("CD4", 1), ("CD8", 1)])
+        self.assertEqual(self.tree.children("T cells"), ["CD4", "CD8"])
+        self.assertIsNone(self.tree.parent("T cells"))
+
+    def test_unknownParentIsIgnored(self):
+        self.tree.add("B cells", self.tree["T cells"], "No such gate")
+        self.assertIsNone(self.tree.parent("B cells"))
+
+    def test_countAndFraction(self):
+        self.assertEqual(self.tree.count("CD4"), 3)
+        self.assertAlmostEqual(self.tree.fraction("CD4"), 0.5)
+        self.assertAlmostEqual(self.tree.fraction("T cells"), 0.6)
+
+    def test_gateGatedFromItselfKeepsItsParent(self):
+        self.tree.add("CD4", self.tree["CD4"].subset([1, 2]), "CD4")
+        self.assertEqual(self.tree.parent("CD4"), "T cells")
+        self.assertIn(("CD4", 1), list(self.tree.walk()))
+        # Replacing it again must not recurse forever
+        self.tree.add("CD4", self.tree["CD4"].subset([1]), "CD4")
+        self.assertEqual(self.tree.count("CD4"), 1)
+
+    def test_descendantIsNotMadeParent(self):
+        self.tree.add("T cells", self.tree["T cells"], "CD8")
+        self.assertIsNone(self.tree.parent("T cells"))
+        self.assertEqual(len(list(self.tree.walk())), 3)
+
+    def test_rowsAndStatistics(self):
+        rows = self.tree.rows("CD8", "key", self.features)
+        self.assertEqual(rows[:, 0].tolist(), [4, 5])
+        statistics = self.tree.statistics("CD8", "key", self.features, ["Marker"])
+        self.assertAlmostEqual(statistics["Marker"]["mean"], 45.0)
+        self.assertEqual(self.tree.summaries("CD8")["Marker"]["count"], 2)
+
+    def test_replacingGateDropsCachesOfSubtree(self):
+        self.tree.rows("CD4", "key", self.features)
+        self.tree.add("T cells", self.tree["T cells"].subset([1, 2]))
+        self.assertEqual(self.tree.rows("CD4", "key", self.features)[:, 0].tolist(), [1, 2])
+        self.assertEqual(self.tree.count("T cells"), 2)
+
+    def test_rowsRecomputedForNewFeatureVersion(self):
+        self.tree.statistics("CD8", "key", self.features, ["Marker"], version=1)
+        self.tree.rows("CD8", "key", self.features, version=1)
+        edited = self.features.copy()
+        edited[:, 1] *= 2
+        self.assertEqual(self.tree.rows("CD8", "key", edited, version=1)[:, 1].tolist(), [40.0, 50.0])
+        self.assertEqual(self.tree.rows("CD8", "key", edited, version=2)[:, 1].tolist(), [80.0, 100.0])
+        self.assertAlmostEqual(self.tree.statistics("CD8", "key", edited, ["Marker"], version=2)["Marker"]["mean"],
+                               90.0)
+        self.assertAlmostEqual(self.tree.summaries("CD8")["Marker"]["mean"], 90.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
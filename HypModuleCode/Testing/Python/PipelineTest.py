@@ -0,0 +1,42 @@
+import unittest
+
+from HypModuleLib.Pipeline import StageScheduler
+
+
+class StageSchedulerTest(unittest.TestCase):
+    """
+    Invalidation of stages downstream of a changed source
+    """
+
+    def setUp(self):
+        self.scheduler = StageScheduler(maxWorkers=2)
+        self.calls = []
+        self.scheduler.setSource("channel", 1, lambda: 3)
+        self.scheduler.define("double", self.double, ["channel"])
+
+    def double(self, value):
+        self.calls.append(value)
+        return 2 * value
+
+    def test_resultsReusedUntilSourceChanges(self):
+        self.assertEqual(self.scheduler.run(["double"])["double"], 6)
+        self.scheduler.setSource("channel", 1, lambda: 4)
+        self.assertEqual(self.scheduler.run(["double"])["double"], 6)
+        self.scheduler.setSource("channel", 2, lambda: 4)
+        self.assertEqual(self.scheduler.run(["double"])["double"], 8)
+        self.assertEqual(self.calls, [3, 4])
+
+    def test_generation(self):
+        self.scheduler.run(["double"])
+        generation = self.scheduler.generation("double")
+        self.scheduler.setSource("channel", 1, lambda: 3)
+        self.assertEqual(self.scheduler.generation("double"), generation)
+        self.scheduler.setSource("channel", 2, lambda: 3)
+        self.assertGreater(self.scheduler.generation("double"), generation)
+        generation = self.scheduler.generation("double")
+        self.scheduler.define("double", self.double, ["channel"], {"unused": True})
+        self.assertGreater(self.scheduler.generation("double"), generation)
+
+
+if __name__ == "__main__":
+    unittest.main()
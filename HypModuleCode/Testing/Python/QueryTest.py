@@ -0,0 +1,119 @@
+import unittest
+
+import numpy as np
+
+from HypModuleLib.Query import evaluateQuery, parseQuery, queryMarkers, queryRows, resolveMarker
+
+
+class ParseQueryTest(unittest.TestCase):
+    """
+    Tokenizing and parsing marker-threshold queries
+    """
+
+    def test_comparison(self):
+        self.assertEqual(parseQuery("CD3 > 2"), ("compare", ">", ("name", "CD3"), ("number", 2.0)))
+
+    def test_precedence(self):
+        expression = parseQuery("CD3 > 2 | CD4 > 1 & ~CD8 >= 1e-5")
+        self.assertEqual(expression[0], "|")
+        self.assertEqual(expression[2][0], "&")
+        self.assertEqual(expression[2][2], ("~", ("compare", ">=", ("name", "CD8"), ("number", 1e-5))))
+
+    def test_keywords(self):
+        self.assertEqual(parseQuery("CD3 > 2 and not (CD4 < 1 or CD8 < 1)"),
+                         parseQuery("CD3 > 2 & ~(CD4 < 1 | CD8 < 1)"))
+
+    def test_chainedComparison(self):
+        self.assertEqual(parseQuery("1 < CD3 <= 5"),
+                         ("&", ("compare", "<", ("number", 1.0), ("name", "CD3")),
+                          ("compare", "<=", ("name", "CD3"), ("number", 5.0))))
+
+    def test_quotedNames(self):
+        expression = parseQuery("\"CD3 (Er170Di)\" > 1 & 'Ki-67' < 2 & `a b` == 0")
+        self.assertEqual(queryMarkers(expression), ["CD3 (Er170Di)", "Ki-67", "a b"])
+
+    def test_unaryMinus(self):
+        self.assertEqual(parseQuery("CD3 > -.5"), ("compare", ">", ("name", "CD3"), ("number", -0.5)))
+        self.assertEqual(parseQuery("-CD3 < 2")[2], ("negative", "CD3"))
+        self.assertEqual(parseQuery("--CD3 < 2")[2], ("name", "CD3"))
+
+    def test_dottedNames(self):
+        self.assertEqual(queryMarkers(parseQuery("CD3.nucleus > 1 & CD3 > 2 & CD3.nucleus < 5")),
+                         ["CD3.nucleus", "CD3"])
+
+    def test_malformed(self):
+        for text in ["", "   ", "CD3", "CD3 >", "CD3 > 2 &", "(CD3 > 2", "CD3 > 2)", "CD3 > 2 CD4", "CD3 $ 2",
+                     "> 2", "CD3 > &"]:
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                parseQuery(text)
+
+
+class ResolveMarkerTest(unittest.TestCase):
+    """
+    Matching query marker names to feature columns
+    """
+
+    columnNames = ["CD3(Er170Di).ome", "CD3(Er170Di).ome (Nucleus)", "CD20(Dy161Di).ome", "cd45", "Area"]
+
+    def test_exact(self):
+        self.assertEqual(resolveMarker("Area", self.columnNames), 4)
+        self.assertEqual(resolveMarker("CD3(Er170Di).ome (Nucleus)", self.columnNames), 1)
+
+    def test_caseInsensitive(self):
+        self.assertEqual(resolveMarker("CD45", self.columnNames), 3)
+        self.assertEqual(resolveMarker("area", self.columnNames), 4)
+
+    def test_substring(self):
+        self.assertEqual(resolveMarker("CD20", self.columnNames), 2)
+        self.assertEqual(resolveMarker("nucleus", self.columnNames), 1)
+
+    def test_prefersColumnOthersExtend(self):
+        self.assertEqual(resolveMarker("CD3", self.columnNames), 0)
+
+    def test_qualifiedName(self):
+        self.assertEqual(resolveMarker("CD3.nucleus", self.columnNames), 1)
+        self.assertEqual(resolveMarker("cd3.Nucleus", self.columnNames), 1)
+
+    def test_ambiguous(self):
+        with self.assertRaises(ValueError) as context:
+            resolveMarker("ome", self.columnNames)
+        self.assertIn("CD20(Dy161Di).ome", str(context.exception))
+
+    def test_unknown(self):
+        for name in ["CD8", "CD20.nucleus"]:
+            with self.subTest(name=name), self.assertRaises(ValueError):
+                resolveMarker(name, self.columnNames)
+
+
+class EvaluateQueryTest(unittest.TestCase):
+    """
+    Selecting cells of a feature matrix with a parsed query
+    """
+
+    def setUp(self):
+        self.columnNames = ["CD3", "CD20"]
+        self.features = np.array([[1, 0.5, 3.0],
+                                  [2, 2.5, 0.0],
+                                  [3, 5.0, 1.0],
+                                  [4, 6.0, 0.2]])
+
+    def test_evaluateQuery(self):
+        columns = {"CD3": self.features[:, 1]}
+        self.assertEqual(evaluateQuery(parseQuery("-CD3 < -2"), columns).tolist(), [False, True, True, True])
+
+    def test_queryRows(self):
+        self.assertEqual(queryRows(parseQuery("1 < CD3 <= 5"), self.features, self.columnNames).tolist(),
+                         [False, True, True, False])
+        self.assertEqual(queryRows(parseQuery("cd3 > 1 and not CD20 < 0.5"), self.features, self.columnNames).tolist(),
+                         [False, False, True, False])
+
+    def test_constantQuery(self):
+        self.assertEqual(queryRows(parseQuery("1 < 2"), self.features, self.columnNames).tolist(), [True] * 4)
+
+    def test_unknownMarker(self):
+        with self.assertRaises(ValueError):
+            queryRows(parseQuery("CD8 > 1"), self.features, self.columnNames)
+
+
+if __name__ == "__main__":
+    unittest.main()